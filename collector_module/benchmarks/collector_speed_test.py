@@ -0,0 +1,178 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Collector throughput benchmark.
+
+Starts the fake security server of fake_security_server.py in a separate process, stores a server list of
+--servers fake servers and runs collector_main against it with a local MongoDB. Reports records/sec, bytes/sec,
+peak RSS and time spent in request, parse, sanitize and insert phases summed over all workers.
+Test data is written to databases of instance COLLECTOR_SPEED_TEST, which are dropped afterwards unless --keep is set.
+
+The collector connects to MongoDB database auth_db like in production, so use the collector MongoDB user.
+Peak RSS of child processes is the largest finished child, i.e. a collector worker process in process mode.
+
+Usage example:
+
+> cd collector_module
+> PYTHONPATH=. python benchmarks/collector_speed_test.py collector_TEST --host 127.0.0.1:27017 --servers 50 --history 3600 --mode thread
+
+"""
+
+import argparse
+import getpass
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+
+from fake_security_server import FakeSecurityServer, add_server_arguments
+
+from opmon_collector.collector_multiprocessing import collector_main
+from opmon_collector.database_manager import DatabaseManager
+from opmon_collector.logger_manager import LoggerManager
+
+TEST_INSTANCE = 'COLLECTOR_SPEED_TEST'
+
+
+def run_fake_security_server(port_queue, args):
+    server = FakeSecurityServer(0, args.records_per_second, args.max_records, args.latency, args.fault_rate)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_fake_security_server(args):
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_fake_security_server, args=(port_queue, args), daemon=True)
+    process.start()
+    return process, f'127.0.0.1:{port_queue.get(timeout=10)}'
+
+
+def build_settings(args, security_server_host, work_dir):
+    return {
+        'collector': {
+            'thread-count': args.thread_count,
+            'mode': args.mode,
+            'thread-concurrency': args.concurrency,
+            'records-from-offset': args.history,
+            'records-to-offset': 0,
+            'repeat-min-records': 50,
+            'repeat-limit': 500,
+            'records-chunk-size': 10000,
+            'pointer-flush-interval': 30,
+            'pid-directory': work_dir,
+            'documents-log-directory': None,
+        },
+        'xroad': {
+            'instance': TEST_INSTANCE,
+            'security-server': {'protocol': 'http://', 'host': security_server_host, 'timeout': 60.0},
+            'monitoring-client': {'memberclass': 'ORG', 'membercode': '1234567-8', 'subsystemcode': 'BENCHMARK'},
+        },
+        'mongodb': {'host': args.mdb_host, 'user': args.MONGODB_USER, 'password': args.mdb_pwd},
+        'logger': {
+            'name': 'collector_speed_test', 'module': 'collector', 'level': 'WARNING',
+            'log-path': work_dir, 'heartbeat-path': work_dir,
+        },
+    }
+
+
+def build_server_list(count):
+    server_list = []
+    for i in range(count):
+        server_code = f'ss{i}'
+        server_list.append({
+            'ownerId': str(i),
+            'instance': TEST_INSTANCE,
+            'memberClass': 'ORG',
+            'memberCode': f'{i:07d}-0',
+            'serverCode': server_code,
+            'address': f'{server_code}.benchmark',
+            'server': f'{TEST_INSTANCE}/ORG/{i:07d}-0/{server_code}/{server_code}.benchmark',
+        })
+    return server_list
+
+
+def print_report(summary, elapsed):
+    print(f"--- Servers collected: {summary['done']}, failed: {summary['error']}")
+    print(f"--- Requests: {summary['requests']}, records: {summary['records']}, bytes: {summary['bytes']}")
+    print(f'--- Wall time: {elapsed:.2f}s')
+    print(f"--- Throughput: {summary['records'] / elapsed:.0f} records/sec, {summary['bytes'] / elapsed / 1e6:.2f} MB/sec")
+
+    phases = ['request_time', 'parse_time', 'sanitize_time', 'insert_time']
+    total = sum(summary[phase] for phase in phases) or 1
+    for phase in phases:
+        print(f"--- {phase.replace('_', ' ').capitalize()}: {summary[phase]:.2f}s ({100 * summary[phase] / total:.1f}%)")
+
+    # ru_maxrss is in kilobytes on Linux
+    print(f'--- Peak RSS: collector {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB, '
+          f'largest child process {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collector throughput benchmark')
+    parser.add_argument('MONGODB_USER', metavar="MONGODB_USER", type=str, help="MongoDB collector user")
+    parser.add_argument('--password', dest='mdb_pwd', help='MongoDB Password', default=None)
+    parser.add_argument('--host', dest='mdb_host', help='MongoDB host (default: %(default)s)', default='127.0.0.1:27017')
+    parser.add_argument('--servers', type=int, default=20, help='Number of monitored servers (default: %(default)s)')
+    parser.add_argument('--history', type=int, default=3600,
+                        help='Seconds of history collected from every server (default: %(default)s)')
+    parser.add_argument('--mode', choices=['process', 'thread'], default='process', help='Collector mode (default: %(default)s)')
+    parser.add_argument('--thread-count', type=int, default=4, help='Collector processes (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=50, help='Thread mode concurrency (default: %(default)s)')
+    parser.add_argument('--security-server', default=None, help='host:port of a separately started fake security server')
+    parser.add_argument('--keep', action='store_true', help='Keep test databases')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    if args.mdb_pwd is None:
+        args.mdb_pwd = getpass.getpass('Password: ')
+
+    fake_server = None
+    security_server_host = args.security_server
+    if security_server_host is None:
+        fake_server, security_server_host = start_fake_security_server(args)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        settings = build_settings(args, security_server_host, work_dir)
+        logger_m = LoggerManager(settings['logger'], TEST_INSTANCE, 'benchmark')
+        db_manager = DatabaseManager(settings['mongodb'], TEST_INSTANCE, logger_m)
+        client = db_manager.get_client()
+        try:
+            db_manager.save_server_list_to_database(build_server_list(args.servers))
+            print(f'--- Collecting {args.history}s of history from {args.servers} servers in {args.mode} mode.')
+            tick = time.perf_counter()
+            summary = collector_main(settings)
+            elapsed = time.perf_counter() - tick
+            print_report(summary, elapsed)
+        finally:
+            if not args.keep:
+                client.drop_database(db_manager.db_name)
+                client.drop_database(db_manager.db_collector_state)
+            db_manager.close()
+            if fake_server is not None:
+                fake_server.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
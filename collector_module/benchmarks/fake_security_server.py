@@ -0,0 +1,205 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Stand-in X-Road security server for collector benchmarks.
+
+Answers getSecurityServerOperationalData requests with multipart SOAP responses carrying gzipped operational
+monitoring JSON, like a real security server. Every monitored server produces records-per-second records for
+each second of the requested time window. At most max-records records are returned per response, the rest is
+paged with nextRecordsFrom.
+
+Usage example:
+
+> python fake_security_server.py --port 8080 --records-per-second 10 --latency 0.05 --fault-rate 0.01
+
+"""
+
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOUNDARY = 'xroadBenchmarkBoundary'
+
+SOAP_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:om="http://x-road.eu/xsd/op-monitoring.xsd">\
+<SOAP-ENV:Body><om:getSecurityServerOperationalDataResponse><om:recordsCount>{count}</om:recordsCount>\
+<om:records>cid:operational-monitoring-data.json.gz</om:records>{next_records_from}\
+</om:getSecurityServerOperationalDataResponse></SOAP-ENV:Body></SOAP-ENV:Envelope>"""
+
+SOAP_FAULT = """<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"><SOAP-ENV:Body><SOAP-ENV:Fault>\
+<faultcode>Server.ServerProxy.NetworkError</faultcode><faultstring>Benchmark fault</faultstring>\
+<detail><faultDetail>benchmark</faultDetail></detail></SOAP-ENV:Fault></SOAP-ENV:Body></SOAP-ENV:Envelope>"""
+
+RECORDS_FROM_PATTERN = re.compile(r'<om:recordsFrom>(\d+)</om:recordsFrom>')
+RECORDS_TO_PATTERN = re.compile(r'<om:recordsTo>(\d+)</om:recordsTo>')
+SERVER_CODE_PATTERN = re.compile(r'<id:serverCode>([^<]*)</id:serverCode>')
+
+
+def generate_record(server_code, index, timestamp):
+    request_in_ts = int(timestamp * 1000)
+    return {
+        'monitoringDataTs': int(timestamp),
+        'securityServerType': 'Client' if index % 2 else 'Producer',
+        'requestInTs': request_in_ts,
+        'requestOutTs': request_in_ts + 150,
+        'responseInTs': request_in_ts + 320,
+        'responseOutTs': request_in_ts + 335,
+        'clientXRoadInstance': 'BENCHMARK',
+        'clientMemberClass': 'ORG',
+        'clientMemberCode': '1234567-8',
+        'clientSubsystemCode': 'CLIENT',
+        'serviceXRoadInstance': 'BENCHMARK',
+        'serviceMemberClass': 'ORG',
+        'serviceMemberCode': '7654321-0',
+        'serviceSubsystemCode': 'SERVICE',
+        'serviceCode': 'getRandom',
+        'serviceVersion': 'v1',
+        'messageId': f'{server_code}-{request_in_ts}-{index}',
+        'messageProtocolVersion': '4.0',
+        'clientSecurityServerAddress': f'{server_code}.client',
+        'serviceSecurityServerAddress': f'{server_code}.service',
+        'requestSoapSize': 1847,
+        'requestAttachmentCount': 0,
+        'responseSoapSize': 1860,
+        'responseMimeSize': 2422,
+        'responseAttachmentCount': 1,
+        'succeeded': True,
+        'xRoadVersion': '7.6.2' if index % 3 else '7.5.1',
+        'restPath': '/random',
+        'xRequestId': f'{server_code}-{index}-{request_in_ts:x}',
+    }
+
+
+def build_response(server_code, records_from, records_to, records_per_second, max_records):
+    """
+    Build a multipart response for the time window [records_from, records_to].
+    :return: Returns response body and number of records in the response.
+    """
+    count = max(int((records_to - records_from) * records_per_second), 0)
+    next_records_from = ''
+    if count > max_records:
+        count = max_records
+        next_timestamp = records_from + max(int(max_records / records_per_second), 1)
+        next_records_from = f'<om:nextRecordsFrom>{next_timestamp}</om:nextRecordsFrom>'
+
+    records = [generate_record(server_code, i, records_from + i / records_per_second) for i in range(count)]
+    attachment = gzip.compress(json.dumps({'records': records}, separators=(',', ':')).encode('utf-8'), compresslevel=1)
+    soap = SOAP_RESPONSE.format(count=count, next_records_from=next_records_from)
+    body = (
+        f'--{BOUNDARY}\r\ncontent-type:text/xml\r\n\r\n{soap}\r\n'
+        f'--{BOUNDARY}\r\ncontent-type:application/gzip\r\ncontent-transfer-encoding: binary\r\n'
+        f'content-id: <operational-monitoring-data.json.gz>\r\n\r\n'
+    ).encode('utf-8') + attachment + f'\r\n--{BOUNDARY}--\r\n'.encode('utf-8')
+    return body, count
+
+
+class FakeSecurityServerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        config = self.server.config
+        if config['latency']:
+            time.sleep(config['latency'])
+
+        if config['fault_rate'] and self.server.random() < config['fault_rate']:
+            self._send(SOAP_FAULT.encode('utf-8'), 'text/xml;charset=UTF-8')
+            return
+
+        body, count = build_response(
+            SERVER_CODE_PATTERN.search(request).group(1),
+            int(RECORDS_FROM_PATTERN.search(request).group(1)),
+            int(RECORDS_TO_PATTERN.search(request).group(1)),
+            config['records_per_second'],
+            config['max_records']
+        )
+        self.server.count_records(count)
+        self._send(body, f'multipart/related; type="text/xml"; charset=UTF-8; boundary={BOUNDARY}')
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSecurityServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, records_per_second=10.0, max_records=10000, latency=0.0, fault_rate=0.0, seed=1):
+        super().__init__(('127.0.0.1', port), FakeSecurityServerHandler)
+        self.config = {
+            'records_per_second': records_per_second,
+            'max_records': max_records,
+            'latency': latency,
+            'fault_rate': fault_rate,
+        }
+        self.records_served = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def count_records(self, count):
+        with self._lock:
+            self.records_served += count
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--records-per-second', type=float, default=10.0,
+                        help='Records produced by every monitored server per second (default: %(default)s)')
+    parser.add_argument('--max-records', type=int, default=10000,
+                        help='Maximum records per response (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency in seconds (default: %(default)s)')
+    parser.add_argument('--fault-rate', type=float, default=0.0,
+                        help='Share of requests answered with a SOAP fault (default: %(default)s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake X-Road security server for collector benchmarks')
+    parser.add_argument('--port', type=int, default=8080, help='Listening port (default: %(default)s)')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeSecurityServer(args.port, args.records_per_second, args.max_records, args.latency, args.fault_rate)
+    print(f'--- Fake security server listening on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Compare record sanitizing and insertTime stamping speed of the previous and the current collector implementation.
+
+Records are generated in memory, no database is needed. Every process sanitizes and stamps its own batches,
+so the reported records/sec per core stays comparable when running with several processes.
+
+Usage example:
+
+> PYTHONPATH=. python benchmarks/sanitize_speed_test.py --records 100000 --batches 10 --processes 4
+
+"""
+
+import argparse
+import time
+from multiprocessing import Pool
+
+from opmon_collector.collector_worker import CollectorWorker, MIN_REST_PATH_VERSION
+
+VERSIONS = ['7.5.1', '7.6.1', '7.6.2', '7.7.0', None]
+
+
+def generate_records(count):
+    records = []
+    for i in range(count):
+        record = {
+            'monitoringDataTs': 1604420300 + i,
+            'securityServerType': 'Client' if i % 2 else 'Producer',
+            'requestInTs': 1604420300000 + i,
+            'messageId': f'message-{i}',
+            'restPath': '/some/path/*',
+        }
+        version = VERSIONS[i % len(VERSIONS)]
+        if version is not None:
+            record['xRoadVersion'] = version
+        records.append(record)
+    return records
+
+
+def legacy_sanitize_and_stamp(records):
+    """ Implementation before the fast path: copy every record, parse version per record, time.time() per record. """
+    sanitized_records = []
+    for record in records:
+        sanitized_record = record.copy()
+        if 'xRoadVersion' not in record or not CollectorWorker._version_gte(record['xRoadVersion'], MIN_REST_PATH_VERSION):
+            sanitized_record.pop('restPath', None)
+        sanitized_records.append(sanitized_record)
+    for data in sanitized_records:
+        data['insertTime'] = float(time.time())
+    return sanitized_records
+
+
+def sanitize_and_stamp(records):
+    records = CollectorWorker._sanitize_records(records)
+    timestamp = float(time.time())
+    for data in records:
+        data['insertTime'] = timestamp
+    return records
+
+
+def run_batches(args):
+    function_name, record_count, batch_count = args
+    function = globals()[function_name]
+    elapsed = 0.0
+    for _ in range(batch_count):
+        records = generate_records(record_count)
+        tick = time.perf_counter()
+        function(records)
+        elapsed += time.perf_counter() - tick
+    return record_count * batch_count / elapsed
+
+
+def measure(function_name, record_count, batch_count, processes):
+    with Pool(processes=processes) as pool:
+        rates = pool.map(run_batches, [(function_name, record_count, batch_count)] * processes)
+    return sum(rates) / len(rates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collector record sanitizing speed test')
+    parser.add_argument('--records', type=int, default=100000, help='Records per batch (default: %(default)s)')
+    parser.add_argument('--batches', type=int, default=10, help='Batches per process (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=1, help='Parallel processes (default: %(default)s)')
+    args = parser.parse_args()
+
+    print(f'--- Sanitizing {args.batches} batches of {args.records} records in {args.processes} processes.')
+    legacy_rate = measure('legacy_sanitize_and_stamp', args.records, args.batches, args.processes)
+    print(f'--- Previous implementation: {legacy_rate:.0f} records/sec per core')
+    rate = measure('sanitize_and_stamp', args.records, args.batches, args.processes)
+    print(f'--- Current implementation: {rate:.0f} records/sec per core')
+    print(f'--- Speedup: {rate / legacy_rate:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -39,27 +39,42 @@ class CentralServerClient:
             central_server_settings.get('tls-client-key')
         )
         self.logger_m = logger_m
+        self.shared_params_location = None
 
-    def get_security_servers(self):
+    def get_security_servers(self, cached_shared_params_location=None):
+        """
+        Get list of security servers from the shared parameters of the central server.
+        :param cached_shared_params_location: Content-location of the shared parameters the cached server list
+            was parsed from. If the location has not changed, shared parameters are not downloaded again.
+        :return: Returns list of server dicts or None if the shared parameters have not changed.
+        """
         try:
-            shared_params = self._get_shared_params()
+            with requests.Session() as session:
+                self.shared_params_location = self._get_shared_params_location(session)
+                if cached_shared_params_location and self.shared_params_location == cached_shared_params_location:
+                    return None
+                shared_params = self._get_shared_params(session, self.shared_params_location)
             return self._parse_server_list(shared_params)
         except Exception as e:
             self.logger_m.log_exception('CentralServerClient.get_security_servers', repr(e))
             raise e
 
-    def _get_shared_params(self):
+    def _get_shared_params_location(self, session):
         internal_conf_url = f'{self.url}/internalconf'
 
-        global_conf = requests.get(internal_conf_url, timeout=self.timeout, cert=self.client_cert,
-                                   verify=self.server_cert)
+        global_conf = session.get(internal_conf_url, timeout=self.timeout, cert=self.client_cert,
+                                  verify=self.server_cert)
         global_conf.raise_for_status()
         #  NB! re.search global configuration regex might be changed
         # according version naming or other future naming conventions
         data = global_conf.content.decode('utf-8')
         s = re.search(r'Content-location: (/V\d+/\d+/shared-params.xml)', data)
-        shared_params = requests.get(f'{self.url}{s.group(1)}', timeout=self.timeout,
-                                     cert=self.client_cert, verify=self.server_cert)
+        return s.group(1)
+
+    def _get_shared_params(self, session, shared_params_location):
+        # Same session reuses the connection opened for internalconf
+        shared_params = session.get(f'{self.url}{shared_params_location}', timeout=self.timeout,
+                                    cert=self.client_cert, verify=self.server_cert)
         shared_params.raise_for_status()
         return shared_params
 
@@ -69,9 +84,10 @@ class CentralServerClient:
 
         root = ET.fromstring(shared_params.content)
         instance = root.find('./instanceIdentifier').text
+        members = {member.get('id'): member for member in root.findall('./member')}
         for server in root.findall('./securityServer'):
             owner_id = server.find('./owner').text
-            owner = root.find("./member[@id='{0}']".format(owner_id))
+            owner = members[owner_id]
             member_class = owner.find('./memberClass/code').text
             member_code = owner.find('./memberCode').text
             server_code = server.find('./serverCode').text
@@ -0,0 +1,82 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+DEFAULT_BACKOFF = 600
+DEFAULT_MAX_BACKOFF = 86400
+
+
+class CircuitBreaker:
+    """
+    Per-server circuit breaker of the collector.
+    Health of a server is stored in a document {server, failures, open_until, last_failure, last_error}.
+    After circuit-breaker-threshold consecutive failed collections the breaker opens and the server is skipped until
+    open_until. Backoff doubles on every further failure, up to circuit-breaker-max-backoff seconds.
+    When open_until has passed the breaker is half-open: the server is collected once and a failure opens the breaker
+    again with a longer backoff, while a success closes it.
+    """
+
+    def __init__(self, settings):
+        self.threshold = settings['collector'].get('circuit-breaker-threshold') or 0
+        self.backoff = settings['collector'].get('circuit-breaker-backoff') or DEFAULT_BACKOFF
+        self.max_backoff = settings['collector'].get('circuit-breaker-max-backoff') or DEFAULT_MAX_BACKOFF
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def is_open(self, health, now):
+        """
+        :param health: Health document of the server or None if server has no failures recorded.
+        :param now: Current timestamp.
+        :return: True if the server must be skipped.
+        """
+        if not self.enabled or health is None or health.get('open_until') is None:
+            return False
+        return health['open_until'] > now
+
+    @staticmethod
+    def record_success(server_key, health):
+        """
+        :return: Returns closed health document of the server or None if health of the server is not changed.
+        """
+        if health is None or not health.get('failures'):
+            return None
+        return {'server': server_key, 'failures': 0, 'open_until': None, 'last_failure': None, 'last_error': None}
+
+    def record_failure(self, server_key, health, error, now):
+        """
+        :return: Returns health document of the server with the failure recorded.
+        """
+        failures = (health or {}).get('failures', 0) + 1
+        open_until = None
+        if failures >= self.threshold:
+            backoff = self.backoff * 2 ** (failures - self.threshold)
+            open_until = now + min(backoff, self.max_backoff)
+        return {
+            'server': server_key,
+            'failures': failures,
+            'open_until': open_until,
+            'last_failure': now,
+            'last_error': repr(error),
+        }
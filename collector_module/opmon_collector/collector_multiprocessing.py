@@ -23,17 +23,28 @@
 #
 
 import time
+from contextlib import nullcontext
 from multiprocessing import Pool
 
+from .circuit_breaker import CircuitBreaker
 from .database_manager import DatabaseManager
 from .logger_manager import LoggerManager
-from .collector_worker import run_collector_thread
+from .metrics import MetricsWriter
+from .collector_worker import run_collector_thread, summarize_results, merge_stats
+from .collector_threads import process_thread_executor
 from .pid_file_handler import OpmonPidFileHandler
+from .records_spool import RecordsSpool, SpoolDrainer, DEFAULT_DRAIN_INTERVAL, DEFAULT_DRAIN_BATCH_SIZE
 from . import __version__
 
+DEFAULT_PRIORITY_LAG = 86400
+COLLECTOR_MODES = ('process', 'thread')
 
-def prepare_thread_inputs(settings, server_list, server_m, logger_m):
+
+def prepare_thread_inputs(settings, server_list, server_m, logger_m, pointers=None, rates=None, health=None):
     inputs = []
+    pointers = pointers or {}
+    rates = rates or {}
+    health = health or {}
 
     for server in server_list:
         data = dict()
@@ -41,42 +52,213 @@ def prepare_thread_inputs(settings, server_list, server_m, logger_m):
         data['logger_manager'] = logger_m
         data['server_manager'] = server_m
         data['server_data'] = server
+        data['records_from'] = pointers.get(server['server'])
+        data['records_rate'] = rates.get(server['server'])
+        data['health'] = health.get(server['server'])
         inputs.append(data)
 
     return inputs
 
 
-def process_thread_pool(settings, inputs):
-    pool = Pool(processes=settings['collector']['thread-count'])
-    results = pool.map(run_collector_thread, inputs)
-    done = len([result[0] for result in results if result[0]])
-    error = len(results) - done
-    return done, error
+def schedule_thread_inputs(settings, inputs, now):
+    """
+    Order worker inputs by backlog, so that the server whose records pointer lags most behind now is collected first.
+    Servers lagging more than priority-lag seconds get priority-repeat-limit repeats instead of repeat-limit.
+    :param settings: Collector settings.
+    :param inputs: Worker inputs prepared by prepare_thread_inputs.
+    :param now: Current timestamp.
+    :return: Returns inputs ordered by backlog, most lagged server first.
+    """
+    priority_lag = settings['collector'].get('priority-lag') or DEFAULT_PRIORITY_LAG
+    priority_repeat_limit = settings['collector'].get('priority-repeat-limit') or 0
+    max_lag = settings['collector']['records-from-offset']
+
+    for data in inputs:
+        data['lag'] = max_lag if data['records_from'] is None else now - data['records_from']
+        if data['lag'] > priority_lag and priority_repeat_limit > settings['collector']['repeat-limit']:
+            data['repeat_limit'] = priority_repeat_limit
+
+    return sorted(inputs, key=lambda data: data['lag'], reverse=True)
+
+
+def get_requeue_inputs(settings, inputs, pointers, now):
+    """
+    Select servers that made progress in the previous pass but still lag more than priority-lag seconds behind.
+    Servers that made no progress, for example unreachable servers, are not re-queued.
+    :param settings: Collector settings.
+    :param inputs: Worker inputs of the previous pass.
+    :param pointers: Records pointers read after the previous pass.
+    :param now: Current timestamp.
+    :return: Returns new worker inputs for servers to collect again.
+    """
+    priority_lag = settings['collector'].get('priority-lag') or DEFAULT_PRIORITY_LAG
+    requeue = []
+    for data in inputs:
+        records_from = pointers.get(data['server_data']['server'])
+        if records_from is None or data['records_from'] is None or records_from <= data['records_from']:
+            continue
+        if now - records_from > priority_lag:
+            requeue.append({**data, 'records_from': records_from})
+    return requeue
+
+
+def process_thread_pool(settings, inputs, pool=None):
+    if pool is None:
+        with Pool(processes=settings['collector']['thread-count']) as pool:
+            return process_thread_pool(settings, inputs, pool)
+    # chunksize=1 dispatches servers in scheduled order
+    results = pool.map(run_collector_thread, inputs, chunksize=1)
+    return summarize_results(results)
+
+
+def create_worker_pool(settings):
+    """
+    Create worker process pool shared by all collection passes of a run.
+    Worker processes are forked when the pool is created, so the pool must be created before the spool drainer
+    thread or any other thread is started.
+    :return: Returns the Pool, or an empty context in thread mode.
+    """
+    if get_collector_mode(settings) == 'thread':
+        return nullcontext()
+    return Pool(processes=settings['collector']['thread-count'])
+
+
+def start_spool_drainer(settings, server_m, logger_m):
+    """
+    Start background thread that inserts spooled records to database while servers are collected.
+    Records left in the spool by previous runs are inserted first.
+    :return: Returns the started SpoolDrainer or None if spool is not enabled.
+    """
+    if not settings['collector'].get('spool-directory'):
+        return None
+    spool = RecordsSpool(settings['collector']['spool-directory'], settings['xroad']['instance'])
+    spool_drainer = SpoolDrainer(
+        spool, server_m, logger_m,
+        interval=settings['collector'].get('spool-drain-interval') or DEFAULT_DRAIN_INTERVAL,
+        batch_size=settings['collector'].get('spool-drain-batch-size') or DEFAULT_DRAIN_BATCH_SIZE
+    )
+    spool_drainer.start()
+    return spool_drainer
+
+
+def get_collector_mode(settings):
+    """
+    Get collector mode from settings.
+    :return: Returns the collector mode, 'process' if mode is not set.
+    """
+    mode = settings['collector'].get('mode') or 'process'
+    if mode not in COLLECTOR_MODES:
+        raise ValueError(f'Unsupported collector mode: {mode}')
+    return mode
+
+
+def get_pointer_flush_interval(settings):
+    """
+    Get interval of buffered pointer writes.
+    Pointers are buffered only in thread mode, where all workers share the DatabaseManager of the run. In process mode
+    every worker process has its own copy of the DatabaseManager and would flush about one pointer per bulk write.
+    :return: Returns pointer-flush-interval in thread mode, 0 in process mode.
+    """
+    if get_collector_mode(settings) != 'thread':
+        return 0
+    return settings['collector'].get('pointer-flush-interval') or 0
+
+
+def process_pool(settings, inputs, pool=None):
+    if get_collector_mode(settings) == 'thread':
+        return process_thread_executor(settings, inputs)
+    return process_thread_pool(settings, inputs, pool)
 
 
 def run_threaded_collector(logger_m, settings):
     logger_m.log_info('collector_start', 'Starting collector')
+    get_collector_mode(settings)
 
     OpmonPidFileHandler(settings).create_pid_file()
 
     start_time_time = time.time()
-    server_m = DatabaseManager(settings['mongodb'], settings['xroad']['instance'], logger_m)
-    server_list, timestamp = server_m.get_server_list_from_database()
-    print(f'- Using server list updated at: {timestamp}')
+    # Worker processes are forked before the database client and the spool drainer start their threads
+    with create_worker_pool(settings) as pool:
+        server_m = DatabaseManager(
+            settings['mongodb'], settings['xroad']['instance'], logger_m,
+            pointer_flush_interval=get_pointer_flush_interval(settings)
+        )
+        server_list, timestamp = server_m.get_server_list_from_database()
+        print(f'- Using server list updated at: {timestamp}')
+
+        health = None
+        circuit_breaker = CircuitBreaker(settings)
+        if circuit_breaker.enabled:
+            health = server_m.load_server_health([server['server'] for server in server_list])
+            now = server_m.get_timestamp()
+            available = [server for server in server_list if not circuit_breaker.is_open(health.get(server['server']), now)]
+            if len(available) < len(server_list):
+                logger_m.log_info(
+                    'collector_circuit_breaker',
+                    f'Skipping {len(server_list) - len(available)} servers with open circuit breaker'
+                )
+            server_list = available
 
-    inputs = prepare_thread_inputs(settings, server_list, server_m, logger_m)
-    done, error = process_thread_pool(settings, inputs)
+        server_keys = [server['server'] for server in server_list]
+        pointers = server_m.load_next_records_timestamps(server_keys, settings['collector']['records-from-offset'])
+        rates = server_m.get_records_rates(server_keys) if settings['collector'].get('adaptive-window') else None
+        inputs = prepare_thread_inputs(settings, server_list, server_m, logger_m, pointers, rates, health)
+        inputs = schedule_thread_inputs(settings, inputs, server_m.get_timestamp())
+        spool_drainer = start_spool_drainer(settings, server_m, logger_m)
+        done, error, stats = process_pool(settings, inputs, pool)
+
+        for _ in range(settings['collector'].get('requeue-passes') or 0):
+            pointers = server_m.load_next_records_timestamps(server_keys, settings['collector']['records-from-offset'])
+            inputs = get_requeue_inputs(settings, inputs, pointers, server_m.get_timestamp())
+            if not inputs:
+                break
+            if settings['collector'].get('adaptive-window'):
+                rates = server_m.get_records_rates([data['server_data']['server'] for data in inputs])
+                for data in inputs:
+                    data['records_rate'] = rates.get(data['server_data']['server'])
+            inputs = schedule_thread_inputs(settings, inputs, server_m.get_timestamp())
+            requeue_done, requeue_error, requeue_stats = process_pool(settings, inputs, pool)
+            merge_stats(stats, requeue_stats)
+            logger_m.log_info(
+                'collector_requeue',
+                f'Re-queued {len(inputs)} servers with remaining backlog, collected: {requeue_done}, error: {requeue_error}'
+            )
+        if spool_drainer is not None:
+            spool_drainer.stop()
+            logger_m.log_info('collector_spool', f'Inserted {spool_drainer.inserted} spooled records')
+
+    summary = dict(stats, done=done, error=error)
+    metrics_writer = MetricsWriter(settings)
+    if metrics_writer.enabled:
+        write_metrics(metrics_writer, summary, server_m, server_keys, settings, time.time() - start_time_time, logger_m)
+    server_m.close()
 
     total_time = time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time_time))
     logger_m.log_info('collector_end', f'Total collected: {done}, Total error: {error}, Total time: {total_time}')
     logger_m.log_heartbeat(f'Total collected: {done}, Total error: {error}, Total time: {total_time}', 'SUCCEEDED')
+    return summary
+
+
+def write_metrics(metrics_writer, summary, server_m, server_keys, settings, duration, logger_m):
+    try:
+        server_m.flush_next_records_timestamps()
+        pointers = server_m.load_next_records_timestamps(server_keys, settings['collector']['records-from-offset'])
+        metrics_writer.write(summary, pointers, server_m.get_timestamp(), duration)
+    except Exception as e:
+        # Metrics must not fail a collector run that has already stored its data
+        logger_m.log_warning('collector_metrics', f'Failed to write metrics file: {repr(e)}')
 
 
 def collector_main(settings):
+    """
+    Collect data from all servers.
+    :return: Returns number of servers collected successfully and failed ('done', 'error') and worker statistics
+        summed up over all servers.
+    """
     logger_m = LoggerManager(settings['logger'], settings['xroad']['instance'], __version__)
 
     try:
-        run_threaded_collector(logger_m, settings)
+        return run_threaded_collector(logger_m, settings)
     except Exception as e:
         logger_m.log_exception('collector', repr(e))
         logger_m.log_heartbeat('error', 'FAILED')
@@ -0,0 +1,62 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .collector_worker import run_collector_thread, summarize_results
+from .security_server_client import create_http_session
+
+DEFAULT_THREAD_CONCURRENCY = 50
+
+
+def process_thread_executor(settings, inputs):
+    """
+    Collect data from all servers concurrently in threads of one process.
+    At most thread-concurrency servers are collected at the same time, the rest wait in the queue of the executor.
+    Every thread has its own HTTP session, because requests sessions are not guaranteed to be thread-safe. A thread
+    reuses its session for all servers it collects, so TLS connections to the security server are kept alive.
+    :param settings: Collector settings.
+    :param inputs: Worker inputs prepared by prepare_thread_inputs.
+    :return: Returns number of servers collected successfully, number of failed servers and summed worker statistics.
+    """
+    concurrency = settings['collector'].get('thread-concurrency') or DEFAULT_THREAD_CONCURRENCY
+    local = threading.local()
+    sessions = []
+
+    def collect(data):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = create_http_session()
+            sessions.append(session)
+        return run_collector_thread(dict(data, http_session=session))
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='collector') as executor:
+            results = list(executor.map(collect, inputs))
+    finally:
+        for session in sessions:
+            session.close()
+
+    return summarize_results(results)
@@ -22,25 +22,42 @@
 # THE SOFTWARE.
 #
 
-import datetime
-import json
-import logging
+import functools
+import hashlib
 import multiprocessing
-import os
 import re
+import threading
+import time
 import uuid
 import xml.etree.ElementTree as ET
-import zlib
 from enum import Enum
-from logging.handlers import RotatingFileHandler
 from xml.etree.ElementTree import Element  # noqa: F401
 from xml.etree.ElementTree import ParseError
 
-import requests
-from opmon_collector.security_server_client import SecurityServerClient
+from bson import ObjectId
+
+from opmon_collector.circuit_breaker import CircuitBreaker
+from opmon_collector.documents_log_writer import DocumentsLogWriter
+from opmon_collector.metrics import REQUEST_DURATION_BUCKETS, RESPONSE_BYTES_BUCKETS, merge_histograms, new_histogram, observe
+from opmon_collector.opmon_response_parser import OpmonResponseParser
+from opmon_collector.records_spool import RecordsSpool
+from opmon_collector.security_server_client import SecurityServerClient, get_process_http_session
 
 # Constants
 MIN_REST_PATH_VERSION = '7.6.2'
+DEFAULT_RECORDS_CHUNK_SIZE = 10000
+DEFAULT_ADAPTIVE_TARGET_RECORDS = 5000
+DEFAULT_ADAPTIVE_MIN_WINDOW = 60
+# Weight of the latest observation in the smoothed records per second rate
+ADAPTIVE_RATE_WEIGHT = 0.5
+# Worker statistics summed up over all servers
+SUMMARY_STATS = ('requests', 'records', 'bytes', 'request_time', 'parse_time', 'sanitize_time', 'insert_time')
+HISTOGRAM_STATS = ('request_duration', 'response_bytes')
+# Fields identifying a record of a security server, hashed to the deterministic _id of the record
+RECORD_ID_FIELDS = (
+    'monitoringDataTs', 'securityServerInternalIp', 'securityServerType', 'requestInTs', 'responseOutTs', 'messageId',
+    'xRequestId'
+)
 
 
 class ServerProxyError(Exception):
@@ -63,24 +80,104 @@ class CollectorWorker:
         self.server_key = self.server_data['server']
         self.logger_m = data['logger_manager']
         self.server_m = data['server_manager']
+        self.records_from = data.get('records_from')
+        self.records_rate = data.get('records_rate')
+        self.health = data.get('health')
+        self.circuit_breaker = CircuitBreaker(self.settings)
+        self.adaptive_window = bool(self.settings['collector'].get('adaptive-window'))
+        self.repeat_limit = data.get('repeat_limit') or self.settings['collector']['repeat-limit']
+        self.time_budget = self.settings['collector'].get('server-time-budget') or 0
+        self.session = data.get('http_session') or get_process_http_session()
         self.thread_name = multiprocessing.current_process().name
+        if threading.current_thread() is not threading.main_thread():
+            self.thread_name = threading.current_thread().name
 
         self.batch_start, self.batch_end = self._get_record_limits()
+        self.request_end = self.batch_end
+        self.request_timeout = self.settings['xroad']['security-server']['timeout']
+        self.collect_start = None
+        self.budget_exhausted = False
         self.status = CollectorWorker.Status.DATA_AVAILABLE
         self.records = []
+        self.records_count = 0
+        self.documents_log_writer = None
+        self.spool = None
+        if self.settings['collector'].get('spool-directory'):
+            self.spool = RecordsSpool(self.settings['collector']['spool-directory'], self.settings['xroad']['instance'])
+        self.stats = {
+            'server': self.server_key,
+            'requests': 0,
+            'records': 0,
+            'bytes': 0,
+            'request_time': 0.0,
+            'parse_time': 0.0,
+            'sanitize_time': 0.0,
+            'insert_time': 0.0,
+            'request_duration': new_histogram(REQUEST_DURATION_BUCKETS),
+            'response_bytes': new_histogram(RESPONSE_BYTES_BUCKETS),
+            'min_batch_size': None,
+            'max_batch_size': None,
+        }
 
     def work(self):
-        for _ in range(self.settings['collector']['repeat-limit']):
+        result = self._collect()
+        try:
+            self.server_m.flush_next_records_timestamps()
+        except Exception as e:
+            self.log_exception('Failed to save records pointer.', repr(e))
+            result = False, e
+        self._update_server_health(*result)
+        return result
+
+    def _update_server_health(self, success, error):
+        if not self.circuit_breaker.enabled:
+            return
+        if success:
+            health = self.circuit_breaker.record_success(self.server_key, self.health)
+        else:
+            health = self.circuit_breaker.record_failure(self.server_key, self.health, error, self.server_m.get_timestamp())
+            if health['open_until'] is not None:
+                self.log_warn(f"Circuit breaker open until {health['open_until']:.0f}.", f"{health['failures']} failures")
+        if health is None:
+            return
+        try:
+            self.server_m.set_server_health(self.server_key, health)
+            self.health = health
+        except Exception as e:
+            # Health is advisory, collected data and pointers are already stored
+            self.log_exception('Failed to save server health.', repr(e))
+
+    def _collect(self):
+        self.collect_start = time.perf_counter()
+        for _ in range(self.repeat_limit):
+            self.request_timeout = self._get_request_timeout()
+            if self.request_timeout is None:
+                self.budget_exhausted = True
+                break
             try:
-                response = self._request_opmon_data()
-                records = self._parse_attachment(response)
-                sanitized_records = self._sanitize_records(records)
-                self.records = sanitized_records
-                if self.settings['collector'].get('documents-log-directory', ''):
-                    self._store_records_to_file()
-                self._store_records_to_database()
-                self.batch_start = self._parse_next_records_from_response(response) or self.batch_end
-                self.server_m.set_next_records_timestamp(self.server_key, self.batch_start)
+                request_start = time.perf_counter()
+                self.request_end = self._get_request_end()
+                with self._request_opmon_data() as parser:
+                    request_duration = time.perf_counter() - request_start
+                    self.stats['request_time'] += request_duration
+                    observe(self.stats['request_duration'], request_duration)
+                    self._store_records(self._parse_records(parser))
+                    self.stats['requests'] += 1
+                    self.stats['records'] += self.records_count
+                    self.stats['bytes'] += parser.bytes_read
+                    observe(self.stats['response_bytes'], parser.bytes_read)
+                    next_records_from = self._parse_next_records_from_response(parser.soap_part)
+                self._update_batch_size_stats()
+                next_batch_start = next_records_from or self.request_end
+                if self.adaptive_window:
+                    self._update_records_rate(next_batch_start - self.batch_start)
+                    self.batch_start = next_batch_start
+                    self.server_m.set_next_records_timestamp(
+                        self.server_key, self.batch_start, records_rate=self.records_rate
+                    )
+                else:
+                    self.batch_start = next_batch_start
+                    self.server_m.set_next_records_timestamp(self.server_key, self.batch_start)
             except ServerClientProxyError as e:
                 self.log_error('Collector caught exception.', repr(e))
                 return False, e
@@ -98,9 +195,63 @@ class CollectorWorker:
     def update_status(self):
         if self.batch_start >= self.batch_end:
             self.status = CollectorWorker.Status.ALL_COLLECTED
-        elif len(self.records) < self.settings['collector']['repeat-min-records']:
+        elif self.request_end < self.batch_end:
+            # Adaptive window did not request all available records yet
+            self.status = CollectorWorker.Status.DATA_AVAILABLE
+        elif self.records_count < self.settings['collector']['repeat-min-records']:
             self.status = CollectorWorker.Status.TOO_SMALL_BATCH
 
+    def _get_request_timeout(self):
+        """
+        Get timeout for the next request.
+        If connect-timeout of the security server is set, requests get a (connect, read) timeout, so that an
+        unreachable server fails within connect-timeout instead of holding a worker for the whole timeout.
+        If server-time-budget is set, timeouts are limited to the remaining budget and later requests are started only
+        if they can finish within the budget.
+        :return: Request timeout in seconds or as (connect, read) tuple, None if the time budget is exhausted.
+        """
+        sec_server_settings = self.settings['xroad']['security-server']
+        timeout = sec_server_settings['timeout']
+        connect_timeout = sec_server_settings.get('connect-timeout') or timeout
+        if self.time_budget:
+            remaining = self.time_budget - (time.perf_counter() - self.collect_start)
+            if remaining <= 0 or (self.stats['requests'] and remaining < timeout):
+                return None
+            timeout = min(timeout, remaining)
+            connect_timeout = min(connect_timeout, remaining)
+        return timeout if connect_timeout >= timeout else (connect_timeout, timeout)
+
+    def _get_request_end(self):
+        """
+        Get recordsTo for the next request.
+        In adaptive window mode the window is sized so that the response is expected to contain
+        adaptive-target-records records, based on the learned records per second rate of the server.
+        """
+        if not self.adaptive_window or not self.records_rate:
+            return self.batch_end
+        target_records = self.settings['collector'].get('adaptive-target-records') or DEFAULT_ADAPTIVE_TARGET_RECORDS
+        min_window = self.settings['collector'].get('adaptive-min-window') or DEFAULT_ADAPTIVE_MIN_WINDOW
+        window = max(int(target_records / self.records_rate), min_window)
+        return min(self.batch_start + window, self.batch_end)
+
+    def _update_records_rate(self, covered_seconds):
+        """
+        Update smoothed records per second rate with the records received for a window of covered_seconds.
+        """
+        if covered_seconds <= 0:
+            return
+        observed_rate = self.records_count / covered_seconds
+        if self.records_rate is None:
+            self.records_rate = observed_rate
+        else:
+            self.records_rate = ADAPTIVE_RATE_WEIGHT * observed_rate + (1 - ADAPTIVE_RATE_WEIGHT) * self.records_rate
+
+    def _update_batch_size_stats(self):
+        if self.stats['min_batch_size'] is None or self.records_count < self.stats['min_batch_size']:
+            self.stats['min_batch_size'] = self.records_count
+        if self.stats['max_batch_size'] is None or self.records_count > self.stats['max_batch_size']:
+            self.stats['max_batch_size'] = self.records_count
+
     def log_warn(self, message, cause):
         self.logger_m.log_warning(
             'collector_worker',
@@ -122,23 +273,39 @@ class CollectorWorker:
             f'[{self.thread_name}] Message: {message} Server: {self.server_key} Cause: {cause} \n')
 
     def _log_status(self):
+        self.log_info(
+            f"Requests: {self.stats['requests']}, records: {self.stats['records']}, "
+            f"round-trip time: {self.stats['request_time']:.3f}s, parse time: {self.stats['parse_time']:.3f}s, "
+            f"sanitize time: {self.stats['sanitize_time']:.3f}s, insert time: {self.stats['insert_time']:.3f}s."
+        )
+        if self.stats['requests']:
+            self.log_info(
+                f"Batch size min: {self.stats['min_batch_size']}, "
+                f"avg: {self.stats['records'] / self.stats['requests']:.0f}, max: {self.stats['max_batch_size']}."
+                + (f' Records rate: {self.records_rate:.3f}/s.' if self.records_rate is not None else '')
+            )
         if self.status == CollectorWorker.Status.ALL_COLLECTED:
             self.log_info(f'Records collected until {self.batch_end}.')
         elif self.status == CollectorWorker.Status.TOO_SMALL_BATCH:
             self.log_info('Not enough data received to repeat query.')
+        elif self.budget_exhausted:
+            self.log_warn('Time budget exhausted.', '')
         else:
             self.log_warn('Maximum repeats reached.', '')
 
     def _get_record_limits(self):
         records_from_offset = self.settings['collector']['records-from-offset']
         records_to_offset = self.settings['collector']['records-to-offset']
-        records_from = int(self.server_m.get_next_records_timestamp(self.server_key, records_from_offset))
+        records_from = self.records_from
+        if records_from is None:
+            records_from = self.server_m.get_next_records_timestamp(self.server_key, records_from_offset)
+        records_from = int(records_from)
         records_to = int(self.server_m.get_timestamp() - records_to_offset)
 
         return records_from, records_to
 
     def _request_opmon_data(self):
-        self.log_info(f'Collecting from {self.batch_start} to {self.batch_end}')
+        self.log_info(f'Collecting from {self.batch_start} to {self.request_end}')
 
         req_id = str(uuid.uuid4())
         headers = {'Content-type': 'text/xml;charset=UTF-8'}
@@ -148,24 +315,28 @@ class CollectorWorker:
             self.server_data,
             req_id,
             self.batch_start,
-            self.batch_end)
+            self.request_end)
 
         try:
             sec_server_settings = self.settings['xroad']['security-server']
             url = sec_server_settings['protocol'] + sec_server_settings['host']
-            timeout = sec_server_settings['timeout']
             client_cert = (
                 sec_server_settings.get('tls-client-certificate'),
                 sec_server_settings.get('tls-client-key')
             )
             server_cert = sec_server_settings.get('tls-server-certificate')
-            response = requests.post(
-                url, data=body, headers=headers, timeout=timeout,
-                cert=client_cert, verify=server_cert
+            response = self.session.post(
+                url, data=body, headers=headers, timeout=self.request_timeout,
+                cert=client_cert, verify=server_cert, stream=True
             )
-            response.raise_for_status()
-            self._process_soap_errors(response.content)
-            return response
+            parser = OpmonResponseParser(response)
+            try:
+                response.raise_for_status()
+                self._process_soap_errors(parser.read_soap_part())
+            except Exception:
+                parser.close()
+                raise
+            return parser
         except Exception as e:
             self.log_exception('Request for operational monitoring data failed.', str(e))
             raise e
@@ -187,20 +358,55 @@ class CollectorWorker:
         except ParseError:
             pass
 
-    def _parse_attachment(self, opmon_response):
+    def _parse_records(self, parser):
+        """
+        Yield records from the response attachment. Time spent reading and decoding records is added to parse_time.
+        """
         try:
-            resp_search = re.search(b'content-id: <operational-monitoring-data.json.gz>\r\n\r\n(.+)\r\n--xroad',
-                                    opmon_response.content, re.DOTALL)
-            if resp_search is None:
-                self.log_warn('No attachment present.', '')
-                raise FileNotFoundError('Attachment not found in operational monitoring data response.')
-
-            data_json = json.loads(zlib.decompress(resp_search.group(1), zlib.MAX_WBITS | 16).decode('utf-8'))
-            return data_json['records']
+            records = parser.records()
+            while True:
+                parse_start = time.perf_counter()
+                record = next(records, None)
+                self.stats['parse_time'] += time.perf_counter() - parse_start
+                if record is None:
+                    return
+                yield record
+        except FileNotFoundError as e:
+            self.log_warn('No attachment present.', '')
+            self.log_exception('Cannot parse response attachment.', str(e))
+            raise e
         except Exception as e:
             self.log_exception('Cannot parse response attachment.', str(e))
             raise e
 
+    def _store_records(self, records):
+        """
+        Sanitize and store records in chunks of records-chunk-size, so that only one chunk is kept in memory.
+        """
+        chunk_size = self.settings['collector'].get('records-chunk-size') or DEFAULT_RECORDS_CHUNK_SIZE
+        self.records_count = 0
+        self.records = []
+        for record in records:
+            self.records.append(record)
+            if len(self.records) >= chunk_size:
+                self._store_records_chunk()
+        if self.records or not self.records_count:
+            self._store_records_chunk()
+
+    def _store_records_chunk(self):
+        sanitize_start = time.perf_counter()
+        self.records = self._sanitize_records(self.records)
+        insert_start = time.perf_counter()
+        self.stats['sanitize_time'] += insert_start - sanitize_start
+        if self.settings['collector'].get('documents-log-directory', ''):
+            self._store_records_to_file()
+        for record in self.records:
+            record['_id'] = record_id(self.server_key, record)
+        self._store_records_to_database()
+        self.stats['insert_time'] += time.perf_counter() - insert_start
+        self.records_count += len(self.records)
+        self.records = []
+
     """
     Check if the version is greater than or equal to the base version.
     :param version: Version to check
@@ -219,54 +425,37 @@ class CollectorWorker:
     def _sanitize_records(records):
         """
         Remove 'restPath' field from records if the xRoadVersion is not present or is less than 7.6.2.
+        Records are owned by the worker, so they are modified in place in a single pass.
         """
-        sanitized_records = []
         for record in records:
-            sanitized_record = record.copy()
-            if 'xRoadVersion' not in record or not CollectorWorker._version_gte(record['xRoadVersion'], MIN_REST_PATH_VERSION):
-                sanitized_record.pop('restPath', None)
-            sanitized_records.append(sanitized_record)
-        return sanitized_records
-
-    def _get_records_logger(self) -> logging.Logger:
-        host_name = re.sub('[^0-9a-zA-Z.-]+', '.', self.server_data['server'])
-        records_logger = logging.getLogger(host_name)
-
-        now = datetime.datetime.now()
-        log_path = f"{self.settings['collector']['documents-log-directory']}" \
-            f"/{self.settings['xroad']['instance']}/{now.year:04d}/{now.month:02d}/{now.day:02d}/"
-
-        base_filename = log_path + host_name + '.log'
-        rotating_host_handlers = [
-            handler for handler in records_logger.handlers
-            if isinstance(handler, RotatingFileHandler)
-            and handler.baseFilename == base_filename
-        ]
-        if not rotating_host_handlers:
-            if not os.path.exists(log_path):
-                os.makedirs(log_path)
-
-            handler = RotatingFileHandler(
-                base_filename,
-                maxBytes=self.settings['collector'].get('documents-log-file-size') or 0,
-                backupCount=self.settings['collector'].get('documents-log-max-files') or 0
-            )
-
-            records_logger.setLevel(logging.INFO)
-            records_logger.addHandler(handler)
-        return records_logger
+            if 'restPath' in record:
+                version = record.get('xRoadVersion')
+                if not isinstance(version, str) or not _rest_path_supported(version):
+                    del record['restPath']
+        return records
 
     def _store_records_to_file(self) -> None:
         if len(self.records):
             self.log_info(f'Appending {len(self.records)} documents to log file.')
-            records_logger = self._get_records_logger()
-            for record in self.records:
-                records_logger.info(json.dumps(record, separators=(',', ':')))
+            if self.documents_log_writer is None:
+                self.documents_log_writer = DocumentsLogWriter(self.settings, self.server_key)
+            try:
+                self.documents_log_writer.write(self.records)
+            except Exception as e:
+                self.log_exception('Failed to append documents to log file.', str(e))
+                raise e
         else:
             self.log_warn('No documents to append to log file!', '')
 
     def _store_records_to_database(self) -> None:
-        if len(self.records):
+        if len(self.records) and self.spool is not None:
+            self.log_info(f'Spooling {len(self.records)} documents.')
+            try:
+                self.spool.append(self.server_key, self.records)
+            except Exception as e:
+                self.log_exception('Failed to spool records.', str(e))
+                raise e
+        elif len(self.records):
             self.log_info(f'Adding {len(self.records)} documents.')
             try:
                 self.server_m.insert_data_to_raw_messages(self.records)
@@ -277,11 +466,69 @@ class CollectorWorker:
             self.log_warn('No documents to store!', '')
 
     @staticmethod
-    def _parse_next_records_from_response(response):
-        result = re.search(b'<om:nextRecordsFrom>(\\d+)</om:nextRecordsFrom>', response.content)
+    def _parse_next_records_from_response(soap_part):
+        result = re.search(b'<om:nextRecordsFrom>(\\d+)</om:nextRecordsFrom>', soap_part)
         return None if result is None else int(result.group(1))
 
 
+def record_id(server_key, record):
+    """
+    Deterministic MongoDB _id of a collected record.
+    Chunks of a response are stored while the response is still being read. If the response fails after some
+    chunks were stored, the records pointer is not moved and the same records are collected again; with the same
+    _id they are skipped instead of being inserted twice.
+    :param server_key: Server string.
+    :param record: Record, without _id and insertTime.
+    :return: Returns ObjectId made of monitoringDataTs and a hash of the server and RECORD_ID_FIELDS of the record.
+    """
+    key = '\x1f'.join([server_key] + [str(record.get(field)) for field in RECORD_ID_FIELDS])
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    timestamp = record.get('monitoringDataTs')
+    seconds = int(timestamp) if isinstance(timestamp, (int, float)) else 0
+    return ObjectId((seconds & 0xFFFFFFFF).to_bytes(4, 'big') + digest)
+
+
+@functools.lru_cache(maxsize=256)
+def _rest_path_supported(version):
+    # Records of one server carry only a few distinct versions, so the comparison is cached
+    return CollectorWorker._version_gte(version, MIN_REST_PATH_VERSION)
+
+
 def run_collector_thread(data):
     worker = CollectorWorker(data)
-    return worker.work()
+    return (*worker.work(), worker.stats)
+
+
+def summarize_results(results):
+    """
+    Count successful and failed servers and sum up worker statistics.
+    :param results: Results of run_collector_thread calls.
+    :return: Returns number of servers collected successfully, number of failed servers and summed statistics.
+        Statistics of every server are listed in 'servers'.
+    """
+    done = len([result[0] for result in results if result[0]])
+    error = len(results) - done
+    stats = dict.fromkeys(SUMMARY_STATS, 0)
+    stats['request_duration'] = new_histogram(REQUEST_DURATION_BUCKETS)
+    stats['response_bytes'] = new_histogram(RESPONSE_BYTES_BUCKETS)
+    stats['servers'] = []
+    for result in results:
+        if len(result) < 3:
+            continue
+        worker_stats = result[2]
+        merge_stats(stats, dict(
+            {key: worker_stats[key] for key in SUMMARY_STATS + HISTOGRAM_STATS},
+            servers=[dict({key: worker_stats[key] for key in SUMMARY_STATS}, server=worker_stats['server'], success=bool(result[0]))]
+        ))
+    return done, error, stats
+
+
+def merge_stats(stats, other):
+    """
+    Add statistics summarized by summarize_results to stats.
+    """
+    for key in SUMMARY_STATS:
+        stats[key] += other[key]
+    for key in HISTOGRAM_STATS:
+        merge_histograms(stats[key], other[key])
+    stats['servers'].extend(other['servers'])
@@ -25,15 +25,20 @@
 Database Manager - Collector Module
 """
 
+import os
+import threading
 import time
 import urllib.parse
 import pymongo
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
 
 
 class DatabaseManager:
 
-    def __init__(self, mongo_settings, xroad_instance, logger_manager):
+    def __init__(self, mongo_settings, xroad_instance, logger_manager, pointer_flush_interval=0):
         self.mongo_uri = self.get_mongo_uri(mongo_settings)
         self.db_name = f'query_db_{xroad_instance}'
         self.db_collector_state = f'collector_state_{xroad_instance}'
@@ -43,6 +48,54 @@ class DatabaseManager:
             'tls': bool(mongo_settings.get('tls')),
             'tlsCAFile': mongo_settings.get('tls-ca-file'),
         }
+        if mongo_settings.get('max-pool-size'):
+            self.connect_args['maxPoolSize'] = mongo_settings['max-pool-size']
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+        self.pointer_flush_interval = pointer_flush_interval
+        self._pending_pointers = {}
+        self._pointers_lock = threading.Lock()
+        self._pointers_flushed_at = time.monotonic()
+
+    def __getstate__(self):
+        # MongoClient is not fork-safe and can not be pickled. Worker processes create their own client.
+        state = self.__dict__.copy()
+        state['_client'] = None
+        state['_client_pid'] = None
+        state['_client_lock'] = None
+        state['_pending_pointers'] = {}
+        state['_pointers_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._client_lock = threading.Lock()
+        self._pointers_lock = threading.Lock()
+
+    def get_client(self):
+        """
+        Get MongoClient of the current process. Client is created on first use and shared by all threads.
+        A new client is created if the manager is used in a forked child process.
+        """
+        pid = os.getpid()
+        if self._client is not None and self._client_pid != pid:
+            # Forked child process must not use the client or the lock of its parent
+            self._client = None
+            self._client_lock = threading.Lock()
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = pymongo.MongoClient(self.mongo_uri, **self.connect_args)
+                    self._client_pid = pid
+        return self._client
+
+    def close(self):
+        self.flush_next_records_timestamps()
+        if self._client is not None and self._client_pid == os.getpid():
+            self._client.close()
+        self._client = None
+        self._client_pid = None
 
     @staticmethod
     def get_mongo_uri(mongo_settings):
@@ -55,38 +108,101 @@ class DatabaseManager:
     def get_timestamp():
         return float(time.time())
 
-    def save_server_list_to_database(self, server_list):
+    def save_server_list_to_database(self, server_list, shared_params_location=None):
+        """ Stores server list as the current server list of the collector.
+        Only one current server list document is kept. Changes compared to the previous list are stored
+        in the server_list_history collection, so the history does not contain a full copy of every update.
+        :param server_list: List of server dicts from CentralServerClient.
+        :param shared_params_location: Content-location of the shared parameters the list was parsed from.
+        """
         try:
-            client = pymongo.MongoClient(self.mongo_uri, **self.connect_args)
+            client = self.get_client()
             db = client[self.db_collector_state]
             collection = db['server_list']
+            timestamp = self.get_timestamp()
+            current = self._get_current_server_list_document(collection)
+            diff = self._diff_server_lists(current['server_list'] if current else [], server_list)
+
             data = dict()
-            data['timestamp'] = self.get_timestamp()
+            data['timestamp'] = timestamp
             data['server_list'] = server_list
             data['collector_id'] = self.collector_id
-            collection.insert_one(data)
+            data['current'] = True
+            data['shared_params_location'] = shared_params_location
+            collection.replace_one({'collector_id': self.collector_id, 'current': True}, data, upsert=True)
+
+            if any(diff.values()):
+                db['server_list_history'].insert_one(dict(diff, collector_id=self.collector_id, timestamp=timestamp))
         except Exception as e:
             self.logger_m.log_exception('ServerManager.get_server_list_database', repr(e))
             raise e
 
+    def touch_server_list(self):
+        """ Updates timestamp of the current server list when the shared parameters have not changed.
+        """
+        try:
+            client = self.get_client()
+            client[self.db_collector_state]['server_list'].update_one(
+                {'collector_id': self.collector_id, 'current': True},
+                {'$set': {'timestamp': self.get_timestamp()}}
+            )
+        except Exception as e:
+            self.logger_m.log_exception('ServerManager.touch_server_list', repr(e))
+            raise e
+
+    def get_shared_params_location(self):
+        """ Returns content-location of the shared parameters the current server list was parsed from.
+        """
+        try:
+            client = self.get_client()
+            current = client[self.db_collector_state]['server_list'].find_one(
+                {'collector_id': self.collector_id, 'current': True}, {'shared_params_location': True}
+            )
+            return current.get('shared_params_location') if current else None
+        except Exception as e:
+            self.logger_m.log_exception('ServerManager.get_shared_params_location', repr(e))
+            raise e
+
     def get_server_list_from_database(self):
         """
         Get the most recent server list from MongoDB
         """
         try:
-            client = pymongo.MongoClient(self.mongo_uri, **self.connect_args)
+            client = self.get_client()
             db = client[self.db_collector_state]
-            data = db['server_list'].find({'collector_id': self.collector_id}).sort([('timestamp', -1)]).limit(1)[0]
+            data = self._get_current_server_list_document(db['server_list'])
+            if data is None:
+                raise IndexError(f'No server list found for {self.collector_id}.')
             return data['server_list'], data['timestamp']
         except Exception as e:
             self.logger_m.log_exception('ServerManager.get_server_list_database', repr(e))
             raise e
 
+    def _get_current_server_list_document(self, collection):
+        data = collection.find_one({'collector_id': self.collector_id, 'current': True})
+        if data is None:
+            # Server lists stored before the current document was introduced
+            data = next(iter(collection.find({'collector_id': self.collector_id}).sort([('timestamp', -1)]).limit(1)), None)
+        return data
+
+    @staticmethod
+    def _diff_server_lists(previous, server_list):
+        previous_servers = {server['server']: server for server in previous}
+        servers = {server['server']: server for server in server_list}
+        return {
+            'added': [server for key, server in servers.items() if key not in previous_servers],
+            'removed': [key for key in previous_servers if key not in servers],
+            'changed': [
+                server for key, server in servers.items()
+                if key in previous_servers and previous_servers[key] != server
+            ],
+        }
+
     def get_next_records_timestamp(self, server_key, records_from_offset):
         """ Returns next records_from pointer for the given server
         """
         try:
-            client = pymongo.MongoClient(self.mongo_uri, **self.connect_args)
+            client = self.get_client()
             db = client[self.db_collector_state]
             collection = db['collector_pointer']
             cur = collection.find_one({'server': server_key})
@@ -105,16 +221,68 @@ class DatabaseManager:
             raise e
         return records_from
 
-    def set_next_records_timestamp(self, server_key, records_from):
+    def load_next_records_timestamps(self, server_keys, records_from_offset):
+        """ Returns next records_from pointers of all given servers, reading them with a single query.
+        Pointers of new servers are initialized to (now - records_from_offset) and stored.
+        """
+        try:
+            client = self.get_client()
+            collection = client[self.db_collector_state]['collector_pointer']
+            cursor = collection.find({'server': {'$in': list(server_keys)}}, {'_id': False, 'server': True, 'records_from': True})
+            pointers = {doc['server']: doc['records_from'] for doc in cursor}
+
+            records_from = self.get_timestamp() - records_from_offset
+            new_pointers = [
+                {'server': server_key, 'records_from': records_from}
+                for server_key in dict.fromkeys(server_keys) if server_key not in pointers
+            ]
+            if new_pointers:
+                collection.insert_many(new_pointers)
+                pointers.update({doc['server']: doc['records_from'] for doc in new_pointers})
+        except Exception as e:
+            self.logger_m.log_exception('ServerManager.load_next_records_timestamps', repr(e))
+            raise e
+        return pointers
+
+    def get_records_rates(self, server_keys):
+        """ Returns learned records per second rates of the given servers. Servers without a rate are omitted.
+        """
+        try:
+            client = self.get_client()
+            collection = client[self.db_collector_state]['collector_pointer']
+            cursor = collection.find(
+                {'server': {'$in': list(server_keys)}, 'records_rate': {'$ne': None}},
+                {'_id': False, 'server': True, 'records_rate': True}
+            )
+            return {doc['server']: doc['records_rate'] for doc in cursor}
+        except Exception as e:
+            self.logger_m.log_exception('ServerManager.get_records_rates', repr(e))
+            raise e
+
+    def set_next_records_timestamp(self, server_key, records_from, records_rate=None):
+        """ Stores next records_from pointer for the given server.
+        Optional records_rate (records per second) is stored with the pointer.
+        If pointer_flush_interval is set, pointers are buffered and written with one bulk write
+        when the interval has passed since the previous write.
+        Caller must store the data before the pointer is set, so that a written pointer is never ahead of the data.
+        """
+        fields = {'server': server_key, 'records_from': records_from}
+        if records_rate is not None:
+            fields['records_rate'] = records_rate
+
+        if self.pointer_flush_interval:
+            with self._pointers_lock:
+                self._pending_pointers[server_key] = fields
+            if time.monotonic() - self._pointers_flushed_at >= self.pointer_flush_interval:
+                self.flush_next_records_timestamps()
+            return
+
         try:
-            client = pymongo.MongoClient(self.mongo_uri, **self.connect_args)
+            client = self.get_client()
             db = client[self.db_collector_state]
             collection = db['collector_pointer']
 
-            update_operations = {'$set': {
-                'server': server_key,
-                'records_from': records_from
-            }}
+            update_operations = {'$set': fields}
 
             if collection.find_one_and_update(
                     {'server': server_key},
@@ -128,17 +296,85 @@ class DatabaseManager:
             self.logger_m.log_exception('ServerManager.set_next_records_timestamp', repr(e))
             raise e
 
+    def flush_next_records_timestamps(self):
+        """ Writes buffered records_from pointers to database with one ordered bulk write.
+        """
+        with self._pointers_lock:
+            pending = self._pending_pointers
+            self._pending_pointers = {}
+            self._pointers_flushed_at = time.monotonic()
+        if not pending:
+            return
+
+        try:
+            client = self.get_client()
+            collection = client[self.db_collector_state]['collector_pointer']
+            collection.bulk_write([
+                UpdateOne({'server': server_key}, {'$set': fields}, upsert=True)
+                for server_key, fields in pending.items()
+            ], ordered=True)
+        except Exception as e:
+            with self._pointers_lock:
+                # Keep failed pointers for the next flush unless newer pointers were set meanwhile
+                self._pending_pointers = dict(pending, **self._pending_pointers)
+            self.logger_m.log_exception('ServerManager.flush_next_records_timestamps', repr(e))
+            raise e
+
+    def load_server_health(self, server_keys):
+        """ Returns circuit breaker health documents of the given servers, reading them with a single query.
+        Servers without recorded failures are omitted.
+        """
+        try:
+            client = self.get_client()
+            collection = client[self.db_collector_state]['server_health']
+            cursor = collection.find({'server': {'$in': list(server_keys)}}, {'_id': False})
+            return {doc['server']: doc for doc in cursor}
+        except Exception as e:
+            self.logger_m.log_exception('ServerManager.load_server_health', repr(e))
+            raise e
+
+    def set_server_health(self, server_key, health):
+        """ Stores circuit breaker health document of the given server.
+        """
+        try:
+            client = self.get_client()
+            collection = client[self.db_collector_state]['server_health']
+            collection.update_one({'server': server_key}, {'$set': health}, upsert=True)
+        except Exception as e:
+            self.logger_m.log_exception('ServerManager.set_server_health', repr(e))
+            raise e
+
     def insert_data_to_raw_messages(self, data_list):
+        """ Inserts collected records with one unordered insert_many.
+        Records have a deterministic _id, so records inserted before a response failed are skipped when the
+        response is collected again.
+        """
         try:
-            client = pymongo.MongoClient(self.mongo_uri, **self.connect_args)
-            db = client[self.db_name]
-            raw_msg = db['raw_messages']
-            # Add timestamp to data list
-            for data in data_list:
-                timestamp = self.get_timestamp()
-                data['insertTime'] = timestamp
-            # Save all
-            raw_msg.insert_many(data_list)
+            self._insert_raw_messages(data_list)
         except Exception as e:
             self.logger_m.log_exception('ServerManager.insert_data_to_raw_messages', repr(e))
             raise e
+
+    def insert_spooled_raw_messages(self, data_list):
+        """ Inserts spooled records with one unordered insert_many.
+        Spooled records already have an _id, so records inserted by a previous partially failed insert are skipped.
+        """
+        try:
+            self._insert_raw_messages(data_list)
+        except Exception as e:
+            self.logger_m.log_exception('ServerManager.insert_spooled_raw_messages', repr(e))
+            raise e
+
+    def _insert_raw_messages(self, data_list):
+        client = self.get_client()
+        raw_msg = client[self.db_name]['raw_messages']
+        # All records of the batch share one insertTime
+        timestamp = self.get_timestamp()
+        for data in data_list:
+            data['insertTime'] = timestamp
+        try:
+            raw_msg.insert_many(data_list, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details.get('writeErrors', [])) \
+                    or e.details.get('writeConcernErrors'):
+                raise e
@@ -0,0 +1,117 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import datetime
+import gzip
+import json
+import os
+import re
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_EXTENSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+FSYNC_POLICIES = ('none', 'batch')
+
+
+class DocumentsLogWriter:
+    """
+    Appends collected records of one server to a per day log file as JSON lines.
+    Every batch is serialized and written with a single write call. With gzip or zstd compression every batch is
+    written as a separate compressed member, so the file is a valid compressed stream after every batch.
+    Log files are rotated with the documents-log-file-size and documents-log-max-files settings,
+    like the RotatingFileHandler used before.
+    """
+
+    def __init__(self, settings, server_key):
+        collector_settings = settings['collector']
+        self.log_directory = collector_settings['documents-log-directory']
+        self.instance = settings['xroad']['instance']
+        self.host_name = re.sub('[^0-9a-zA-Z.-]+', '.', server_key)
+        self.max_bytes = collector_settings.get('documents-log-file-size') or 0
+        self.backup_count = collector_settings.get('documents-log-max-files') or 0
+
+        self.compression = collector_settings.get('documents-log-compression') or 'none'
+        if self.compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f'Unsupported documents-log-compression: {self.compression}')
+        if self.compression == 'zstd' and zstandard is None:
+            raise ValueError('documents-log-compression zstd requires the zstandard package')
+
+        self.fsync = collector_settings.get('documents-log-fsync') or 'none'
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Unsupported documents-log-fsync: {self.fsync}')
+
+    def get_file_name(self, now=None):
+        now = now or datetime.datetime.now()
+        log_path = os.path.join(
+            self.log_directory, self.instance, f'{now.year:04d}', f'{now.month:02d}', f'{now.day:02d}'
+        )
+        return os.path.join(log_path, self.host_name + '.log' + COMPRESSION_EXTENSIONS[self.compression])
+
+    def write(self, records):
+        """
+        Append records to the log file of the current day.
+        :param records: List of records.
+        :return: Returns number of bytes written.
+        """
+        if not records:
+            return 0
+        payload = self._encode(records)
+        file_name = self.get_file_name()
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self._rotate_if_needed(file_name, len(payload))
+
+        with open(file_name, 'ab') as f:
+            f.write(payload)
+            if self.fsync == 'batch':
+                f.flush()
+                os.fsync(f.fileno())
+        return len(payload)
+
+    def _encode(self, records):
+        lines = '\n'.join(json.dumps(record, separators=(',', ':')) for record in records) + '\n'
+        data = lines.encode('utf-8')
+        if self.compression == 'gzip':
+            return gzip.compress(data, compresslevel=6)
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    def _rotate_if_needed(self, file_name, payload_size):
+        # Same rules as RotatingFileHandler: rotation is disabled if either limit is 0
+        if not self.max_bytes or not self.backup_count or not os.path.exists(file_name):
+            return
+        if os.path.getsize(file_name) + payload_size <= self.max_bytes:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f'{file_name}.{i}'
+            if os.path.exists(source):
+                os.replace(source, f'{file_name}.{i + 1}')
+        os.replace(file_name, f'{file_name}.1')
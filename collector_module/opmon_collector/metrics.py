@@ -0,0 +1,164 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+"""
+Collector metrics in Prometheus text exposition format.
+Metrics of the latest collector run are written to metrics-file, which can be read with the textfile collector
+of Prometheus node exporter.
+"""
+
+import os
+import tempfile
+
+METRIC_PREFIX = 'xroad_metrics_collector'
+REQUEST_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RESPONSE_BYTES_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8)
+
+# Statistics of a single server, exported as gauges of the latest run
+SERVER_METRICS = (
+    ('records', 'server_records', 'Records collected from the server in the latest run.'),
+    ('requests', 'server_requests', 'Requests sent for the server in the latest run.'),
+    ('bytes', 'server_response_bytes', 'Response bytes received for the server in the latest run.'),
+    ('request_time', 'server_request_seconds', 'Time spent waiting for responses of the server in the latest run.'),
+    ('parse_time', 'server_parse_seconds', 'Time spent parsing responses of the server in the latest run.'),
+    ('insert_time', 'server_insert_seconds', 'Time spent storing records of the server in the latest run.'),
+)
+HISTOGRAMS = (
+    ('request_duration', 'request_duration_seconds', 'Duration of operational data requests.'),
+    ('response_bytes', 'response_bytes', 'Size of operational data responses.'),
+)
+
+
+def new_histogram(buckets):
+    return {'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+
+
+def observe(histogram, value):
+    for i, bound in enumerate(histogram['buckets']):
+        if value <= bound:
+            histogram['counts'][i] += 1
+            break
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+
+def merge_histograms(histogram, other):
+    """
+    Add observations of other histogram with the same buckets to histogram.
+    """
+    histogram['counts'] = [a + b for a, b in zip(histogram['counts'], other['counts'])]
+    histogram['sum'] += other['sum']
+    histogram['count'] += other['count']
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class MetricsWriter:
+    def __init__(self, settings):
+        self.metrics_file = settings['collector'].get('metrics-file')
+        self.instance = settings['xroad']['instance']
+
+    @property
+    def enabled(self):
+        return bool(self.metrics_file)
+
+    def render(self, summary, pointers, timestamp, duration):
+        """
+        :param summary: Collector run summary returned by run_threaded_collector.
+        :param pointers: Records pointers of the servers after the run.
+        :param timestamp: Timestamp of the end of the run.
+        :param duration: Duration of the run in seconds.
+        :return: Returns metrics in Prometheus text exposition format.
+        """
+        instance = {'instance': self.instance}
+        lines = []
+
+        def gauge(name, help_text, samples):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+            for labels, value in samples:
+                lines.append(f'{METRIC_PREFIX}_{name}{_labels(**labels)} {value}')
+
+        gauge('last_run_timestamp_seconds', 'Timestamp of the end of the latest run.', [(instance, timestamp)])
+        gauge('run_duration_seconds', 'Duration of the latest run.', [(instance, duration)])
+        gauge('servers', 'Servers collected and failed in the latest run.', [
+            (dict(instance, status='collected'), summary['done']),
+            (dict(instance, status='failed'), summary['error']),
+        ])
+
+        servers = self._merge_servers(summary.get('servers', []))
+        gauge('server_up', 'Whether the latest collection of the server succeeded.', [
+            (dict(instance, server=key), int(stats['success'])) for key, stats in servers.items()
+        ])
+        for stats_key, name, help_text in SERVER_METRICS:
+            gauge(name, help_text, [(dict(instance, server=key), stats[stats_key]) for key, stats in servers.items()])
+        gauge('pointer_lag_seconds', 'Seconds the records pointer of the server lags behind the end of the run.', [
+            (dict(instance, server=key), max(timestamp - records_from, 0)) for key, records_from in sorted(pointers.items())
+        ])
+
+        for stats_key, name, help_text in HISTOGRAMS:
+            histogram = summary.get(stats_key)
+            if histogram is None:
+                continue
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                lines.append(f'{METRIC_PREFIX}_{name}_bucket{_labels(le=bound, **instance)} {cumulative}')
+            lines.append(f'{METRIC_PREFIX}_{name}_bucket{_labels(le="+Inf", **instance)} {histogram["count"]}')
+            lines.append(f'{METRIC_PREFIX}_{name}_sum{_labels(**instance)} {histogram["sum"]}')
+            lines.append(f'{METRIC_PREFIX}_{name}_count{_labels(**instance)} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, summary, pointers, timestamp, duration):
+        """
+        Write metrics to metrics-file. File is replaced atomically, so a reader never sees a partial file.
+        """
+        directory = os.path.dirname(os.path.abspath(self.metrics_file))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.metrics-', delete=False) as f:
+            f.write(self.render(summary, pointers, timestamp, duration))
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, self.metrics_file)
+
+    @staticmethod
+    def _merge_servers(servers):
+        # Re-queued servers are collected more than once in a run
+        merged = {}
+        for stats in servers:
+            if stats['server'] not in merged:
+                merged[stats['server']] = dict(stats)
+                continue
+            current = merged[stats['server']]
+            for stats_key, _, _ in SERVER_METRICS:
+                current[stats_key] += stats[stats_key]
+            current['success'] = stats['success']
+        return dict(sorted(merged.items()))
@@ -0,0 +1,239 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Streaming parser for getSecurityServerOperationalData responses.
+
+The response is a multipart message with the SOAP envelope in the first part and
+the gzipped operational monitoring JSON document in the
+operational-monitoring-data.json.gz attachment. The attachment is inflated and
+decoded incrementally, so records are yielded one at a time without holding
+the whole response in memory.
+"""
+
+import codecs
+import json
+import re
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+ATTACHMENT_CONTENT_ID = '<operational-monitoring-data.json.gz>'
+
+_BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+_RECORDS_ARRAY_PATTERN = re.compile(r'"records"\s*:\s*\[')
+_SEPARATORS_PATTERN = re.compile(r'[\s,]*')
+
+
+class RecordsArrayDecoder:
+    """
+    Incremental decoder for the {"records": [...]} JSON document.
+    Text is fed in arbitrary pieces and every complete record is returned as soon as it is available.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text = ''
+        self._in_array = False
+        self.done = False
+
+    def feed(self, text):
+        """
+        Add text to the decoder.
+        :param text: Next piece of the JSON document.
+        :return: Returns list of records completed by the text.
+        """
+        self._text += text
+        records = []
+        if not self._in_array:
+            match = _RECORDS_ARRAY_PATTERN.search(self._text)
+            if match is None:
+                return records
+            self._text = self._text[match.end():]
+            self._in_array = True
+
+        text = self._text
+        raw_decode = self._decoder.raw_decode
+        skip_separators = _SEPARATORS_PATTERN.match
+        pos = 0
+        length = len(text)
+        while not self.done:
+            pos = skip_separators(text, pos).end()
+            if pos >= length:
+                break
+            if text[pos] == ']':
+                self.done = True
+                pos += 1
+                break
+            try:
+                record, pos = raw_decode(text, pos)
+            except json.JSONDecodeError:
+                # Record is not complete yet, wait for more text
+                break
+            records.append(record)
+
+        self._text = self._text[pos:]
+        return records
+
+    def close(self):
+        if not self.done:
+            raise ValueError('Operational monitoring data ended before all records were read.')
+
+
+class OpmonResponseParser:
+    """
+    Reads a getSecurityServerOperationalData response incrementally.
+
+    Usage:
+        with OpmonResponseParser(response) as parser:
+            soap_part = parser.read_soap_part()
+            for record in parser.records():
+                ...
+    """
+
+    def __init__(self, response, chunk_size=CHUNK_SIZE):
+        self.response = response
+        self.bytes_read = 0
+        self.soap_part = None
+        self._chunks = response.iter_content(chunk_size)
+        self._buffer = b''
+        self._attachment_found = False
+
+        match = _BOUNDARY_PATTERN.search(response.headers.get('Content-Type', ''))
+        self._boundary = match.group(1).encode('ascii') if match else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.response.close()
+
+    def _read_more(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self.bytes_read += len(chunk)
+        self._buffer += chunk
+        return True
+
+    def _find(self, marker, start=0):
+        """
+        Find marker from the buffer, reading more data from the response until it is found.
+        :return: Returns index of the marker or -1 if the response ended before marker was found.
+        """
+        while True:
+            index = self._buffer.find(marker, start)
+            if index >= 0:
+                return index
+            start = max(start, len(self._buffer) - len(marker) + 1)
+            if not self._read_more():
+                return -1
+
+    def _read_all(self):
+        while self._read_more():
+            pass
+
+    @staticmethod
+    def _parse_part_headers(raw_headers):
+        headers = {}
+        for line in raw_headers.split(b'\r\n'):
+            name, _, value = line.decode('utf-8', 'replace').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def read_soap_part(self):
+        """
+        Read the response until the start of the records attachment.
+        Responses that are not multipart messages (e.g. SOAP faults) are read completely.
+        :return: Returns the SOAP envelope of the response.
+        """
+        first_line_end = self._find(b'\r\n')
+        if self._boundary is None:
+            if first_line_end < 0 or not self._buffer.startswith(b'--'):
+                self._read_all()
+                self.soap_part = self._buffer
+                self._buffer = b''
+                return self.soap_part
+            self._boundary = self._buffer[2:first_line_end].strip()
+
+        # Prefix buffer with line break so that the first delimiter is similar to the others
+        self._buffer = b'\r\n' + self._buffer
+        delimiter = b'\r\n--' + self._boundary
+        index = self._find(delimiter)
+        while index >= 0:
+            self._buffer = self._buffer[index + len(delimiter):]
+            line_end = self._find(b'\r\n')
+            if line_end < 0 or self._buffer.startswith(b'--'):
+                break
+            headers_end = self._find(b'\r\n\r\n', line_end)
+            if headers_end < 0:
+                break
+            headers = self._parse_part_headers(self._buffer[line_end + 2:headers_end])
+            self._buffer = self._buffer[headers_end + 4:]
+
+            if headers.get('content-id') == ATTACHMENT_CONTENT_ID:
+                self._attachment_found = True
+                break
+
+            index = self._find(delimiter)
+            if self.soap_part is None:
+                self.soap_part = self._buffer[:index] if index >= 0 else self._buffer
+
+        if self.soap_part is None:
+            self.soap_part = b''
+        return self.soap_part
+
+    def records(self):
+        """
+        Inflate and decode the records attachment.
+        :return: Yields operational monitoring records one at a time.
+        """
+        if self.soap_part is None:
+            self.read_soap_part()
+        if not self._attachment_found:
+            raise FileNotFoundError('Attachment not found in operational monitoring data response.')
+
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        records_decoder = RecordsArrayDecoder()
+
+        data = self._buffer
+        self._buffer = b''
+        while not decompressor.eof:
+            if data:
+                text = text_decoder.decode(decompressor.decompress(data))
+                yield from records_decoder.feed(text)
+            data = next(self._chunks, None)
+            if data is None:
+                break
+            self.bytes_read += len(data)
+
+        if not decompressor.eof:
+            raise zlib.error('Operational monitoring data attachment is truncated.')
+        yield from records_decoder.feed(text_decoder.decode(decompressor.flush(), final=True))
+        records_decoder.close()
+
+        # Read the closing delimiter, so that the connection can be reused
+        for data in self._chunks:
+            self.bytes_read += len(data)
@@ -0,0 +1,166 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from bson import ObjectId
+
+SEGMENT_SUFFIX = '.jsonl'
+TMP_PREFIX = '.tmp-'
+DEFAULT_DRAIN_INTERVAL = 10
+DEFAULT_DRAIN_BATCH_SIZE = 50000
+
+
+class RecordsSpool:
+    """
+    On-disk write-ahead spool of collected records.
+    Every appended batch is written to a new segment file in the spool directory of the server. Segment is written
+    to a temporary file, synced and renamed, so that a segment is either complete or not visible at all.
+    Records keep their MongoDB _id, or get one when spooled, so inserting a segment again after a partial failure
+    does not create duplicates.
+    """
+
+    def __init__(self, spool_directory, xroad_instance):
+        self.directory = os.path.join(spool_directory, xroad_instance)
+
+    def append(self, server_key, records):
+        """
+        Append records of a server to the spool.
+        :param server_key: Server string.
+        :param records: List of records.
+        :return: Returns path of the written segment.
+        """
+        server_directory = os.path.join(self.directory, re.sub('[^0-9a-zA-Z.-]+', '.', server_key))
+        os.makedirs(server_directory, exist_ok=True)
+        segment_name = f'{time.time_ns():020d}-{uuid.uuid4().hex}{SEGMENT_SUFFIX}'
+        tmp_path = os.path.join(server_directory, TMP_PREFIX + segment_name)
+        lines = [json.dumps(dict(record, _id=str(record.get('_id') or ObjectId())), separators=(',', ':')) for record in records]
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        segment_path = os.path.join(server_directory, segment_name)
+        os.replace(tmp_path, segment_path)
+        return segment_path
+
+    def segments(self):
+        """
+        :return: Returns paths of complete segments of all servers, oldest segment of each server first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        segments = []
+        for server_directory in sorted(os.scandir(self.directory), key=lambda entry: entry.name):
+            if not server_directory.is_dir():
+                continue
+            segments.extend(sorted(
+                entry.path for entry in os.scandir(server_directory.path)
+                if entry.name.endswith(SEGMENT_SUFFIX) and not entry.name.startswith(TMP_PREFIX)
+            ))
+        return segments
+
+    @staticmethod
+    def read_segment(segment_path):
+        records = []
+        with open(segment_path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    record['_id'] = ObjectId(record['_id'])
+                    records.append(record)
+        return records
+
+    def drain(self, server_m, batch_size=DEFAULT_DRAIN_BATCH_SIZE):
+        """
+        Insert spooled records to raw_messages in batches of at least batch_size records and remove inserted segments.
+        Draining stops at the first failed insert, remaining segments are kept for the next drain.
+        :param server_m: DatabaseManager used to insert the records.
+        :param batch_size: Number of records inserted with one insert_many call.
+        :return: Returns number of inserted records.
+        """
+        inserted = 0
+        records = []
+        batch_segments = []
+        for segment_path in self.segments():
+            records.extend(self.read_segment(segment_path))
+            batch_segments.append(segment_path)
+            if len(records) >= batch_size:
+                inserted += self._insert_batch(server_m, records, batch_segments)
+                records = []
+                batch_segments = []
+        if batch_segments:
+            inserted += self._insert_batch(server_m, records, batch_segments)
+        return inserted
+
+    @staticmethod
+    def _insert_batch(server_m, records, segments):
+        if records:
+            server_m.insert_spooled_raw_messages(records)
+        for segment_path in segments:
+            os.remove(segment_path)
+        return len(records)
+
+
+class SpoolDrainer(threading.Thread):
+    """
+    Background thread that drains the spool every interval seconds until stopped.
+    """
+
+    def __init__(self, spool, server_m, logger_m, interval=DEFAULT_DRAIN_INTERVAL, batch_size=DEFAULT_DRAIN_BATCH_SIZE):
+        super().__init__(name='spool-drainer', daemon=True)
+        self.spool = spool
+        self.server_m = server_m
+        self.logger_m = logger_m
+        self.interval = interval
+        self.batch_size = batch_size
+        self.inserted = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while True:
+            self.drain()
+            if self._stop_event.wait(self.interval):
+                return
+
+    def drain(self):
+        try:
+            self.inserted += self.spool.drain(self.server_m, self.batch_size)
+            return True
+        except Exception as e:
+            self.logger_m.log_warning('collector_spool', f'Draining spool failed, records are kept in spool: {repr(e)}')
+            return False
+
+    def stop(self):
+        """
+        Stop the background thread and drain the remaining spooled records.
+        :return: Returns True if the spool was drained completely.
+        """
+        self._stop_event.set()
+        self.join()
+        return self.drain()
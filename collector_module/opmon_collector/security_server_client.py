@@ -22,6 +22,38 @@
 # THE SOFTWARE.
 #
 
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_process_sessions = {}
+
+
+def create_http_session(pool_size=1):
+    """
+    Create a requests session that keeps TLS connections to the security server alive between requests.
+    :param pool_size: Maximum number of connections kept open per host.
+    :return: Returns the new session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_process_http_session():
+    """
+    Get the HTTP session of the current process. Sessions are not shared with forked child processes.
+    :return: Returns the session of the current process.
+    """
+    pid = os.getpid()
+    if pid not in _process_sessions:
+        _process_sessions[pid] = create_http_session()
+    return _process_sessions[pid]
+
+
 class SecurityServerClient:
     def __init__(self):
         pass
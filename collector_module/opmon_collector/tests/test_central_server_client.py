@@ -52,7 +52,8 @@ def test_get_security_servers(basic_settings, mocker):
                   body=shared_params, status=200)
 
     client = CentralServerClient(basic_settings['xroad'], mocker.Mock())
-    server_list = client.get_security_servers()
+    server_list = client.get_security_servers('/V2/20201105104801222890000/old-shared-params.xml')
+    assert client.shared_params_location == '/V2/20201105104801222890000/shared-params.xml'
 
     expected_servers = [
         'DEV/ORG/1234567-8/ss1/x-road-ss',
@@ -66,3 +67,16 @@ def test_get_security_servers(basic_settings, mocker):
     for server in server_list:
         keys = set(server.keys())
         assert keys == {'ownerId', 'instance', 'memberClass', 'memberCode', 'serverCode', 'address', 'server'}
+
+
+@responses.activate
+def test_get_security_servers_not_changed(basic_settings, mocker):
+    with open('responses/internalconf.txt', "r") as f:
+        internal_conf_response = f.read()
+
+    responses.add(responses.GET, 'http://x-road-cs/internalconf', body=internal_conf_response, status=200)
+
+    client = CentralServerClient(basic_settings['xroad'], mocker.Mock())
+    assert client.get_security_servers('/V2/20201105104801222890000/shared-params.xml') is None
+    assert client.shared_params_location == '/V2/20201105104801222890000/shared-params.xml'
+    assert len(responses.calls) == 1
@@ -0,0 +1,73 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+from opmon_collector.circuit_breaker import CircuitBreaker
+
+SETTINGS = {'collector': {'circuit-breaker-threshold': 2, 'circuit-breaker-backoff': 100, 'circuit-breaker-max-backoff': 300}}
+
+
+def test_circuit_breaker_disabled():
+    breaker = CircuitBreaker({'collector': {}})
+    assert not breaker.enabled
+    assert not breaker.is_open({'server': 'server1', 'failures': 10, 'open_until': 2000.0}, 1000.0)
+
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(SETTINGS)
+
+    health = breaker.record_failure('server1', None, TimeoutError('timeout'), 1000.0)
+    assert health['failures'] == 1
+    assert health['open_until'] is None
+    assert not breaker.is_open(health, 1000.0)
+
+    health = breaker.record_failure('server1', health, TimeoutError('timeout'), 1000.0)
+    assert health['failures'] == 2
+    assert health['open_until'] == 1100.0
+    assert health['last_error'] == "TimeoutError('timeout')"
+    assert breaker.is_open(health, 1050.0)
+
+    # Half-open after backoff
+    assert not breaker.is_open(health, 1100.0)
+
+
+def test_circuit_breaker_backoff_is_exponential_and_capped():
+    breaker = CircuitBreaker(SETTINGS)
+    health = {'server': 'server1', 'failures': 2, 'open_until': 1100.0}
+
+    health = breaker.record_failure('server1', health, Exception(), 2000.0)
+    assert health['open_until'] == 2200.0
+
+    health = breaker.record_failure('server1', health, Exception(), 3000.0)
+    assert health['open_until'] == 3300.0
+
+
+def test_circuit_breaker_success_closes():
+    breaker = CircuitBreaker(SETTINGS)
+    assert breaker.record_success('server1', None) is None
+    assert breaker.record_success('server1', {'server': 'server1', 'failures': 0}) is None
+
+    health = breaker.record_success('server1', {'server': 'server1', 'failures': 3, 'open_until': 1100.0})
+    assert health['failures'] == 0
+    assert health['open_until'] is None
+    assert not breaker.is_open(health, 1000.0)
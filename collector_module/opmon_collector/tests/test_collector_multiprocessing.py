@@ -29,15 +29,23 @@ import pathlib
 from opmon_collector.settings import OpmonSettingsManager
 from opmon_collector.collector_multiprocessing import run_threaded_collector
 from opmon_collector.collector_multiprocessing import process_thread_pool
+from opmon_collector.collector_multiprocessing import schedule_thread_inputs
+from opmon_collector.collector_multiprocessing import get_requeue_inputs
+from opmon_collector.collector_worker import summarize_results
 import opmon_collector
 
-TEST_SERVERS = [1, 2, 3]
+TEST_SERVERS = [{'server': 'server1'}, {'server': 'server2'}, {'server': 'server3'}]
+TEST_POINTERS = {'server1': 1000.0, 'server2': 2000.0, 'server3': 3000.0}
+NOW = 100000.0
 
 
 @pytest.fixture()
 def mock_server_manager(mocker):
     manager = mocker.Mock()
     manager.get_server_list_from_database = mocker.Mock(return_value=(TEST_SERVERS, 1))
+    manager.load_next_records_timestamps = mocker.Mock(return_value=TEST_POINTERS)
+    manager.get_timestamp = mocker.Mock(return_value=NOW)
+    manager.load_server_health = mocker.Mock(return_value={})
     mocker.patch('opmon_collector.collector_multiprocessing.DatabaseManager', return_value=manager)
     return manager
 
@@ -50,7 +58,8 @@ def basic_settings():
 
 @pytest.fixture()
 def mock_thread_pool(mocker):
-    pool = mocker.Mock()
+    pool = mocker.MagicMock()
+    pool.__enter__.return_value = pool
     pool.map = mocker.Mock(return_value=([(True, None), (False, FileNotFoundError('test error')), (True, None)]))
     mocker.patch('opmon_collector.collector_multiprocessing.Pool', return_value=pool)
     return pool
@@ -71,9 +80,12 @@ def mock_thread(test_input):
 
 def test_run_threaded_collector(mocker, mock_server_manager, mock_thread_pool, basic_settings):
     mock_logger = mocker.Mock()
-    run_threaded_collector(mock_logger, basic_settings)
+    summary = run_threaded_collector(mock_logger, basic_settings)
 
+    assert summary['done'] == 2
+    assert summary['error'] == 1
     assert mock_thread_pool.map.call_count == 1
+    assert mock_thread_pool.__exit__.call_count == 1
     args, _ = mock_thread_pool.map.call_args
     function, inputs = args
 
@@ -83,6 +95,48 @@ def test_run_threaded_collector(mocker, mock_server_manager, mock_thread_pool, b
     for i in inputs:
         assert i['settings'] == basic_settings
         assert i['server_data'] in TEST_SERVERS
+        assert i['records_from'] == TEST_POINTERS[i['server_data']['server']]
+
+    mock_server_manager.load_next_records_timestamps.assert_called_once_with(
+        ['server1', 'server2', 'server3'], basic_settings['collector']['records-from-offset']
+    )
+    mock_server_manager.close.assert_called_once()
+
+
+def test_run_threaded_collector_thread_mode(mocker, mock_server_manager, mock_thread_pool, basic_settings):
+    mock_thread_executor = mocker.patch(
+        'opmon_collector.collector_multiprocessing.process_thread_executor', return_value=summarize_results([])
+    )
+    mocker.patch('opmon_collector.collector_multiprocessing.OpmonPidFileHandler')
+    basic_settings['collector']['mode'] = 'thread'
+    run_threaded_collector(mocker.Mock(), basic_settings)
+
+    assert mock_thread_pool.map.call_count == 0
+    assert mock_thread_executor.call_count == 1
+    _, inputs = mock_thread_executor.call_args[0]
+    assert len(inputs) == 3
+
+
+@pytest.mark.parametrize('mode, pointer_flush_interval', [('process', 0), ('thread', 30)])
+def test_run_threaded_collector_buffers_pointers_in_thread_mode(mocker, mock_server_manager, mock_thread_pool,
+                                                                basic_settings, mode, pointer_flush_interval):
+    mocker.patch('opmon_collector.collector_multiprocessing.process_thread_executor', return_value=summarize_results([]))
+    mocker.patch('opmon_collector.collector_multiprocessing.OpmonPidFileHandler')
+    database_manager = opmon_collector.collector_multiprocessing.DatabaseManager
+    basic_settings['collector']['mode'] = mode
+    basic_settings['collector']['pointer-flush-interval'] = 30
+    run_threaded_collector(mocker.Mock(), basic_settings)
+
+    assert database_manager.call_args[1]['pointer_flush_interval'] == pointer_flush_interval
+
+
+def test_run_threaded_collector_unsupported_mode(mocker, mock_server_manager, mock_thread_pool, basic_settings):
+    mocker.patch('opmon_collector.collector_multiprocessing.OpmonPidFileHandler')
+    basic_settings['collector']['mode'] = 'async'
+
+    with pytest.raises(ValueError, match='Unsupported collector mode: async'):
+        run_threaded_collector(mocker.Mock(), basic_settings)
+    assert mock_thread_pool.map.call_count == 0
 
 
 def test_run_threaded_collector_with_existing_pid_file(mocker, mock_server_manager, mock_thread_pool, basic_settings):
@@ -102,7 +156,114 @@ def test_process_thread_pool():
     settings = {'collector': {'thread-count': 5}}
     inputs = [1, 2, 3]
     opmon_collector.collector_multiprocessing.run_collector_thread = mock_thread
-    done, error = process_thread_pool(settings, inputs)
+    done, error, stats = process_thread_pool(settings, inputs)
 
     assert done == 2
     assert error == 1
+    assert stats['records'] == 0
+
+
+def test_run_threaded_collector_requeues_lagging_servers(mocker, mock_server_manager, mock_thread_pool, basic_settings):
+    mock_server_manager.load_next_records_timestamps.side_effect = [
+        TEST_POINTERS,
+        {'server1': 1500.0, 'server2': 2000.0, 'server3': NOW},
+        {'server1': 1500.0, 'server2': 2000.0, 'server3': NOW},
+    ]
+    mocker.patch('opmon_collector.collector_multiprocessing.OpmonPidFileHandler')
+    basic_settings['collector']['requeue-passes'] = 2
+    basic_settings['collector']['priority-lag'] = 3600
+    run_threaded_collector(mocker.Mock(), basic_settings)
+
+    # Second pass collects only server1, the only server that made progress and is still lagging.
+    # Server1 makes no progress in the second pass, so there is no third pass.
+    assert mock_thread_pool.map.call_count == 2
+    assert mock_thread_pool.__exit__.call_count == 1
+    _, inputs = mock_thread_pool.map.call_args[0]
+    assert [i['server_data']['server'] for i in inputs] == ['server1']
+    assert inputs[0]['records_from'] == 1500.0
+    assert mock_server_manager.load_next_records_timestamps.call_count == 3
+
+
+def test_run_threaded_collector_skips_open_circuit_breaker(mocker, mock_server_manager, mock_thread_pool, basic_settings):
+    mock_server_manager.load_server_health.return_value = {
+        'server2': {'server': 'server2', 'failures': 5, 'open_until': NOW + 100},
+        'server3': {'server': 'server3', 'failures': 5, 'open_until': NOW - 100},
+    }
+    mocker.patch('opmon_collector.collector_multiprocessing.OpmonPidFileHandler')
+    basic_settings['collector']['circuit-breaker-threshold'] = 3
+    run_threaded_collector(mocker.Mock(), basic_settings)
+
+    _, inputs = mock_thread_pool.map.call_args[0]
+    assert [i['server_data']['server'] for i in inputs] == ['server1', 'server3']
+    assert inputs[1]['health']['failures'] == 5
+    mock_server_manager.load_next_records_timestamps.assert_called_once_with(
+        ['server1', 'server3'], basic_settings['collector']['records-from-offset']
+    )
+
+
+def test_run_threaded_collector_drains_spool(mocker, mock_server_manager, mock_thread_pool, basic_settings, tmp_path):
+    drainer = mocker.Mock(inserted=10)
+    drainer_class = mocker.patch('opmon_collector.collector_multiprocessing.SpoolDrainer', return_value=drainer)
+    mocker.patch('opmon_collector.collector_multiprocessing.OpmonPidFileHandler')
+    events = []
+    mocker.patch(
+        'opmon_collector.collector_multiprocessing.Pool', side_effect=lambda **kwargs: events.append('fork') or mock_thread_pool
+    )
+    drainer.start.side_effect = lambda: events.append('start')
+    drainer.stop.side_effect = lambda: events.append('stop')
+    mock_thread_pool.__exit__.side_effect = lambda *args: events.append('exit')
+    basic_settings['collector']['spool-directory'] = str(tmp_path)
+    basic_settings['collector']['requeue-passes'] = 1
+    run_threaded_collector(mocker.Mock(), basic_settings)
+
+    # Worker processes are not forked while the drainer thread is running
+    assert events == ['fork', 'start', 'stop', 'exit']
+
+    spool, server_m, _ = drainer_class.call_args[0]
+    assert spool.directory == os.path.join(str(tmp_path), basic_settings['xroad']['instance'])
+    assert server_m == mock_server_manager
+    drainer.start.assert_called_once()
+    drainer.stop.assert_called_once()
+
+
+def test_run_threaded_collector_writes_metrics(mocker, mock_server_manager, mock_thread_pool, basic_settings, tmp_path):
+    mocker.patch('opmon_collector.collector_multiprocessing.OpmonPidFileHandler')
+    metrics_file = tmp_path / 'collector.prom'
+    basic_settings['collector']['metrics-file'] = str(metrics_file)
+    run_threaded_collector(mocker.Mock(), basic_settings)
+
+    metrics = metrics_file.read_text()
+    assert 'xroad_metrics_collector_servers{instance="DEFAULT",status="collected"} 2' in metrics
+    assert f'xroad_metrics_collector_pointer_lag_seconds{{instance="DEFAULT",server="server1"}} {NOW - 1000.0}' in metrics
+    mock_server_manager.flush_next_records_timestamps.assert_called_once()
+
+
+def test_schedule_thread_inputs():
+    settings = {'collector': {
+        'records-from-offset': 50000, 'repeat-limit': 10, 'priority-lag': 90000, 'priority-repeat-limit': 100
+    }}
+    inputs = [
+        {'server_data': {'server': 'server1'}, 'records_from': 20000.0},
+        {'server_data': {'server': 'server2'}, 'records_from': None},
+        {'server_data': {'server': 'server3'}, 'records_from': 5000.0},
+    ]
+    scheduled = schedule_thread_inputs(settings, inputs, NOW)
+
+    assert [i['server_data']['server'] for i in scheduled] == ['server3', 'server1', 'server2']
+    assert scheduled[0]['repeat_limit'] == 100
+    assert 'repeat_limit' not in scheduled[1]
+    assert 'repeat_limit' not in scheduled[2]
+
+
+def test_get_requeue_inputs():
+    settings = {'collector': {'priority-lag': 3600}}
+    inputs = [
+        {'server_data': {'server': 'server1'}, 'records_from': 1000.0},
+        {'server_data': {'server': 'server2'}, 'records_from': 2000.0},
+        {'server_data': {'server': 'server3'}, 'records_from': 3000.0},
+    ]
+    pointers = {'server1': 2000.0, 'server2': 2000.0, 'server3': NOW - 100}
+    requeue = get_requeue_inputs(settings, inputs, pointers, NOW)
+
+    assert requeue == [{'server_data': {'server': 'server1'}, 'records_from': 2000.0}]
+    assert inputs[0]['records_from'] == 1000.0
@@ -0,0 +1,98 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import threading
+
+from opmon_collector.collector_threads import process_thread_executor
+
+
+def mock_thread(test_input):
+    if test_input['server_data'] == 2:
+        return False, FileNotFoundError('test error')
+    return True, None
+
+
+def test_process_thread_executor(mocker):
+    collect = mocker.patch('opmon_collector.collector_threads.run_collector_thread', side_effect=mock_thread)
+    settings = {'collector': {'thread-concurrency': 2}}
+    inputs = [{'server_data': i} for i in [1, 2, 3]]
+
+    done, error, stats = process_thread_executor(settings, inputs)
+
+    assert done == 2
+    assert error == 1
+    assert stats['records'] == 0
+    assert all('http_session' not in data for data in inputs)
+    assert all(call.args[0]['http_session'] is not None for call in collect.call_args_list)
+
+
+def test_process_thread_executor_session_per_thread(mocker):
+    sessions = {}
+    # Both threads are collecting at the same time, so each collects with its own session
+    barrier = threading.Barrier(2, timeout=30)
+
+    def thread_session(data):
+        barrier.wait()
+        sessions.setdefault(threading.get_ident(), set()).add(data['http_session'])
+        return True, None
+
+    mocker.patch('opmon_collector.collector_threads.run_collector_thread', side_effect=thread_session)
+    close = mocker.patch('requests.Session.close')
+    settings = {'collector': {'thread-concurrency': 2}}
+
+    process_thread_executor(settings, [{'server_data': i} for i in range(4)])
+
+    assert len(sessions) == 2
+    assert all(len(thread_sessions) == 1 for thread_sessions in sessions.values())
+    assert len(set.union(*sessions.values())) == 2
+    assert close.call_count == 2
+
+
+def test_process_thread_executor_concurrency_limit(mocker):
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+    # Workers block until the concurrency limit is reached, so the maximum does not depend on timing
+    release = threading.Event()
+
+    def blocking_thread(data):
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+            if running['now'] == 3:
+                release.set()
+        if not release.wait(30):
+            raise TimeoutError('concurrency limit was not reached')
+        with lock:
+            running['now'] -= 1
+        return True, None
+
+    mocker.patch('opmon_collector.collector_threads.run_collector_thread', side_effect=blocking_thread)
+    settings = {'collector': {'thread-concurrency': 3}}
+    inputs = [{'server_data': i} for i in range(10)]
+
+    done, error, _ = process_thread_executor(settings, inputs)
+
+    assert done == 10
+    assert error == 0
+    assert running['max'] == 3
@@ -25,12 +25,15 @@
 import os
 import pathlib
 from logging import StreamHandler
+from unittest.mock import call
 
 import pytest
+import requests
 import responses
 
-from opmon_collector.collector_worker import CollectorWorker
+from opmon_collector.collector_worker import CollectorWorker, summarize_results
 from opmon_collector.logger_manager import LoggerManager
+from opmon_collector.metrics import REQUEST_DURATION_BUCKETS, RESPONSE_BYTES_BUCKETS, new_histogram, observe
 from opmon_collector.security_server_client import SecurityServerClient
 from opmon_collector.settings import OpmonSettingsManager
 
@@ -103,6 +106,10 @@ def test_collector_worker_work(mock_server_manager, basic_data, mock_response_co
     if error is not None:
         raise error
 
+    assert worker.stats['sanitize_time'] > 0
+    assert worker.stats['insert_time'] > 0
+    assert worker.stats['request_duration']['count'] == 2
+    assert worker.stats['response_bytes']['sum'] == worker.stats['bytes']
     assert mock_server_manager.set_next_records_timestamp.call_count == 2
     next_time_in_response1 = 1604420300
     mock_server_manager.set_next_records_timestamp.assert_any_call('--testservername--', next_time_in_response1)
@@ -146,15 +153,64 @@ def test_collector_worker_work_max_repeats(mock_server_manager, basic_data, mock
     assert worker.status == CollectorWorker.Status.DATA_AVAILABLE
 
 
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat', 'metrics_response2.dat')], indirect=True
+)
+def test_collector_worker_stores_records_in_chunks(mock_server_manager, basic_data, mock_response_contents):
+    for content in mock_response_contents:
+        responses.add(responses.POST, 'http://x-road-ss', body=content, status=200)
+
+    basic_data['settings']['collector']['records-chunk-size'] = 1000
+
+    worker = CollectorWorker(basic_data)
+    result, error = worker.work()
+
+    if error is not None:
+        raise error
+
+    chunks = [call[0][0] for call in mock_server_manager.insert_data_to_raw_messages.call_args_list]
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 1000, 1000, 1000, 230]
+    assert mock_server_manager.set_next_records_timestamp.call_count == 2
+    assert worker.stats['records'] == 5230
+    assert worker.status == CollectorWorker.Status.ALL_COLLECTED
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat',)], indirect=True
+)
+def test_collector_worker_record_ids_are_stable(mock_server_manager, basic_data, mock_response_contents):
+    responses.add(responses.POST, 'http://x-road-ss', body=mock_response_contents[0], status=200)
+    responses.add(responses.POST, 'http://x-road-ss', body=mock_response_contents[0], status=200)
+    basic_data['settings']['collector']['repeat-limit'] = 1
+
+    ids = []
+    for _ in range(2):
+        mock_server_manager.insert_data_to_raw_messages.reset_mock()
+        result, error = CollectorWorker(basic_data).work()
+        if error is not None:
+            raise error
+        records = mock_server_manager.insert_data_to_raw_messages.call_args_list[0][0][0]
+        ids.append([record['_id'] for record in records])
+
+    # Records collected again after a failed response get the same _id and are skipped by the insert
+    assert len(ids[0]) == 5230
+    assert ids[0] == ids[1]
+    assert ids[0][0].generation_time.timestamp() == records[0]['monitoringDataTs']
+
+
 @responses.activate
 @pytest.mark.parametrize('documents_log_dir, num_records_logged_to_file', [('Test', 5230), (None, 0)])
 @pytest.mark.parametrize(
     'mock_response_contents', [('metrics_response1.dat',)], indirect=True
 )
 def test_collector_worker_logs_to_file(documents_log_dir, num_records_logged_to_file,
-                                       mock_server_manager, basic_data, mock_response_contents, caplog):
+                                       mock_server_manager, basic_data, mock_response_contents, tmp_path):
     responses.add(responses.POST, 'http://x-road-ss', body=mock_response_contents[0], status=200)
 
+    if documents_log_dir:
+        documents_log_dir = str(tmp_path / documents_log_dir)
     basic_data['settings']['collector']['documents-log-directory'] = documents_log_dir
     basic_data['settings']['collector']['repeat-limit'] = 1
 
@@ -166,7 +222,136 @@ def test_collector_worker_logs_to_file(documents_log_dir, num_records_logged_to_
     records = mock_server_manager.insert_data_to_raw_messages.call_args_list[0][0][0]
 
     assert len(records) == 5230
-    assert len(caplog.records) == num_records_logged_to_file
+    if documents_log_dir:
+        with open(worker.documents_log_writer.get_file_name()) as f:
+            assert len(f.readlines()) == num_records_logged_to_file
+    else:
+        assert worker.documents_log_writer is None
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat',)], indirect=True
+)
+def test_collector_worker_spools_records(tmp_path, mock_server_manager, basic_data, mock_response_contents):
+    responses.add(responses.POST, 'http://x-road-ss', body=mock_response_contents[0], status=200)
+
+    basic_data['settings']['collector']['spool-directory'] = str(tmp_path)
+    basic_data['settings']['collector']['repeat-limit'] = 1
+    mock_server_manager.insert_data_to_raw_messages.side_effect = ConnectionError('db down')
+    worker = CollectorWorker(basic_data)
+    result, error = worker.work()
+
+    assert result is True
+    mock_server_manager.insert_data_to_raw_messages.assert_not_called()
+    mock_server_manager.set_next_records_timestamp.assert_called_once_with('--testservername--', 1604420300)
+    segments = worker.spool.segments()
+    assert sum(len(worker.spool.read_segment(segment)) for segment in segments) == 5230
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat', 'metrics_response2.dat')], indirect=True
+)
+def test_collector_worker_uses_shared_session(mocker, basic_data, mock_response_contents):
+    for content in mock_response_contents:
+        responses.add(responses.POST, 'http://x-road-ss', body=content, status=200)
+
+    session = requests.Session()
+    post = mocker.spy(session, 'post')
+    basic_data['http_session'] = session
+
+    worker = CollectorWorker(basic_data)
+    result, error = worker.work()
+
+    if error is not None:
+        raise error
+    assert post.call_count == 2
+    assert worker.stats['requests'] == 2
+    assert worker.stats['records'] == 5230
+    assert worker.stats['request_time'] > 0
+    assert worker.stats['parse_time'] > 0
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat', 'metrics_response2.dat')], indirect=True
+)
+def test_collector_worker_priority_repeat_limit(mock_server_manager, basic_data, mock_response_contents):
+    for content in mock_response_contents:
+        responses.add(responses.POST, 'http://x-road-ss', body=content, status=200)
+
+    basic_data['settings']['collector']['repeat-limit'] = 1
+    basic_data['repeat_limit'] = 2
+    worker = CollectorWorker(basic_data)
+    result, error = worker.work()
+
+    assert result is True
+    assert mock_server_manager.set_next_records_timestamp.call_count == 2
+    assert worker.status == CollectorWorker.Status.ALL_COLLECTED
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat',)], indirect=True
+)
+def test_collector_worker_time_budget(mocker, mock_server_manager, basic_data, mock_response_contents):
+    responses.add(responses.POST, 'http://x-road-ss', body=mock_response_contents[0], status=200)
+    basic_data['settings']['collector']['server-time-budget'] = 0.5
+    worker = CollectorWorker(basic_data)
+    post = mocker.spy(worker.session, 'post')
+    result, error = worker.work()
+
+    # First request timeout is clamped to the budget, second request would not finish within the budget
+    assert result is True
+    assert post.call_count == 1
+    assert 0 < post.call_args[1]['timeout'] <= 0.5
+    assert worker.budget_exhausted
+    assert worker.status == CollectorWorker.Status.DATA_AVAILABLE
+
+
+def test_request_timeout_without_time_budget(basic_data):
+    worker = CollectorWorker(basic_data)
+    worker.collect_start = 0
+    assert worker._get_request_timeout() == basic_data['settings']['xroad']['security-server']['timeout']
+
+
+def test_request_timeout_with_connect_timeout(basic_data):
+    basic_data['settings']['xroad']['security-server']['connect-timeout'] = 0.5
+    worker = CollectorWorker(basic_data)
+    worker.collect_start = 0
+    assert worker._get_request_timeout() == (0.5, basic_data['settings']['xroad']['security-server']['timeout'])
+
+
+def test_collector_worker_records_failure(mocker, mock_server_manager, basic_data):
+    basic_data['settings']['collector']['circuit-breaker-threshold'] = 1
+    basic_data['health'] = {'server': '--testservername--', 'failures': 1, 'open_until': NOW - 1}
+    worker = CollectorWorker(basic_data)
+    mocker.patch.object(worker, '_request_opmon_data', side_effect=requests.ConnectionError('unreachable'))
+    result, error = worker.work()
+
+    assert result is False
+    server_key, health = mock_server_manager.set_server_health.call_args[0]
+    assert server_key == '--testservername--'
+    assert health['failures'] == 2
+    assert health['open_until'] > NOW
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat', 'metrics_response2.dat')], indirect=True
+)
+def test_collector_worker_records_success(mock_server_manager, basic_data, mock_response_contents):
+    for content in mock_response_contents:
+        responses.add(responses.POST, 'http://x-road-ss', body=content, status=200)
+
+    basic_data['settings']['collector']['circuit-breaker-threshold'] = 1
+    basic_data['health'] = {'server': '--testservername--', 'failures': 1, 'open_until': NOW - 1}
+    result, error = CollectorWorker(basic_data).work()
+
+    assert result is True
+    _, health = mock_server_manager.set_server_health.call_args[0]
+    assert health['failures'] == 0
 
 
 def test_worker_status(mock_server_manager, basic_data):
@@ -176,16 +361,16 @@ def test_worker_status(mock_server_manager, basic_data):
     assert worker.batch_start > 3
     assert worker.status == CollectorWorker.Status.DATA_AVAILABLE
 
-    worker.records = [i for i in range(1000)]
+    worker.records_count = 1000
     assert worker.status == CollectorWorker.Status.DATA_AVAILABLE
 
-    worker.records = [1, 2, 3]
+    worker.records_count = 3
     worker.update_status()
     assert worker.status == CollectorWorker.Status.TOO_SMALL_BATCH
 
     worker.status = CollectorWorker.Status.DATA_AVAILABLE
     worker.batch_start = worker.batch_end + 1
-    worker.records = [i for i in range(1000)]
+    worker.records_count = 1000
     worker.update_status()
     assert worker.status == CollectorWorker.Status.ALL_COLLECTED
 
@@ -195,6 +380,88 @@ def test_worker_status(mock_server_manager, basic_data):
     assert worker.status == CollectorWorker.Status.ALL_COLLECTED
 
 
+def test_worker_uses_preloaded_pointer(mock_server_manager, basic_data):
+    basic_data['records_from'] = 1604000100.5
+    worker = CollectorWorker(basic_data)
+
+    assert worker.batch_start == 1604000100
+    mock_server_manager.get_next_records_timestamp.assert_not_called()
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat', 'metrics_response2.dat')], indirect=True
+)
+def test_collector_worker_flushes_pointer(mock_server_manager, basic_data, mock_response_contents):
+    for content in mock_response_contents:
+        responses.add(responses.POST, 'http://x-road-ss', body=content, status=200)
+
+    worker = CollectorWorker(basic_data)
+    result, error = worker.work()
+
+    assert result is True
+    mock_server_manager.flush_next_records_timestamps.assert_called_once()
+
+    mock_server_manager.flush_next_records_timestamps.side_effect = RuntimeError('test error')
+    result, error = CollectorWorker(basic_data).work()
+    assert result is False
+    assert isinstance(error, RuntimeError)
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    'mock_response_contents', [('metrics_response1.dat', 'metrics_response2.dat')], indirect=True
+)
+def test_collector_worker_adaptive_window(mock_server_manager, basic_data, mock_response_contents):
+    for content in mock_response_contents:
+        responses.add(responses.POST, 'http://x-road-ss', body=content, status=200)
+
+    basic_data['settings']['collector']['adaptive-window'] = True
+    basic_data['settings']['collector']['adaptive-target-records'] = 1000
+    basic_data['settings']['collector']['repeat-limit'] = 2
+    basic_data['records_rate'] = 1.0
+
+    worker = CollectorWorker(basic_data)
+    result, error = worker.work()
+
+    if error is not None:
+        raise error
+
+    # First window is sized by the stored rate: 1000 records / 1.0 records per second
+    assert '<om:recordsTo>1604001000</om:recordsTo>' in responses.calls[0].request.body
+    # Rate is updated with 5230 records received until nextRecordsFrom
+    rate = 0.5 * 5230 / (1604420300 - 1604000000) + 0.5 * 1.0
+    assert mock_server_manager.set_next_records_timestamp.call_args_list[0] == call(
+        '--testservername--', 1604420300, records_rate=pytest.approx(rate)
+    )
+    request_end = 1604420300 + int(1000 / rate)
+    assert f'<om:recordsTo>{request_end}</om:recordsTo>' in responses.calls[1].request.body
+    assert mock_server_manager.set_next_records_timestamp.call_args_list[1][0] == ('--testservername--', request_end)
+
+    assert worker.stats['min_batch_size'] == 0
+    assert worker.stats['max_batch_size'] == 5230
+    assert worker.status == CollectorWorker.Status.DATA_AVAILABLE
+
+
+def test_adaptive_window_request_end(mock_server_manager, basic_data):
+    basic_data['settings']['collector']['adaptive-window'] = True
+    basic_data['settings']['collector']['adaptive-target-records'] = 1000
+    basic_data['settings']['collector']['adaptive-min-window'] = 60
+    worker = CollectorWorker(basic_data)
+
+    # Unknown rate, request everything
+    assert worker._get_request_end() == worker.batch_end
+
+    worker.records_rate = 10.0
+    assert worker._get_request_end() == worker.batch_start + 100
+
+    worker.records_rate = 1000.0
+    assert worker._get_request_end() == worker.batch_start + 60
+
+    worker.records_rate = 0.00001
+    assert worker._get_request_end() == worker.batch_end
+
+
 def test_sanitize_records(mock_server_manager, basic_data):
     worker = CollectorWorker(basic_data)
 
@@ -218,6 +485,24 @@ def test_sanitize_records(mock_server_manager, basic_data):
     assert 'restPath' not in sanitized_records[4]  # xRoadVersion < 7.6.2
 
 
+def test_sanitize_records_in_place(mock_server_manager, basic_data):
+    records = [
+        {"id": 1, "restPath": "some_path/*", "xRoadVersion": 762},
+        {"id": 2, "restPath": "some_path/*", "xRoadVersion": None},
+        {"id": 3, "xRoadVersion": "7.5.0"},
+        {"id": 4, "restPath": "some_path/*", "xRoadVersion": "7.6.2"},
+    ]
+    sanitized_records = CollectorWorker._sanitize_records(records)
+
+    assert sanitized_records is records
+    assert records == [
+        {"id": 1, "xRoadVersion": 762},
+        {"id": 2, "xRoadVersion": None},
+        {"id": 3, "xRoadVersion": "7.5.0"},
+        {"id": 4, "restPath": "some_path/*", "xRoadVersion": "7.6.2"},
+    ]
+
+
 @responses.activate
 @pytest.mark.parametrize(
     'mock_response_contents', [('metrics_client_proxy_ssl_auth_failed.dat',)], indirect=True
@@ -297,3 +582,37 @@ def test_version_gte():
     assert CollectorWorker._version_gte("alpha.6.2", "7.6.2") is False
     assert CollectorWorker._version_gte(" 7.6.2", "7.6.2") is True
     assert CollectorWorker._version_gte("7.6.2 ", "7.6.2") is True
+
+
+def test_summarize_results():
+    def worker_stats(server, requests, records, request_time):
+        stats = {
+            'server': server, 'requests': requests, 'records': records, 'bytes': 10 * records,
+            'request_time': request_time, 'parse_time': 0.5, 'sanitize_time': 0.1, 'insert_time': 0.25,
+            'request_duration': new_histogram(REQUEST_DURATION_BUCKETS),
+            'response_bytes': new_histogram(RESPONSE_BYTES_BUCKETS), 'min_batch_size': 40,
+        }
+        observe(stats['request_duration'], request_time)
+        observe(stats['response_bytes'], 10 * records)
+        return stats
+
+    results = [
+        (True, None, worker_stats('server1', 2, 100, 1.5)),
+        (False, ValueError('test'), worker_stats('server2', 1, 10, 0.5)),
+        (True, None),
+    ]
+    done, error, stats = summarize_results(results)
+
+    assert done == 2
+    assert error == 1
+    assert stats['requests'] == 3
+    assert stats['records'] == 110
+    assert stats['bytes'] == 1100
+    assert stats['request_time'] == 2.0
+    assert stats['insert_time'] == 0.5
+    assert stats['request_duration']['count'] == 2
+    assert stats['request_duration']['sum'] == 2.0
+    assert stats['response_bytes']['counts'][0] == 2
+    assert [(server['server'], server['success'], server['records']) for server in stats['servers']] == [
+        ('server1', True, 100), ('server2', False, 10)
+    ]
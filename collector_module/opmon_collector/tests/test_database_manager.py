@@ -51,6 +51,7 @@ Unit tests for database_manager.py
 import pytest
 import os
 import pathlib
+import pickle
 import time
 import mongomock
 import pymongo
@@ -58,6 +59,8 @@ import pymongo
 from opmon_collector.database_manager import DatabaseManager
 from opmon_collector.settings import OpmonSettingsManager
 
+TEST_SERVER_LIST = [{'server': 'server1', 'address': 'ss1'}, {'server': 'server2', 'address': 'ss2'}]
+
 
 @pytest.fixture
 def basic_settings():
@@ -96,11 +99,62 @@ def test_save_server_list_to_database(basic_settings, mocker):
     xroad_instance = basic_settings['xroad']['instance']
 
     d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
-    d.save_server_list_to_database([1, 2, 3])
+    d.save_server_list_to_database(TEST_SERVER_LIST)
+
+    server_list, timestamp = d.get_server_list_from_database()
+    assert timestamp == pytest.approx(float(time.time()), abs=1)
+    assert server_list == TEST_SERVER_LIST
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_save_server_list_stores_diffs(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
+    d.save_server_list_to_database(TEST_SERVER_LIST, '/V2/1/shared-params.xml')
+    updated_list = [
+        {'server': 'server1', 'address': 'ss1-new'},
+        {'server': 'server3', 'address': 'ss3'},
+    ]
+    d.save_server_list_to_database(updated_list, '/V2/2/shared-params.xml')
+    d.save_server_list_to_database(updated_list, '/V2/3/shared-params.xml')
+
+    db = d.get_client()['collector_state_DEFAULT']
+    assert db['server_list'].count_documents({}) == 1
+    assert d.get_server_list_from_database()[0] == updated_list
+    assert d.get_shared_params_location() == '/V2/3/shared-params.xml'
+
+    history = list(db['server_list_history'].find({}, {'_id': False, 'timestamp': False}).sort([('timestamp', 1)]))
+    assert history == [
+        {'collector_id': 'collector_DEFAULT', 'added': TEST_SERVER_LIST, 'removed': [], 'changed': []},
+        {
+            'collector_id': 'collector_DEFAULT',
+            'added': [{'server': 'server3', 'address': 'ss3'}],
+            'removed': ['server2'],
+            'changed': [{'server': 'server1', 'address': 'ss1-new'}],
+        },
+    ]
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_server_list_legacy_document_and_touch(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
+    collection = d.get_client()['collector_state_DEFAULT']['server_list']
+    collection.insert_one({'collector_id': 'collector_DEFAULT', 'timestamp': 100.0, 'server_list': TEST_SERVER_LIST})
+
+    assert d.get_server_list_from_database() == (TEST_SERVER_LIST, 100.0)
+    assert d.get_shared_params_location() is None
 
+    d.save_server_list_to_database(TEST_SERVER_LIST, '/V2/1/shared-params.xml')
+    d.touch_server_list()
     server_list, timestamp = d.get_server_list_from_database()
+    assert server_list == TEST_SERVER_LIST
     assert timestamp == pytest.approx(float(time.time()), abs=1)
-    assert server_list == [1, 2, 3]
+    assert d.get_client()['collector_state_DEFAULT']['server_list_history'].count_documents({}) == 0
 
 
 @mongomock.patch(servers=(('defaultmongodb', 27017),))
@@ -119,6 +173,20 @@ def test_insert_data_to_raw_messages(basic_settings, mocker):
 
     assert test_data == items
     assert test_data is not items
+    assert len({item['insertTime'] for item in items}) == 1
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_insert_data_to_raw_messages_skips_duplicates(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
+    d.insert_data_to_raw_messages([{'_id': 1, 'test': 1}])
+    d.insert_data_to_raw_messages([{'_id': 1, 'test': 1}, {'_id': 2, 'test': 2}])
+
+    items = list(d.get_client()['query_db_DEFAULT']['raw_messages'].find())
+    assert [item['_id'] for item in items] == [1, 2]
 
 
 @mongomock.patch(servers=(('defaultmongodb', 27017),))
@@ -153,3 +221,154 @@ def test_get_next_records_timestamp_non_existent_key(basic_settings, mocker):
 
     t = d.get_next_records_timestamp('newkey', 0)
     assert t == pytest.approx(float(time.time()), 1)
+
+
+def test_client_is_created_once(basic_settings, mocker):
+    mongo_client = mocker.patch('opmon_collector.database_manager.pymongo.MongoClient')
+    mongo_settings = dict(basic_settings['mongodb'], **{'max-pool-size': 20})
+
+    d = DatabaseManager(mongo_settings, basic_settings['xroad']['instance'], mocker.Mock())
+    assert mongo_client.call_count == 0
+
+    d.insert_data_to_raw_messages([{'test': 1}])
+    d.get_next_records_timestamp('test-server', 0)
+    d.set_next_records_timestamp('test-server', 123)
+
+    assert mongo_client.call_count == 1
+    assert mongo_client.call_args[1]['maxPoolSize'] == 20
+
+
+def test_client_is_not_pickled(basic_settings, mocker):
+    mongo_client = mocker.patch('opmon_collector.database_manager.pymongo.MongoClient')
+    d = DatabaseManager(basic_settings['mongodb'], basic_settings['xroad']['instance'], 'testlogmanager')
+    d.get_client()
+
+    copy = pickle.loads(pickle.dumps(d))
+    assert copy.mongo_uri == d.mongo_uri
+    assert copy._client is None
+
+    copy.get_client()
+    assert mongo_client.call_count == 2
+
+
+def test_client_is_recreated_in_child_process(basic_settings, mocker):
+    mongo_client = mocker.patch('opmon_collector.database_manager.pymongo.MongoClient')
+    d = DatabaseManager(basic_settings['mongodb'], basic_settings['xroad']['instance'], mocker.Mock())
+    parent_client = d.get_client()
+
+    mocker.patch('opmon_collector.database_manager.os.getpid', return_value=-1)
+    mongo_client.return_value = mocker.Mock()
+    child_client = d.get_client()
+
+    assert child_client is not parent_client
+    assert d.get_client() is child_client
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_load_next_records_timestamps(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
+    d.set_next_records_timestamp('server1', 123)
+    d.set_next_records_timestamp('server2', 456)
+
+    pointers = d.load_next_records_timestamps(['server1', 'server2', 'server3'], 100)
+
+    assert pointers['server1'] == 123
+    assert pointers['server2'] == 456
+    assert pointers['server3'] == pytest.approx(float(time.time()) - 100, abs=1)
+    # New pointers are stored
+    assert d.get_next_records_timestamp('server3', 0) == pointers['server3']
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_buffered_next_records_timestamps(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock(), pointer_flush_interval=3600)
+    collection = pymongo.MongoClient(d.mongo_uri)[d.db_collector_state]['collector_pointer']
+
+    d.set_next_records_timestamp('server1', 123)
+    d.set_next_records_timestamp('server2', 456)
+    d.set_next_records_timestamp('server1', 789)
+    assert collection.count_documents({}) == 0
+
+    bulk_write = mocker.spy(collection.__class__, 'bulk_write')
+    d.flush_next_records_timestamps()
+    assert bulk_write.call_count == 1
+    assert d.get_next_records_timestamp('server1', 0) == 789
+    assert d.get_next_records_timestamp('server2', 0) == 456
+
+    d.flush_next_records_timestamps()
+    assert bulk_write.call_count == 1
+
+    # Interval has passed
+    d.pointer_flush_interval = 0.0001
+    time.sleep(0.001)
+    d.set_next_records_timestamp('server2', 1000)
+    assert d.get_next_records_timestamp('server2', 0) == 1000
+
+
+def test_failed_flush_keeps_pointers(basic_settings, mocker):
+    mongo_client = mocker.patch('opmon_collector.database_manager.pymongo.MongoClient')
+    collection = mongo_client.return_value.__getitem__.return_value.__getitem__.return_value
+    collection.bulk_write.side_effect = pymongo.errors.AutoReconnect('test error')
+
+    d = DatabaseManager(basic_settings['mongodb'], basic_settings['xroad']['instance'], mocker.Mock(), pointer_flush_interval=3600)
+    d.set_next_records_timestamp('server1', 123)
+    with pytest.raises(pymongo.errors.AutoReconnect):
+        d.flush_next_records_timestamps()
+
+    collection.bulk_write.side_effect = None
+    d.flush_next_records_timestamps()
+    operations = collection.bulk_write.call_args[0][0]
+    assert [operation._doc['$set'] for operation in operations] == [{'server': 'server1', 'records_from': 123}]
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_records_rates(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
+    d.set_next_records_timestamp('server1', 123, records_rate=2.5)
+    d.set_next_records_timestamp('server2', 456)
+
+    assert d.get_records_rates(['server1', 'server2', 'server3']) == {'server1': 2.5}
+
+    # Rate is kept when only pointer is updated
+    d.set_next_records_timestamp('server1', 789)
+    assert d.get_records_rates(['server1']) == {'server1': 2.5}
+    assert d.get_next_records_timestamp('server1', 0) == 789
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_server_health(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
+    d.set_server_health('server1', {'server': 'server1', 'failures': 1, 'open_until': None})
+    d.set_server_health('server2', {'server': 'server2', 'failures': 3, 'open_until': 1000.0})
+    d.set_server_health('server1', {'server': 'server1', 'failures': 2, 'open_until': None})
+
+    assert d.load_server_health(['server1', 'server2', 'server3']) == {
+        'server1': {'server': 'server1', 'failures': 2, 'open_until': None},
+        'server2': {'server': 'server2', 'failures': 3, 'open_until': 1000.0},
+    }
+
+
+@mongomock.patch(servers=(('defaultmongodb', 27017),))
+def test_insert_spooled_raw_messages_skips_duplicates(basic_settings, mocker):
+    mongo_settings = basic_settings['mongodb']
+    xroad_instance = basic_settings['xroad']['instance']
+
+    d = DatabaseManager(mongo_settings, xroad_instance, mocker.Mock())
+    d.insert_spooled_raw_messages([{'_id': 1, 'test': 1}])
+    d.insert_spooled_raw_messages([{'_id': 1, 'test': 1}, {'_id': 2, 'test': 2}])
+
+    items = list(d.get_client()['query_db_DEFAULT']['raw_messages'].find())
+    assert [item['_id'] for item in items] == [1, 2]
+    assert all('insertTime' in item for item in items)
@@ -0,0 +1,99 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import datetime
+import gzip
+import json
+import os
+
+import pytest
+
+from opmon_collector.documents_log_writer import DocumentsLogWriter
+
+RECORDS = [{'id': 1, 'restPath': '/path'}, {'id': 2, 'xRoadVersion': '7.6.2'}]
+
+
+def make_settings(log_dir, **collector_settings):
+    collector = {'documents-log-directory': str(log_dir)}
+    collector.update(collector_settings)
+    return {'collector': collector, 'xroad': {'instance': 'DEFAULT'}}
+
+
+def test_file_name(tmp_path):
+    writer = DocumentsLogWriter(make_settings(tmp_path), 'DEFAULT/GOV/1234/ss1/host')
+    now = datetime.datetime(2023, 4, 5)
+    assert writer.get_file_name(now) == os.path.join(str(tmp_path), 'DEFAULT', '2023', '04', '05', 'DEFAULT.GOV.1234.ss1.host.log')
+
+    writer = DocumentsLogWriter(make_settings(tmp_path, **{'documents-log-compression': 'gzip'}), 'server')
+    assert writer.get_file_name(now).endswith('server.log.gz')
+
+
+def test_write_batches(tmp_path):
+    writer = DocumentsLogWriter(make_settings(tmp_path), 'server')
+    assert writer.write(RECORDS) > 0
+    writer.write(RECORDS[:1])
+    assert writer.write([]) == 0
+
+    with open(writer.get_file_name()) as f:
+        lines = f.readlines()
+    assert [json.loads(line) for line in lines] == RECORDS + RECORDS[:1]
+
+
+def test_write_gzip(tmp_path):
+    writer = DocumentsLogWriter(make_settings(tmp_path, **{'documents-log-compression': 'gzip'}), 'server')
+    writer.write(RECORDS)
+    writer.write(RECORDS)
+
+    with gzip.open(writer.get_file_name(), 'rt') as f:
+        assert [json.loads(line) for line in f] == RECORDS + RECORDS
+
+
+def test_write_fsync(tmp_path, mocker):
+    fsync = mocker.patch('opmon_collector.documents_log_writer.os.fsync')
+    writer = DocumentsLogWriter(make_settings(tmp_path, **{'documents-log-fsync': 'batch'}), 'server')
+    writer.write(RECORDS)
+    assert fsync.call_count == 1
+
+
+def test_rotation(tmp_path):
+    settings = make_settings(tmp_path, **{'documents-log-file-size': 50, 'documents-log-max-files': 2})
+    writer = DocumentsLogWriter(settings, 'server')
+    for _ in range(4):
+        writer.write(RECORDS)
+
+    file_name = writer.get_file_name()
+    assert os.path.exists(file_name)
+    assert os.path.exists(file_name + '.1')
+    assert os.path.exists(file_name + '.2')
+    assert not os.path.exists(file_name + '.3')
+
+
+def test_invalid_settings(tmp_path, mocker):
+    with pytest.raises(ValueError):
+        DocumentsLogWriter(make_settings(tmp_path, **{'documents-log-compression': 'bz2'}), 'server')
+    with pytest.raises(ValueError):
+        DocumentsLogWriter(make_settings(tmp_path, **{'documents-log-fsync': 'always'}), 'server')
+    mocker.patch('opmon_collector.documents_log_writer.zstandard', None)
+    with pytest.raises(ValueError):
+        DocumentsLogWriter(make_settings(tmp_path, **{'documents-log-compression': 'zstd'}), 'server')
@@ -0,0 +1,91 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+from opmon_collector.metrics import MetricsWriter, merge_histograms, new_histogram, observe
+
+SETTINGS = {'collector': {}, 'xroad': {'instance': 'DEFAULT'}}
+
+
+def make_summary():
+    request_duration = new_histogram((1.0, 10.0))
+    observe(request_duration, 0.5)
+    observe(request_duration, 5.0)
+    observe(request_duration, 100.0)
+    server_stats = {'requests': 2, 'records': 100, 'bytes': 1000, 'request_time': 1.5, 'parse_time': 0.5,
+                    'sanitize_time': 0.1, 'insert_time': 0.25}
+    return {
+        'done': 1,
+        'error': 1,
+        'request_duration': request_duration,
+        'servers': [
+            dict(server_stats, server='DEFAULT/GOV/1234/ss1', success=True),
+            dict(server_stats, server='DEFAULT/GOV/"5678"/ss2', success=False),
+            dict(server_stats, server='DEFAULT/GOV/1234/ss1', success=True),
+        ],
+    }
+
+
+def test_histogram():
+    histogram = new_histogram((1.0, 10.0))
+    observe(histogram, 0.5)
+    observe(histogram, 1.0)
+    observe(histogram, 20.0)
+    assert histogram == {'buckets': [1.0, 10.0], 'counts': [2, 0], 'sum': 21.5, 'count': 3}
+
+    other = new_histogram((1.0, 10.0))
+    observe(other, 5.0)
+    merge_histograms(histogram, other)
+    assert histogram == {'buckets': [1.0, 10.0], 'counts': [2, 1], 'sum': 26.5, 'count': 4}
+
+
+def test_render():
+    writer = MetricsWriter(SETTINGS)
+    assert not writer.enabled
+    text = writer.render(make_summary(), {'DEFAULT/GOV/1234/ss1': 900.0}, 1000.0, 12.5)
+    lines = text.splitlines()
+
+    assert 'xroad_metrics_collector_run_duration_seconds{instance="DEFAULT"} 12.5' in lines
+    assert 'xroad_metrics_collector_servers{instance="DEFAULT",status="failed"} 1' in lines
+    assert 'xroad_metrics_collector_server_up{instance="DEFAULT",server="DEFAULT/GOV/1234/ss1"} 1' in lines
+    assert 'xroad_metrics_collector_server_up{instance="DEFAULT",server="DEFAULT/GOV/\\"5678\\"/ss2"} 0' in lines
+    # Re-queued server is reported once with summed statistics
+    assert 'xroad_metrics_collector_server_records{instance="DEFAULT",server="DEFAULT/GOV/1234/ss1"} 200' in lines
+    assert 'xroad_metrics_collector_pointer_lag_seconds{instance="DEFAULT",server="DEFAULT/GOV/1234/ss1"} 100.0' in lines
+    assert '# TYPE xroad_metrics_collector_request_duration_seconds histogram' in lines
+    assert 'xroad_metrics_collector_request_duration_seconds_bucket{le="1.0",instance="DEFAULT"} 1' in lines
+    assert 'xroad_metrics_collector_request_duration_seconds_bucket{le="10.0",instance="DEFAULT"} 2' in lines
+    assert 'xroad_metrics_collector_request_duration_seconds_bucket{le="+Inf",instance="DEFAULT"} 3' in lines
+    assert 'xroad_metrics_collector_request_duration_seconds_count{instance="DEFAULT"} 3' in lines
+    assert 'response_bytes_bucket' not in text
+
+
+def test_write(tmp_path):
+    metrics_file = tmp_path / 'textfile' / 'xroad_metrics_collector.prom'
+    writer = MetricsWriter({'collector': {'metrics-file': str(metrics_file)}, 'xroad': {'instance': 'DEFAULT'}})
+    assert writer.enabled
+    writer.write(make_summary(), {}, 1000.0, 1.0)
+    writer.write(make_summary(), {}, 2000.0, 1.0)
+
+    assert 'xroad_metrics_collector_last_run_timestamp_seconds{instance="DEFAULT"} 2000.0' in metrics_file.read_text()
+    assert [path.name for path in metrics_file.parent.iterdir()] == ['xroad_metrics_collector.prom']
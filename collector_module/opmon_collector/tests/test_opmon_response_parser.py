@@ -0,0 +1,130 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import json
+import os
+import pathlib
+import re
+import zlib
+
+import pytest
+
+from opmon_collector.opmon_response_parser import OpmonResponseParser, RecordsArrayDecoder
+
+RESPONSES_DIR = pathlib.Path(__file__).parent.absolute() / 'responses'
+
+
+class MockResponse:
+    def __init__(self, content, headers=None):
+        self.content = content
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+def read_response(name):
+    with open(os.path.join(RESPONSES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def expected_records(content):
+    attachment = re.search(b'content-id: <operational-monitoring-data.json.gz>\r\n\r\n(.+)\r\n--xroad', content, re.DOTALL)
+    return json.loads(zlib.decompress(attachment.group(1), zlib.MAX_WBITS | 16).decode('utf-8'))['records']
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1000, 64 * 1024])
+def test_parse_records(chunk_size):
+    content = read_response('metrics_response1.dat')
+    response = MockResponse(content)
+
+    with OpmonResponseParser(response, chunk_size) as parser:
+        soap_part = parser.read_soap_part()
+        records = list(parser.records())
+
+    assert response.closed
+    assert soap_part.startswith(b'<?xml')
+    assert soap_part.rstrip().endswith(b'</SOAP-ENV:Envelope>')
+    assert b'<om:nextRecordsFrom>1604420300</om:nextRecordsFrom>' in soap_part
+    assert len(records) == 5230
+    assert records == expected_records(content)
+    assert parser.bytes_read == len(content)
+
+
+def test_parse_empty_records():
+    parser = OpmonResponseParser(MockResponse(read_response('metrics_response2.dat')))
+    assert b'<om:recordsCount>0</om:recordsCount>' in parser.read_soap_part()
+    assert list(parser.records()) == []
+
+
+def test_parse_boundary_from_content_type():
+    content = read_response('metrics_response1.dat')
+    boundary = content[2:content.find(b'\r\n')].decode('ascii')
+    headers = {'Content-Type': f'multipart/related; type="text/xml"; charset=UTF-8; boundary={boundary}'}
+    parser = OpmonResponseParser(MockResponse(b'preamble\r\n' + content, headers), 100)
+
+    assert b'<om:recordsCount>5230</om:recordsCount>' in parser.read_soap_part()
+    assert len(list(parser.records())) == 5230
+
+
+def test_parse_soap_fault():
+    content = read_response('metrics_client_proxy_ssl_auth_failed.dat')
+    parser = OpmonResponseParser(MockResponse(content), 16)
+
+    assert parser.read_soap_part() == content
+    with pytest.raises(FileNotFoundError):
+        list(parser.records())
+
+
+def test_parse_truncated_attachment():
+    content = read_response('metrics_response1.dat')
+    parser = OpmonResponseParser(MockResponse(content[:len(content) // 2]))
+    parser.read_soap_part()
+
+    with pytest.raises(zlib.error):
+        list(parser.records())
+
+
+def test_records_array_decoder():
+    document = json.dumps({'records': [{'id': 1, 'text': 'a,]}'}, {'id': 2, 'nested': {'list': [1, 2]}}, {'id': 3}]})
+    decoder = RecordsArrayDecoder()
+    records = []
+    for char in document:
+        records.extend(decoder.feed(char))
+    decoder.close()
+
+    assert [record['id'] for record in records] == [1, 2, 3]
+    assert records[0]['text'] == 'a,]}'
+
+
+def test_records_array_decoder_incomplete():
+    decoder = RecordsArrayDecoder()
+    assert decoder.feed('{"records": [{"id": 1}, {"id"') == [{'id': 1}]
+    with pytest.raises(ValueError):
+        decoder.close()
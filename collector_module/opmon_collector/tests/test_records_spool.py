@@ -0,0 +1,100 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import os
+
+import pytest
+from bson import ObjectId
+
+from opmon_collector.records_spool import RecordsSpool, SpoolDrainer
+
+RECORDS = [{'id': 1}, {'id': 2}, {'id': 3}]
+
+
+def test_append_and_read(tmp_path):
+    spool = RecordsSpool(str(tmp_path), 'DEFAULT')
+    segment = spool.append('DEFAULT/GOV/1234/ss1', RECORDS)
+
+    assert os.path.dirname(segment) == os.path.join(str(tmp_path), 'DEFAULT', 'DEFAULT.GOV.1234.ss1')
+    assert spool.segments() == [segment]
+    records = spool.read_segment(segment)
+    assert [record['id'] for record in records] == [1, 2, 3]
+    assert all(isinstance(record['_id'], ObjectId) for record in records)
+    assert len({record['_id'] for record in records}) == 3
+    assert '_id' not in RECORDS[0]
+
+
+def test_segments_skip_incomplete(tmp_path):
+    spool = RecordsSpool(str(tmp_path), 'DEFAULT')
+    assert spool.segments() == []
+    first = spool.append('server1', RECORDS)
+    second = spool.append('server1', RECORDS)
+    open(os.path.join(os.path.dirname(first), '.tmp-incomplete.jsonl'), 'w').close()
+
+    assert spool.segments() == [first, second]
+
+
+def test_drain(tmp_path, mocker):
+    server_m = mocker.Mock()
+    spool = RecordsSpool(str(tmp_path), 'DEFAULT')
+    spool.append('server1', RECORDS)
+    spool.append('server2', RECORDS)
+    spool.append('server2', RECORDS[:1])
+
+    assert spool.drain(server_m, batch_size=5) == 7
+    assert [len(call[0][0]) for call in server_m.insert_spooled_raw_messages.call_args_list] == [6, 1]
+    assert spool.segments() == []
+
+
+def test_failed_drain_keeps_segments(tmp_path, mocker):
+    server_m = mocker.Mock()
+    server_m.insert_spooled_raw_messages.side_effect = [None, ConnectionError('db down')]
+    spool = RecordsSpool(str(tmp_path), 'DEFAULT')
+    spool.append('server1', RECORDS)
+    remaining = spool.append('server2', RECORDS)
+
+    with pytest.raises(ConnectionError):
+        spool.drain(server_m, batch_size=1)
+    assert spool.segments() == [remaining]
+
+
+def test_spool_drainer(tmp_path, mocker):
+    server_m = mocker.Mock()
+    logger_m = mocker.Mock()
+    spool = RecordsSpool(str(tmp_path), 'DEFAULT')
+    spool.append('server1', RECORDS)
+
+    drainer = SpoolDrainer(spool, server_m, logger_m, interval=60)
+    drainer.start()
+    spool.append('server1', RECORDS)
+
+    assert drainer.stop() is True
+    assert drainer.inserted == 6
+    assert spool.segments() == []
+
+    server_m.insert_spooled_raw_messages.side_effect = ConnectionError('db down')
+    spool.append('server1', RECORDS)
+    assert drainer.drain() is False
+    logger_m.log_warning.assert_called_once()
+    assert len(spool.segments()) == 1
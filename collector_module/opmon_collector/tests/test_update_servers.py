@@ -57,8 +57,18 @@ def cleanup_test_pid_files():
 def test_update_database_server_list(mock_clients, basic_settings):
     updater.update_database_server_list(basic_settings)
     cs_client, db_client = mock_clients
-    cs_client.get_security_servers.assert_called_once_with()
-    db_client.save_server_list_to_database.assert_called_once_with([1, 2, 3])
+    cs_client.get_security_servers.assert_called_once_with(db_client.get_shared_params_location.return_value)
+    db_client.save_server_list_to_database.assert_called_once_with([1, 2, 3], cs_client.shared_params_location)
+
+
+def test_update_database_server_list_not_changed(mocker, mock_clients, basic_settings):
+    mocker.patch('opmon_collector.update_servers.OpmonPidFileHandler')
+    cs_client, db_client = mock_clients
+    cs_client.get_security_servers.return_value = None
+    updater.update_database_server_list(basic_settings)
+
+    db_client.touch_server_list.assert_called_once_with()
+    db_client.save_server_list_to_database.assert_not_called()
 
 
 def test_update_database_server_list_with_existing_pid_file(mock_clients, basic_settings):
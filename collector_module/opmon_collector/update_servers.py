@@ -48,9 +48,12 @@ def update_database_server_list(settings):
         raise e
 
     cs_client, db_client = _init_clients(settings, logger_m)
-    server_list = cs_client.get_security_servers()
-    if len(server_list):
-        db_client.save_server_list_to_database(server_list)
+    server_list = cs_client.get_security_servers(db_client.get_shared_params_location())
+    if server_list is None:
+        db_client.touch_server_list()
+        logger_m.log_info('update_database_server_list', '- Shared parameters not changed, server list is up to date.')
+    elif len(server_list):
+        db_client.save_server_list_to_database(server_list, cs_client.shared_params_location)
         logger_m.log_info(
             'update_database_server_list',
             '- Total of {0} inserted into server_list collection.'.format(len(server_list))
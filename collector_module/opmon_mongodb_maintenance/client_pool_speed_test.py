@@ -0,0 +1,133 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Compare collector database access with a new MongoClient per call and with a pooled MongoClient.
+
+Every simulated batch reads the collector pointer, inserts records into raw_messages and writes the pointer,
+like the collector does for each batch. Test data is written to a temporary database which is dropped afterwards.
+
+Usage example:
+
+> python client_pool_speed_test.py root --auth admin --host 127.0.0.1:27017 --batches 100 --records 100
+
+"""
+
+import argparse
+import getpass
+import time
+import urllib.parse
+from unittest.mock import Mock
+
+import pymongo
+from tqdm import tqdm
+
+from opmon_collector.database_manager import DatabaseManager
+
+TEST_INSTANCE = 'CLIENT_POOL_SPEED_TEST'
+TEST_SERVER = 'speed-test-server'
+
+
+def unpooled_batch(uri, db_manager, records):
+    """ Database calls of one batch, every call creates a new MongoClient. """
+    client = pymongo.MongoClient(uri, **db_manager.connect_args)
+    client[db_manager.db_collector_state]['collector_pointer'].find_one({'server': TEST_SERVER})
+    client.close()
+
+    client = pymongo.MongoClient(uri, **db_manager.connect_args)
+    client[db_manager.db_name]['raw_messages'].insert_many(records)
+    client.close()
+
+    client = pymongo.MongoClient(uri, **db_manager.connect_args)
+    client[db_manager.db_collector_state]['collector_pointer'].find_one_and_update(
+        {'server': TEST_SERVER}, {'$set': {'records_from': time.time()}}, upsert=True
+    )
+    client.close()
+
+
+def pooled_batch(db_manager, records):
+    """ Database calls of one batch using the pooled client of DatabaseManager. """
+    db_manager.get_next_records_timestamp(TEST_SERVER, 0)
+    db_manager.insert_data_to_raw_messages(records)
+    db_manager.set_next_records_timestamp(TEST_SERVER, time.time())
+
+
+def run_batches(name, batch_function, batches, records_per_batch):
+    tick = time.time()
+    for _ in tqdm(range(batches), desc=name):
+        records = [{'speedTest': True, 'index': i} for i in range(records_per_batch)]
+        batch_function(records)
+    elapsed = time.time() - tick
+    print('--- {0}: {1:.2f} batches/sec, {2:.2f} ms/batch'.format(name, batches / elapsed, 1000 * elapsed / batches))
+    return elapsed
+
+
+def client_pool_speed_test(uri, mongo_settings, batches, records_per_batch):
+    db_manager = DatabaseManager(mongo_settings, TEST_INSTANCE, Mock())
+    db_manager.mongo_uri = uri
+    try:
+        unpooled = run_batches(
+            'New client per call', lambda records: unpooled_batch(uri, db_manager, records), batches, records_per_batch
+        )
+        pooled = run_batches(
+            'Pooled client', lambda records: pooled_batch(db_manager, records), batches, records_per_batch
+        )
+        print('--- Saving per batch: {0:.2f} ms ({1:.1f}x faster)'.format(
+            1000 * (unpooled - pooled) / batches, unpooled / pooled
+        ))
+    finally:
+        client = db_manager.get_client()
+        client.drop_database(db_manager.db_name)
+        client.drop_database(db_manager.db_collector_state)
+        db_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MongoDB script')
+    parser.add_argument('MONGODB_USER', metavar="MONGODB_USER", type=str, help="MongoDB Database user")
+    parser.add_argument('--password', dest='mdb_pwd', help='MongoDB Password', default=None)
+    parser.add_argument('--auth', dest='auth_db', help='Authorization Database', default='admin')
+    parser.add_argument('--host', dest='mdb_host', help='MongoDB host (default: %(default)s)',
+                        default='127.0.0.1:27017')
+    parser.add_argument('--tls', dest='tls', help='Use TLS connection', action='store_true')
+    parser.add_argument('--batches', dest='batches', type=int, help='Number of batches (default: %(default)s)',
+                        default=100)
+    parser.add_argument('--records', dest='records', type=int, help='Records per batch (default: %(default)s)',
+                        default=100)
+
+    args = parser.parse_args()
+    # Get user password to access MongoDB
+    mdb_pwd = args.mdb_pwd
+    if mdb_pwd is None:
+        mdb_pwd = getpass.getpass('Password:')
+
+    uri = "mongodb://{0}:{1}@{2}/{3}".format(
+        args.MONGODB_USER, urllib.parse.quote(mdb_pwd, safe=''), args.mdb_host, args.auth_db
+    )
+    mongo_settings = {'user': args.MONGODB_USER, 'password': mdb_pwd, 'host': args.mdb_host, 'tls': args.tls}
+
+    print('* Collector database access speed, {0} batches of {1} records:'.format(args.batches, args.records))
+    client_pool_speed_test(uri, mongo_settings, args.batches, args.records)
+
+
+if __name__ == '__main__':
+    main()
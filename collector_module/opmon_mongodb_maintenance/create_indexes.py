@@ -81,7 +81,14 @@ indexRequests = [
     IndexRequest('collector_state',
                  'server_list',
                  [
-                     IndexModel([('timestamp', ASC)])
+                     IndexModel([('timestamp', ASC)]),
+                     IndexModel([('collector_id', ASC), ('current', ASC)])
+                 ]),
+
+    IndexRequest('collector_state',
+                 'server_list_history',
+                 [
+                     IndexModel([('collector_id', ASC), ('timestamp', ASC)])
                  ]),
 
     IndexRequest('reports_state',
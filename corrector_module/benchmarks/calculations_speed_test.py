@@ -0,0 +1,137 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Corrector calculation benchmark.
+
+Compares the calculation stage of the corrector for matched client and producer pairs:
+  document - DocumentManager.apply_calculations, one document at a time
+  batch    - DocumentManager.apply_calculations_batch, chunk-size documents at a time
+
+Both paths get identical copies of the generated pairs and the results are checked to be equal.
+Copying the pairs is not included in the measured time.
+
+Usage example:
+
+> cd corrector_module
+> PYTHONPATH=. python benchmarks/calculations_speed_test.py --pairs 100000 --chunk-size 100
+
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from copy import deepcopy
+
+from opmon_corrector.document_manager import DocumentManager
+
+CALC_SETTINGS = (
+    'total-duration', 'client-request-duration', 'client-response-duration', 'producer-duration-client-view',
+    'producer-duration-producer-view', 'producer-request-duration', 'producer-response-duration',
+    'producer-is-duration', 'request-nw-duration', 'response-nw-duration', 'request-size', 'response-size'
+)
+
+
+def build_settings(work_dir):
+    return {
+        'corrector': {
+            'calc': {setting: True for setting in CALC_SETTINGS},
+            'time-window': 600000,
+            'comparison-list': [],
+            'comparison_list_orphan': [],
+        },
+        'xroad': {'instance': 'CORRECTOR_SPEED_TEST'},
+        'logger': {
+            'name': 'corrector', 'module': 'corrector', 'level': 'INFO',
+            'log-path': work_dir, 'heartbeat-path': work_dir,
+        },
+    }
+
+
+def generate_member(request_in_ts):
+    attachments = random.choice([0, 0, 0, 1])
+    return {
+        'requestInTs': request_in_ts,
+        'requestOutTs': request_in_ts + random.randint(0, 50),
+        'responseInTs': request_in_ts + random.randint(50, 1000),
+        'responseOutTs': request_in_ts + random.randint(1000, 1100),
+        'requestSize': random.randint(100, 10000),
+        'requestMimeSize': random.randint(10000, 100000),
+        'requestAttachmentCount': attachments,
+        'responseSize': random.randint(100, 10000),
+        'responseMimeSize': random.randint(10000, 100000),
+        'responseAttachmentCount': attachments,
+    }
+
+
+def generate_pairs(count):
+    pairs = []
+    for _ in range(count):
+        request_in_ts = random.randint(1600000000000, 1700000000000)
+        pairs.append({
+            'client': generate_member(request_in_ts),
+            'producer': generate_member(request_in_ts + random.randint(0, 50)),
+            'xRequestId': '',
+        })
+    return pairs
+
+
+def measure_document(doc_m, documents):
+    start_time = time.time()
+    results = [doc_m.apply_calculations(doc) for doc in documents]
+    return time.time() - start_time, results
+
+
+def measure_batch(doc_m, documents, chunk_size):
+    start_time = time.time()
+    results = []
+    for i in range(0, len(documents), chunk_size):
+        results.extend(doc_m.apply_calculations_batch(documents[i:i + chunk_size]))
+    return time.time() - start_time, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Corrector calculation benchmark')
+    parser.add_argument('--pairs', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    pairs = generate_pairs(args.pairs)
+    with tempfile.TemporaryDirectory() as work_dir:
+        doc_m = DocumentManager(build_settings(work_dir))
+        document_time, document_results = measure_document(doc_m, deepcopy(pairs))
+        batch_time, batch_results = measure_batch(doc_m, deepcopy(pairs), args.chunk_size)
+
+    if document_results != batch_results:
+        raise RuntimeError('Batch calculations differ from document calculations.')
+
+    print(f'pairs: {args.pairs}, chunk-size: {args.chunk_size}')
+    print(f'document: {1000 * document_time:.1f} ms')
+    print(f'batch:    {1000 * batch_time:.1f} ms')
+    print(f'speedup:  {document_time / batch_time:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
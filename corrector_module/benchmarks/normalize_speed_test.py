@@ -0,0 +1,134 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Corrector raw document normalization benchmark.
+
+Compares sanitizing and structure correction of raw documents:
+  previous  - sanitize_document and correct_structure as they were before normalize_document: a translation
+              table built for every string value and a loop over all must_fields
+  normalize - DocumentManager.normalize_document
+
+The sample is built from the raw_messages test fixtures of the corrector, repeated to the requested size.
+Every path gets its own copy of the sample and the results are checked to be equal.
+
+Usage example:
+
+> cd corrector_module
+> PYTHONPATH=. python benchmarks/normalize_speed_test.py --documents 100000
+
+"""
+
+import argparse
+import json
+import pathlib
+import tempfile
+import time
+from copy import deepcopy
+
+from opmon_corrector.document_manager import DocumentManager
+
+FIXTURES = pathlib.Path(__file__).parent.parent / 'opmon_corrector' / 'tests' / 'fixtures'
+
+
+def build_settings(work_dir):
+    return {
+        'corrector': {
+            'calc': {},
+            'time-window': 600000,
+            'comparison-list': [],
+            'comparison_list_orphan': [],
+        },
+        'xroad': {'instance': 'CORRECTOR_SPEED_TEST'},
+        'logger': {
+            'name': 'corrector', 'module': 'corrector', 'level': 'INFO',
+            'log-path': work_dir, 'heartbeat-path': work_dir,
+        },
+    }
+
+
+def load_sample(count):
+    documents = []
+    for path in sorted(FIXTURES.glob('raw_messages_*.json')):
+        with open(path) as f:
+            documents.extend(json.load(f))
+    for document in documents:
+        document.pop('_id', None)
+    return [deepcopy(documents[i % len(documents)]) for i in range(count)]
+
+
+def previous_escape_html(value):
+    return value.translate(str.maketrans({'<': '&lt;', '>': '&gt;', '&': '&amp;'}))
+
+
+def previous_normalize(doc_m, document):
+    doc = {
+        key: previous_escape_html(value) if isinstance(value, str) else value
+        for key, value in document.items()
+    }
+
+    if 'requestSize' not in doc:
+        doc['requestSize'] = doc.get('requestSoapSize') or doc.get('requestRestSize')
+
+    if 'responseSize' not in doc:
+        doc['responseSize'] = doc.get('responseSoapSize') or doc.get('responseRestSize')
+
+    if 'serviceType' not in doc and doc.get('responseSoapSize') is not None:
+        doc['serviceType'] = 'WSDL'
+
+    if 'serviceType' not in doc and doc.get('responseRestSize') is not None:
+        doc['serviceType'] = 'REST'
+
+    for f in doc_m.must_fields:
+        if f not in doc:
+            doc[f] = None
+    return doc
+
+
+def measure(normalize, documents):
+    start_time = time.time()
+    results = [normalize(doc) for doc in documents]
+    return time.time() - start_time, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Corrector raw document normalization benchmark')
+    parser.add_argument('--documents', type=int, default=100000)
+    args = parser.parse_args()
+
+    sample = load_sample(args.documents)
+    with tempfile.TemporaryDirectory() as work_dir:
+        doc_m = DocumentManager(build_settings(work_dir))
+        previous_time, previous_results = measure(lambda doc: previous_normalize(doc_m, doc), deepcopy(sample))
+        normalize_time, normalize_results = measure(doc_m.normalize_document, deepcopy(sample))
+
+    if previous_results != normalize_results:
+        raise RuntimeError('Normalized documents differ from the previous implementation.')
+
+    print(f'documents: {args.documents}')
+    print(f'previous:  {1000 * previous_time:.1f} ms')
+    print(f'normalize: {1000 * normalize_time:.1f} ms')
+    print(f'speedup:   {previous_time / normalize_time:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+""" Corrector worker startup benchmark.
+
+Measures the time spent per corrector batch on starting workers:
+  spawn - like before the worker pool: per batch one batch process and a Manager, and then for every job
+          thread-count worker processes that create their DatabaseManager and LoggerManager
+  pool  - the long-lived worker pool of correctord: every job is dispatched as task messages to running workers
+
+Jobs carry no work, so the reported time is the overhead of a batch with two jobs (consume and faulty).
+Pool jobs are dispatched as empty faulty tasks, which do not touch the database.
+MongoDB connections are created lazily, so no MongoDB server is needed; connecting to MongoDB adds to the spawn time
+in production.
+
+Usage example:
+
+> cd corrector_module
+> PYTHONPATH=. python benchmarks/worker_pool_speed_test.py --thread-count 8 --batches 20
+
+"""
+
+import argparse
+import multiprocessing
+import tempfile
+import time
+
+from opmon_corrector.corrector_worker import CorrectorWorker
+from opmon_corrector.logger_manager import LoggerManager
+from opmon_corrector.worker_pool import CorrectorWorkerPool
+
+JOB_TYPES = ('consume', 'faulty')
+
+
+def build_settings(args, work_dir):
+    return {
+        'corrector': {
+            'thread-count': args.thread_count,
+            'calc': {},
+            'time-window': 600000,
+            'comparison-list': [],
+            'comparison_list_orphan': [],
+        },
+        'xroad': {'instance': 'CORRECTOR_SPEED_TEST'},
+        'mongodb': {'host': args.host, 'user': 'benchmark', 'password': 'benchmark'},
+        'logger': {
+            'name': 'corrector', 'module': 'corrector', 'level': 'INFO',
+            'log-path': work_dir, 'heartbeat-path': work_dir,
+        },
+    }
+
+
+def run_spawned_job(settings, job_type):
+    pool = []
+    for i in range(settings['corrector']['thread-count']):
+        worker = CorrectorWorker(settings, f'worker_{i}')
+        pool.append(multiprocessing.Process(target=worker.start))
+    for p in pool:
+        p.start()
+    for p in pool:
+        p.join()
+
+
+def run_spawned_batch(settings):
+    for job_type in JOB_TYPES:
+        run_spawned_job(settings, job_type)
+
+
+def measure_spawn(settings, batches):
+    start_time = time.time()
+    for _ in range(batches):
+        manager = multiprocessing.Manager()
+        p = multiprocessing.Process(target=run_spawned_batch, args=(settings,))
+        p.start()
+        p.join()
+        manager.shutdown()
+    return (time.time() - start_time) / batches
+
+
+def measure_pool(settings, batches):
+    logger_m = LoggerManager(settings['logger'], settings['xroad']['instance'], '')
+    pool = CorrectorWorkerPool(settings, logger_m)
+    startup_time = pool.start()
+    start_time = time.time()
+    for _ in range(batches):
+        for _ in JOB_TYPES:
+            pool.process([[] for _ in range(settings['corrector']['thread-count'])], 'faulty')
+    batch_time = (time.time() - start_time) / batches
+    pool.stop()
+    return startup_time, batch_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Corrector worker startup benchmark')
+    parser.add_argument('--thread-count', type=int, default=8)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--host', default='localhost', help='MongoDB host of the DatabaseManager, not contacted')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        settings = build_settings(args, work_dir)
+        spawn_time = measure_spawn(settings, args.batches)
+        startup_time, pool_time = measure_pool(settings, args.batches)
+
+    print(f'thread-count: {args.thread_count}, batches: {args.batches}')
+    print(f'spawn: {1000 * spawn_time:.1f} ms per batch')
+    print(f'pool:  {1000 * pool_time:.1f} ms per batch, {1000 * startup_time:.1f} ms once at correctord start')
+    print(f'saved: {1000 * (spawn_time - pool_time):.1f} ms per batch')
+
+
+if __name__ == '__main__':
+    main()
@@ -22,21 +22,87 @@
 # THE SOFTWARE.
 #
 
-import multiprocessing
+import itertools
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from typing import Optional
 
-from opmon_corrector import database_manager, document_manager
-from opmon_corrector.corrector_worker import CorrectorWorker
+from opmon_corrector import database_manager
 from opmon_corrector.logger_manager import LoggerManager
+from opmon_corrector.shard_lease import ShardLease
+from opmon_corrector.worker_pool import CorrectorWorkerPool
 
 PROCESSING_TIME_FORMAT = '%H:%M:%S'
 
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_CURSOR_BATCH_SIZE = 1000
+DEFAULT_TIMEOUT_CHUNK_SIZE = 10000
+
+
+def group_documents_in_window(documents, window, postponed=None):
+    """
+    Groups raw documents by xRequestId while they are read.
+    Documents must be sorted by requestInTs. A group is complete when a document is read that is more than window
+    milliseconds newer than the first document of the group. Then the group is yielded and removed from memory.
+    Documents of an already yielded group are not yielded again: they are left uncorrected for the next batch,
+    so that two workers never process the same xRequestId at the same time.
+    :param documents: Iterable of raw documents sorted by requestInTs.
+    :param window: Grouping window in milliseconds.
+    :param postponed: Optional list, ids of the postponed documents are appended to it.
+    :return: Generator of (x_request_id, documents) tuples.
+    """
+    open_groups = OrderedDict()
+    closed = set()
+    for _doc in documents:
+        x_request_id = _doc.get('xRequestId')
+        if not x_request_id:
+            continue
+        request_in_ts = _doc.get('requestInTs') or 0
+
+        while open_groups:
+            first_id, (first_ts, group) = next(iter(open_groups.items()))
+            if request_in_ts - first_ts <= window:
+                break
+            del open_groups[first_id]
+            closed.add(first_id)
+            yield first_id, group
+
+        if x_request_id in closed:
+            if postponed is not None:
+                postponed.append(_doc['_id'])
+            continue
+        if x_request_id in open_groups:
+            open_groups[x_request_id][1].append(_doc)
+        else:
+            open_groups[x_request_id] = (request_in_ts, [_doc])
+
+    for x_request_id, (_, group) in open_groups.items():
+        yield x_request_id, group
+
+
+def chunks(iterable, size):
+    """
+    Splits iterable to lists of at most size items.
+    :param iterable: The input iterable.
+    :param size: Maximum size of one chunk.
+    :return: Generator of lists.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 
 class CorrectorBatch:
-    def __init__(self, settings, logger_m: LoggerManager):
+    def __init__(self, settings, logger_m: LoggerManager, pool: Optional[CorrectorWorkerPool] = None,
+                 lease: Optional[ShardLease] = None, db_m: Optional[database_manager.DatabaseManager] = None):
         self.settings = settings
         self.logger_m = logger_m
+        self.pool = pool
+        self.lease = lease
+        self.db_m = db_m
 
     def run(self, process_dict):
         """
@@ -52,101 +118,154 @@ class CorrectorBatch:
             # Raise exception again
             raise e
 
-    def _process_workers(self, list_to_process, duplicates, job_type='consume'):
+    def _process_workers(self, tasks, job_type='consume'):
         """
-        Processes the workers in a thread pool.
-        :param list_to_process: queue of items to be processed by the worker processes
-        :param duplicates: a shared Value object to store the number of duplicates encountered
-        during processing
-        : return: None
+        Processes the tasks in the worker pool.
+        If the batch has no worker pool, a pool is started for this call only.
+        :param tasks: iterable of tasks to be processed by the worker processes
+        :param job_type: Job type (consume / faulty)
+        :return: Returns the number of duplicates encountered during processing.
         """
-        # Configure worker
-        pool = []
-        for i in range(self.settings['corrector']['thread-count']):
-            # Configure worker
-            worker = CorrectorWorker(self.settings, f'worker_{i}')
-            p = multiprocessing.Process(
-                target=worker.run, args=(list_to_process, duplicates, job_type)
+        if self.pool is not None:
+            return self.pool.process(tasks, job_type)
+
+        pool = CorrectorWorkerPool(self.settings, self.logger_m)
+        try:
+            return pool.process(tasks, job_type)
+        finally:
+            pool.stop()
+
+    def _renew_lease(self):
+        """
+        Renews the shard lease between jobs of the batch.
+        Raises RuntimeError if the lease of the shard of the batch was lost.
+        """
+        if self.lease is None:
+            return
+        shard_index = self.lease.shard_index
+        if not self.lease.acquire() or self.lease.shard_index != shard_index:
+            raise RuntimeError('Corrector shard lease was lost during the batch.')
+
+    def _get_consume_tasks(self, db_m, limit, counters, shard_query=None):
+        """
+        Builds tasks of the consume job. Every task is a chunk of (xRequestId, raw document ids) tuples.
+        Only the fields needed for grouping are read here, workers read the raw documents of their task by id.
+        In list read mode all raw documents of the batch are read and grouped before the first task.
+        In cursor read mode raw documents are grouped within time-window while they are read from a cursor.
+        :param db_m: DatabaseManager
+        :param limit: Maximum number of raw documents to read.
+        :param counters: dict, where the number of read, queued and postponed documents is stored.
+        :param shard_query: Optional xRequestId range of the corrector shard.
+        :return: Generator of tasks.
+        """
+        corrector_settings = self.settings['corrector']
+        chunk_size = corrector_settings.get('chunk-size') or DEFAULT_CHUNK_SIZE
+        projection = database_manager.RAW_DOCUMENT_GROUPING_PROJECTION
+        postponed = []
+
+        if corrector_settings.get('read-mode', 'list') == 'cursor':
+            documents = self._count_documents(
+                db_m.iter_raw_documents(limit, DEFAULT_CURSOR_BATCH_SIZE, projection, shard_query), counters
             )
-            pool.append(p)
+            groups = group_documents_in_window(documents, corrector_settings['time-window'], postponed)
+        else:
+            cursor = db_m.get_raw_documents(limit, projection, shard_query)
+            self.logger_m.log_info('corrector_batch_raw', f'Processing {len(cursor)} raw documents.')
+            # Process documents with xRequestId
+            doc_map = defaultdict(list)
+            for _doc in self._count_documents(cursor, counters):
+                x_request_id = _doc.get('xRequestId')
+                if not x_request_id:
+                    continue
+                doc_map[x_request_id].append(_doc)
+            groups = doc_map.items()
 
-        # Starts all pool process
-        for p in pool:
-            p.start()
-        # Wait all processes to finish their jobs
-        for p in pool:
-            p.join()
+        for chunk in chunks(groups, chunk_size):
+            if self.lease is not None and self.lease.renewal_due:
+                self._renew_lease()
+            task = []
+            for x_request_id, documents in chunk:
+                task.append((x_request_id, [_doc['_id'] for _doc in documents]))
+                counters['queued'] += len(documents)
+            yield task
+        counters['postponed'] = len(postponed)
+
+    @staticmethod
+    def _count_documents(documents, counters):
+        """
+        Passes documents through and counts them to counters['read'].
+        """
+        for _doc in documents:
+            counters['read'] += 1
+            yield _doc
 
     def _batch_run(self, process_dict):
+        """
+        Runs the batch with the DatabaseManager of the batch owner.
+        If the batch has no DatabaseManager, one is created for this batch only and closed afterwards.
+        :param process_dict:
+        :return: None
+        """
+        if self.db_m is not None:
+            self._run_jobs(process_dict, self.db_m)
+            return
+
+        db_m = database_manager.DatabaseManager(self.settings)
+        try:
+            self._run_jobs(process_dict, db_m)
+        finally:
+            db_m.close()
+
+    def _run_jobs(self, process_dict, db_m):
         """
         Gets unique xRequestId's, gets documents by xRequestId, corrects documents, initializes
         workers, gets raw documents, groups by "messageId", corrects documents' structure,
         initializes workers, updates timeout documents to "done", removes duplicates from
         raw_messages.
         :param process_dict:
+        :param db_m: DatabaseManager
         :return: Returns the amount of documents still to process.
         """
         doc_len = 0
         start_processing_time = time.time()
         self.logger_m.log_heartbeat('processing', 'SUCCEEDED')
+        shard_query = self.lease.x_request_id_query() if self.lease is not None else {}
         self.logger_m.log_info(
             'corrector_batch_start',
-            'Starting corrector'
+            f'Starting corrector for xRequestIds {shard_query["xRequestId"]}' if shard_query else 'Starting corrector'
         )
-        db_m = database_manager.DatabaseManager(self.settings)
-        doc_m = document_manager.DocumentManager(self.settings)
 
         limit = self.settings['corrector']['documents-max']
-        cursor = db_m.get_raw_documents(limit)
-        self.logger_m.log_info('corrector_batch_raw', f'Processing {len(cursor)} raw documents.')
-
-        # Process documents with xRequestId
-        doc_map = defaultdict(list)
-        for _doc in cursor:
-            x_request_id = _doc.get('xRequestId')
-            if not x_request_id:
-                continue
-            doc_map[x_request_id].append(_doc)
-
-        # Build queue to be processed
-        list_to_process = multiprocessing.Queue()
-        duplicates = multiprocessing.Value('i', 0, lock=True)
-
-        for x_request_id in doc_map:
-            documents = doc_map[x_request_id]
-            data = dict()
-            data['logger_manager'] = self.logger_m
-            data['document_manager'] = doc_m
-            data['x_request_id'] = x_request_id
-            data['documents'] = documents
-            list_to_process.put(data)
-            doc_len += len(documents)
-
-        self._process_workers(list_to_process, duplicates)
-
-        if duplicates.value > 0:
+        chunk_size = self.settings['corrector'].get('chunk-size') or DEFAULT_CHUNK_SIZE
+        counters = {'read': 0, 'queued': 0, 'postponed': 0}
+
+        duplicates = self._process_workers(self._get_consume_tasks(db_m, limit, counters, shard_query))
+        doc_len += counters['queued']
+
+        if self.settings['corrector'].get('read-mode', 'list') == 'cursor':
+            self.logger_m.log_info(
+                'corrector_batch_raw',
+                f"Processed {counters['queued']} of {counters['read']} raw documents read with cursor. "
+                f"{counters['postponed']} documents postponed to next batch.")
+
+        if duplicates > 0:
             self.logger_m.log_info(
                 'corrector_batch_remove_duplicates_from_raw',
-                f'Total of {duplicates.value} duplicate documents removed from raw messages.')
+                f'Total of {duplicates} duplicate documents removed from raw messages.')
         else:
             self.logger_m.log_info(
                 'corrector_batch_remove_duplicates_from_raw',
                 'No raw documents marked to removal.')
 
         # Process documents without xRequestId
-        cursor = db_m.get_faulty_raw_documents(limit)
-        self.logger_m.log_info(
-            'corrector_batch_raw', f'Processing {len(cursor)} faulty raw documents')
-        if len(cursor) > 0:
-            doc_len += len(cursor)
-            list_to_process = multiprocessing.Queue()
-            for _doc in cursor:
-                data = dict()
-                data['logger_manager'] = self.logger_m
-                data['document_manager'] = doc_m
-                data['document'] = _doc
-                list_to_process.put(data)
-            self._process_workers(list_to_process, None, 'faulty')
+        self._renew_lease()
+        if self.lease is None or self.lease.processes_faulty_documents:
+            cursor = db_m.get_faulty_raw_documents(limit, {'_id': True})
+            self.logger_m.log_info(
+                'corrector_batch_raw', f'Processing {len(cursor)} faulty raw documents')
+            if len(cursor) > 0:
+                doc_len += len(cursor)
+                self._process_workers(chunks((_doc['_id'] for _doc in cursor), chunk_size), 'faulty')
 
         # Updating Status of older documents from processing to done
         timeout = self.settings['corrector']['timeout-days']
@@ -154,29 +273,27 @@ class CorrectorBatch:
             'corrector_batch_update_timeout',
             f'Updating timed out [{timeout} days] orphans to done.')
 
-        list_of_doc_ids_client = db_m.get_timeout_document_ids_client(timeout, limit=limit)
-        list_of_doc_ids_producer = db_m.get_timeout_document_ids_producer(timeout, limit=limit)
-        list_of_doc_ids = list_of_doc_ids_client + list_of_doc_ids_producer
-        if len(list_of_doc_ids) > 0:
-            doc_len += len(list_of_doc_ids)
-            list_to_process = multiprocessing.Queue()
-            for _doc in list_of_doc_ids:
-                list_to_process.put(_doc['_id'])
-            self._process_workers(list_to_process, None, 'timeout')
-
-        if len(list_of_doc_ids_client) > 0:
+        self._renew_lease()
+        timeout_chunk_size = self.settings['corrector'].get('timeout-chunk-size') or DEFAULT_TIMEOUT_CHUNK_SIZE
+        client_count = db_m.update_timeout_documents_to_done(
+            'client', timeout, limit=limit, chunk_size=timeout_chunk_size, shard_query=shard_query)
+        producer_count = db_m.update_timeout_documents_to_done(
+            'producer', timeout, limit=limit, chunk_size=timeout_chunk_size, shard_query=shard_query)
+        doc_len += client_count + producer_count
+
+        if client_count > 0:
             self.logger_m.log_info(
                 'corrector_batch_update_client_old_to_done',
-                f'Total of {len(list_of_doc_ids_client)} orphans from Client '
+                f'Total of {client_count} orphans from Client '
                 "updated to status 'done'.")
         else:
             self.logger_m.log_info(
                 'corrector_batch_update_client_old_to_done', 'No orphans updated to done.')
 
-        if len(list_of_doc_ids_producer) > 0:
+        if producer_count > 0:
             self.logger_m.log_info(
                 'corrector_batch_update_producer_old_to_done',
-                f'Total of {len(list_of_doc_ids_producer)} orphans from Producer '
+                f'Total of {producer_count} orphans from Producer '
                 "updated to status 'done'.")
         else:
             self.logger_m.log_info(
@@ -187,7 +304,7 @@ class CorrectorBatch:
             PROCESSING_TIME_FORMAT,
             time.gmtime(end_processing_time - start_processing_time)
         )
-        msg = [f'Number of duplicates: {duplicates.value}',
+        msg = [f'Number of duplicates: {duplicates}',
                f'Documents processed: {str(doc_len)}',
                f'Processing time: {total_time}']
 
@@ -22,12 +22,14 @@
 # THE SOFTWARE.
 #
 
-import queue
-
-from . import database_manager
+from . import database_manager, document_manager
+from .logger_manager import LoggerManager
 
 from opmon_corrector import SECURITY_SERVER_TYPE_CLIENT
 from opmon_corrector import SECURITY_SERVER_TYPE_PRODUCER
+from opmon_corrector import __version__
+
+DEFAULT_BULK_WRITE_SIZE = 1000
 
 
 class CorrectorWorker:
@@ -35,48 +37,163 @@ class CorrectorWorker:
     def __init__(self, settings, name):
         self.settings = settings
         self.db_m = None
+        self.doc_m = None
+        self.logger_m = None
         self.worker_name = name
+        # clean_data documents of the current chunk by xRequestId, None outside consume_chunk
+        self.clean_documents = None
 
-    def run(self, to_process, duplicates, job_type='consume'):
-        """ Process run entry point
-        :param to_process: Queue of documents to be processed
-        :param duplicates: Variable to hold the number of duplicates
-        :param job_type: Job type (consume / timeout)
+    def start(self):
+        """
+        Prepares the worker for processing tasks. Called once in the worker process.
         :return: None
         """
-        self.db_m = database_manager.DatabaseManager(self.settings)
+        self.db_m = database_manager.DatabaseManager(
+            self.settings,
+            self.settings['corrector'].get('bulk-write-size', DEFAULT_BULK_WRITE_SIZE)
+        )
+        self.doc_m = document_manager.DocumentManager(self.settings)
+        self.logger_m = LoggerManager(self.settings['logger'], self.settings['xroad']['instance'], __version__)
+
+    def serve(self, task_queue, result_queue):
+        """ Worker process entry point
+        Processes tasks until a None item is received. Every task is acknowledged with a (job_id, result, error) tuple.
+        :param task_queue: Queue of (job_id, job_type, task) tuples.
+        :param result_queue: Queue for task results.
+        :return: None
+        """
+        self.start()
+        while True:
+            item = task_queue.get()
+            if item is None:
+                break
+            job_id, job_type, task = item
+            try:
+                result_queue.put((job_id, self.process_task(job_type, task), None))
+            except Exception as e:
+                result_queue.put((job_id, 0, f'{self.worker_name}: {repr(e)}'))
+
+    def process_task(self, job_type, task):
+        """
+        Processes one task and writes its buffered database writes.
+        :param job_type: Job type (consume / faulty)
+        :param task: List of items of the job type.
+        :return: Returns number of duplicates found.
+        """
         try:
-            # Process queue while is not empty
-            while True:
-                data = to_process.get(True, 1)
-                if job_type == 'consume':
-                    duplicate_count = self.consume_data(data)
-                    with duplicates.get_lock():
-                        duplicates.value += duplicate_count
-                elif job_type == 'faulty':
-                    self.consume_faulty_data(data)
-                elif job_type == 'timeout':
-                    self.db_m.update_old_doc_to_done(data)
-        except queue.Empty:
-            pass
-
-    def consume_data(self, data):
-        """
-        The Corrector worker. Processes a batch of documents with the same xRequestId
-        :param data: Contains LoggerManager, DocumentManager, x_request_id and documents to be
-        processed.
+            if job_type == 'consume':
+                return self.consume_chunk(task)
+            if job_type == 'faulty':
+                for _doc in self.db_m.get_raw_documents_by_ids(task):
+                    self._run_write_group(self.consume_faulty_data, {'document': _doc})
+            return 0
+        finally:
+            self.db_m.flush_writes()
+
+    def consume_chunk(self, chunk):
+        """
+        Processes a chunk of xRequestId groups.
+        Raw documents and existing clean documents of the whole chunk are read with one query each.
+        Documents of all groups are matched first, calculations are applied to the matched documents of the whole
+        chunk at once and then the writes of every group are done.
+        A group that fails is logged and skipped, its raw documents are corrected again by the next batch.
+        :param chunk: List of (x_request_id, raw document ids) tuples.
         :return: Returns number of duplicates found.
         """
-        # Get parameters
-        # logger_manager = data['logger_manager']
-        doc_m = data['document_manager']
-        x_request_id = data['x_request_id']
-        documents = []
-        for _doc in data['documents']:
-            sanitized_doc = doc_m.sanitize_document(_doc)
-            fix_doc = doc_m.correct_structure(sanitized_doc)
-            documents.append(fix_doc)
         duplicates = 0
+        raw_documents = {
+            _doc['_id']: _doc
+            for _doc in self.db_m.get_raw_documents_by_ids([doc_id for _, doc_ids in chunk for doc_id in doc_ids])
+        }
+        self.clean_documents = self.db_m.get_clean_documents(x_request_id for x_request_id, _ in chunk)
+        groups = []
+        try:
+            for x_request_id, doc_ids in chunk:
+                try:
+                    groups.append(self._match_group({
+                        'x_request_id': x_request_id,
+                        'documents': [raw_documents[doc_id] for doc_id in doc_ids if doc_id in raw_documents]
+                    }))
+                except Exception as e:
+                    self.logger_m.log_exception('corrector_worker', f'Matching xRequestId {x_request_id} failed: {repr(e)}')
+        finally:
+            self.clean_documents = None
+        for group in self._apply_calculations(groups):
+            try:
+                duplicates += self._run_write_group(self._store_group, group)
+            except Exception as e:
+                self.logger_m.log_exception('corrector_worker', f'Storing xRequestId {group["x_request_id"]} failed: {repr(e)}')
+        return duplicates
+
+    def _apply_calculations(self, groups):
+        """
+        Applies calculations to the documents of the matched groups, for the whole chunk at once.
+        If that fails, calculations are applied document by document and the groups that fail are skipped.
+        :param groups: Groups returned by _match_group.
+        :return: Returns the groups with calculations applied.
+        """
+        try:
+            self.doc_m.apply_calculations_batch([group['document'] for group in groups if group['document'] is not None])
+            return groups
+        except Exception as e:
+            self.logger_m.log_warning('corrector_worker', f'Calculations of chunk failed, calculating documents one by one: {repr(e)}')
+
+        calculated = []
+        for group in groups:
+            try:
+                if group['document'] is not None:
+                    group['document'] = self.doc_m.apply_calculations(group['document'])
+            except Exception as e:
+                self.logger_m.log_exception('corrector_worker', f'Calculations of xRequestId {group["x_request_id"]} failed: {repr(e)}')
+                continue
+            calculated.append(group)
+        return calculated
+
+    def _clean_document_exists(self, x_request_id, document):
+        """
+        Checks if clean_data has a document of the same security server type for the xRequestId.
+        Uses the clean documents prefetched for the current chunk.
+        """
+        party = document['securityServerType'].lower()
+        return any(
+            (clean_document.get(party) or {}).get('securityServerType') == document['securityServerType']
+            for clean_document in self.clean_documents.get(x_request_id, [])
+        )
+
+    def _get_clean_document(self, document):
+        """
+        Gets the clean_data document of the xRequestId of the given document.
+        Uses the clean documents prefetched for the current chunk.
+        """
+        clean_documents = self.clean_documents.get(document['xRequestId'])
+        return clean_documents[0] if clean_documents else None
+
+    def _run_write_group(self, consume, data):
+        """
+        Runs consume for data, so that buffered database writes of data are written together.
+        Writes of a failed consume are discarded.
+        :param consume: _store_group or consume_faulty_data.
+        :param data: Data passed to consume.
+        :return: Returns the value returned by consume.
+        """
+        try:
+            result = consume(data)
+        except Exception:
+            self.db_m.discard_write_group()
+            raise
+        self.db_m.end_write_group()
+        return result
+
+    def _match_group(self, data):
+        """
+        Matches the documents of one xRequestId without writing to the database.
+        :param data: Contains x_request_id and documents to be processed.
+        :return: Returns dict with the duplicates to remove, the matched pair and the clean document to store without
+            calculations applied. Document is None if all documents are duplicates.
+        """
+        doc_m = self.doc_m
+        x_request_id = data['x_request_id']
+        documents = [doc_m.normalize_document(_doc) for _doc in data['documents']]
 
         matched_pair = {}
         clients = [
@@ -89,11 +206,11 @@ class CorrectorWorker:
         ]
 
         if clients:
-            if not self.db_m.check_clean_document_exists(x_request_id, clients[0]):
+            if not self._clean_document_exists(x_request_id, clients[0]):
                 matched_pair['client'] = clients[0]
 
         if producers:
-            if not self.db_m.check_clean_document_exists(x_request_id, producers[0]):
+            if not self._clean_document_exists(x_request_id, producers[0]):
                 matched_pair['producer'] = producers[0]
 
         docs_to_remove = [
@@ -103,7 +220,47 @@ class CorrectorWorker:
                 and doc != matched_pair.get('producer')
             )
         ]
-        for current_document in docs_to_remove:
+        group = {
+            'x_request_id': x_request_id,
+            'docs_to_remove': docs_to_remove,
+            'matched_pair': matched_pair,
+            'document': None,
+            'existing': False
+        }
+        if not matched_pair:
+            return group
+
+        # Let's find processing party in processing clean_data
+        if len(matched_pair) == 1:
+            doc = matched_pair.get('client') or matched_pair.get('producer')
+            clean_document = self._get_clean_document(doc)
+
+            if clean_document:
+                if doc['securityServerType'].lower() == SECURITY_SERVER_TYPE_CLIENT:
+                    clean_document['client'] = doc
+                else:
+                    clean_document['producer'] = doc
+                group['document'] = clean_document
+                group['existing'] = True
+                return group
+
+        group['document'] = doc_m.create_json(
+            matched_pair.get('client'), matched_pair.get('producer'), x_request_id
+        )
+        return group
+
+    def _store_group(self, group):
+        """
+        Writes the results of a matched xRequestId group, calculations must already be applied to its document.
+        :param group: Group returned by _match_group.
+        :return: Returns number of duplicates found.
+        """
+        doc_m = self.doc_m
+        x_request_id = group['x_request_id']
+        matched_pair = group['matched_pair']
+        duplicates = 0
+
+        for current_document in group['docs_to_remove']:
             self.db_m.remove_duplicate_from_raw(current_document['_id'])
             duplicates += 1
             """
@@ -120,36 +277,22 @@ class CorrectorWorker:
             or matched_pair.get('producer', {}).get('messageId') or ''
         )
 
-        # Let's find processing party in processing clean_data
-        if len(matched_pair) == 1:
-            doc = matched_pair.get('client') or matched_pair.get('producer')
-            clean_document = self.db_m.get_clean_document(doc)
+        if group['existing']:
+            clean_document = group['document']
+            if clean_document['correctorStatus'] == 'processing':
+                # Updating correctorTime value only when document is in 'processing' status
+                # Updating correctorTime value when document is in 'done' status
+                # may trigger anonymizer to insert duplicate value to opendata
+                clean_document['correctorTime'] = database_manager.get_timestamp()
+            clean_document['correctorStatus'] = 'done'
+            clean_document['matchingType'] = 'regular_pair'
+            clean_document['xRequestId'] = x_request_id
+            doc_m.correct_client_rest_path(clean_document['client'], clean_document['producer'])
+            self.db_m.update_document_clean_data(clean_document)
+            self._post_consume_raw_document(matched_pair.get('client'), matched_pair.get('producer'))
+            return duplicates
 
-            if clean_document:
-                if doc['securityServerType'].lower() == SECURITY_SERVER_TYPE_CLIENT:
-                    clean_document['client'] = doc
-                    clean_document = doc_m.apply_calculations(clean_document)
-                else:
-                    clean_document['producer'] = doc
-                    clean_document = doc_m.apply_calculations(clean_document)
-
-                if clean_document['correctorStatus'] == 'processing':
-                    # Updating correctorTime value only when document is in 'processing' status
-                    # Updating correctorTime value when document is in 'done' status
-                    # may trigger anonymizer to insert duplicate value to opendata
-                    clean_document['correctorTime'] = database_manager.get_timestamp()
-                clean_document['correctorStatus'] = 'done'
-                clean_document['matchingType'] = 'regular_pair'
-                clean_document['xRequestId'] = x_request_id
-                doc_m.correct_client_rest_path(clean_document['client'], clean_document['producer'])
-                self.db_m.update_document_clean_data(clean_document)
-                self._post_consume_raw_document(matched_pair.get('client'), matched_pair.get('producer'))
-                return duplicates
-
-        corrected_document = doc_m.create_json(
-            matched_pair.get('client'), matched_pair.get('producer'), x_request_id
-        )
-        corrected_document = doc_m.apply_calculations(corrected_document)
+        corrected_document = group['document']
         corrected_document['correctorTime'] = database_manager.get_timestamp()
         corrected_document['correctorStatus'] = 'done' if len(matched_pair) > 1 else 'processing'
         corrected_document['matchingType'] = 'regular_pair' if len(matched_pair) > 1 else 'orphan'
@@ -163,14 +306,11 @@ class CorrectorWorker:
     def consume_faulty_data(self, data):
         """
         The Corrector worker for faulty documents without xRequestId.
-        :param data: Contains LoggerManager, DocumentManager and document to be processed.
+        :param data: Contains document to be processed.
         :return: None.
         """
-        # Get parameters
-        # logger_manager = data['logger_manager']
-        doc_m = data['document_manager']
-        sanitized_doc = doc_m.sanitize_document(data['document'])
-        fixed_doc = doc_m.correct_structure(sanitized_doc)
+        doc_m = self.doc_m
+        fixed_doc = doc_m.normalize_document(data['document'])
         producer = fixed_doc if (
             fixed_doc['securityServerType'].lower() == SECURITY_SERVER_TYPE_PRODUCER) else None
         client = fixed_doc if (
@@ -24,11 +24,14 @@
 
 import argparse
 import time
-from multiprocessing import Manager, Process
 
-from .corrector_batch import CorrectorBatch
+from .corrector_batch import DEFAULT_CHUNK_SIZE, CorrectorBatch, chunks
+from .database_manager import DatabaseManager
 from .logger_manager import LoggerManager
+from .raw_message_stream import RawMessageStream
 from .settings_parser import OpmonSettingsManager
+from .shard_lease import ShardLease
+from .worker_pool import CorrectorWorkerPool
 from . import __version__
 
 
@@ -36,33 +39,62 @@ def main():
     args = parse_args()
     settings = OpmonSettingsManager(args.profile).settings
     logger_m = LoggerManager(settings['logger'], settings['xroad']['instance'], __version__)
+    # Worker processes are started once and reused by all batches
+    pool = CorrectorWorkerPool(settings, logger_m)
+    pool.start()
+    lease = ShardLease(settings, logger_m)
+    stream = RawMessageStream(settings, logger_m) if settings['corrector'].get('change-stream') else None
+    # MongoDB client of the batches is created once and reused by all batches
+    db_m = DatabaseManager(settings)
     # Runs Corrector in infinite Loop
-    while True:
-        try:
-            process_dict = run_batch(settings, logger_m)
-            handle_results(process_dict, settings, logger_m)
-        except Exception as e:
-            logger_m.log_exception('corrector_main', f'Internal error: {repr(e)}')
-            logger_m.log_heartbeat('error', 'FAILED')
-            # If here, it is not possible to restart the processing batch. Raise exception again
-            raise e
-
-
-def run_batch(settings, logger_m: LoggerManager):
-    c_batch = CorrectorBatch(settings, logger_m)
-    manager = Manager()
-    process_dict = manager.dict()
+    try:
+        while True:
+            try:
+                process_dict = run_batch(settings, logger_m, pool, lease, db_m)
+                handle_results(process_dict, settings, logger_m, pool, lease, stream)
+            except Exception as e:
+                logger_m.log_exception('corrector_main', f'Internal error: {repr(e)}')
+                logger_m.log_heartbeat('error', 'FAILED')
+                # If here, it is not possible to restart the processing batch. Raise exception again
+                raise e
+    finally:
+        if stream is not None:
+            stream.shutdown()
+        pool.terminate()
+        lease.close()
+        db_m.close()
+
+
+def run_batch(settings, logger_m: LoggerManager, pool: CorrectorWorkerPool = None, lease: ShardLease = None,
+              db_m: DatabaseManager = None):
+    c_batch = CorrectorBatch(settings, logger_m, pool, lease, db_m)
+    process_dict = dict()
     process_dict['doc_len'] = -1
 
     print('Corrector Service [{0}] - Batch timestamp: {1}'.format(__version__, int(time.time())))
-    p = Process(target=c_batch.run, args=(process_dict,))
-    p.start()
-    p.join()
+    if lease is not None:
+        try:
+            acquired = lease.acquire()
+        except Exception as e:
+            # handle_results waits wait-on-error before trying to claim a shard again
+            logger_m.log_exception('corrector_main', f'Acquiring corrector shard lease failed: {repr(e)}')
+            return process_dict
+        if not acquired:
+            # Wait wait-on-done like after an empty batch before trying to claim a shard again
+            logger_m.log_info('corrector_main', 'All corrector shards are claimed by other corrector instances.')
+            process_dict['doc_len'] = 0
+            return process_dict
+    try:
+        c_batch.run(process_dict)
+    except Exception:
+        # CorrectorBatch.run logs the error, handle_results waits wait-on-error before next batch
+        pass
 
     return process_dict
 
 
-def handle_results(process_dict, settings, logger_m):
+def handle_results(process_dict, settings, logger_m, pool: CorrectorWorkerPool = None, lease: ShardLease = None,
+                   stream: RawMessageStream = None):
     # Wait 5 sec between successful batches to allow external kill
     wait_time = 5
 
@@ -70,6 +102,7 @@ def handle_results(process_dict, settings, logger_m):
         wait_time = settings["corrector"]["wait-on-error"]
         logger_m.log_error('corrector_main', 'Corrector batch finished with error code.')
         logger_m.log_heartbeat("error", "FAILED")
+        stream = None
 
     elif process_dict['doc_len'] < settings["corrector"]["documents-min"]:
         wait_time = settings["corrector"]["wait-on-done"]
@@ -78,10 +111,61 @@ def handle_results(process_dict, settings, logger_m):
         logger_m.log_info('corrector_main', message)
 
     logger_m.log_info('corrector_main', f'Next batch starting in {wait_time} seconds.')
-    time.sleep(wait_time)
+    if stream is not None and pool is not None:
+        run_stream(wait_time, settings, logger_m, pool, lease, stream)
+    else:
+        time.sleep(wait_time)
     logger_m.log_info('corrector_main', 'Done waiting. Next batch starting now.')
 
 
+def run_stream(wait_time, settings, logger_m: LoggerManager, pool: CorrectorWorkerPool, lease: ShardLease,
+               stream: RawMessageStream):
+    """
+    Corrects raw documents inserted while waiting for the next batch, as soon as they are released by the pairing
+    buffer of the change stream.
+    Sleeps instead if the change stream is not available or the instance does not hold a shard lease.
+    :param wait_time: Time to wait for the next batch in seconds.
+    :param settings: Corrector settings.
+    :param logger_m: The LoggerManager object.
+    :param pool: The worker pool correcting the documents.
+    :param lease: The ShardLease object of the instance.
+    :param stream: The RawMessageStream object.
+    :return: None
+    """
+    end_time = time.monotonic() + wait_time
+    chunk_size = settings['corrector'].get('chunk-size') or DEFAULT_CHUNK_SIZE
+
+    if lease is not None and lease.enabled and lease.shard_index is None:
+        stream.close()
+    else:
+        stream.open(lease.x_request_id_query() if lease is not None else {})
+
+    while stream.is_open and time.monotonic() < end_time:
+        groups = stream.wait(end_time - time.monotonic())
+        if not groups:
+            continue
+        try:
+            if lease is not None and lease.renewal_due and (
+                    not lease.acquire() or lease.x_request_id_query() != stream.shard_query):
+                # Shard was lost, documents are corrected by the instance that holds the shard
+                stream.close()
+                break
+            duplicates = pool.process(chunks(groups, chunk_size), 'consume')
+        except Exception as e:
+            # Documents that were not corrected are corrected by the next batch
+            logger_m.log_exception('corrector_change_stream', f'Correcting inserted documents failed: {repr(e)}')
+            stream.close()
+            break
+        doc_len = sum(len(doc_ids) for _, doc_ids in groups)
+        logger_m.log_info(
+            'corrector_change_stream',
+            f'Corrected {doc_len} inserted raw documents of {len(groups)} xRequestIds, {duplicates} duplicates removed.')
+
+    remaining_time = end_time - time.monotonic()
+    if remaining_time > 0:
+        time.sleep(remaining_time)
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
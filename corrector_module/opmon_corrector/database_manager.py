@@ -25,19 +25,37 @@
 Database Manager - Corrector Module
 """
 
+import os
 import time
 from datetime import datetime
 import urllib.parse
 import pymongo
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional
 
+from pymongo import DeleteOne, InsertOne, UpdateOne
 from pymongo.database import Database
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from .logger_manager import LoggerManager
 from . import __version__
 
 RAW_DATA_COLLECTION = 'raw_messages'
 CLEAN_DATA_COLLECTION = 'clean_data'
+LEASE_COLLECTION = 'corrector_leases'
+
+# Fields of raw_messages documents needed to group raw documents into worker tasks
+RAW_DOCUMENT_GROUPING_PROJECTION = {
+    'xRequestId': True,
+    'requestInTs': True,
+}
+
+# Fields of clean_data documents needed to pair raw documents, calculated fields are calculated again when pairing.
+CLEAN_DOCUMENT_PROJECTION = {
+    'xRequestId': True,
+    'client': True,
+    'producer': True,
+    'correctorStatus': True,
+}
 
 
 def json_serial(obj):
@@ -63,19 +81,49 @@ def get_timestamp():
 
 class DatabaseManager:
 
-    def __init__(self, settings: dict) -> None:
+    def __init__(self, settings: dict, write_buffer_size: int = 0) -> None:
+        """
+        :param settings: Corrector settings.
+        :param write_buffer_size: If set, clean_data and raw_messages writes are buffered and written with bulk_write
+        when at least write_buffer_size writes are pending at the end of a write group. Buffered writes must be
+        grouped with end_write_group and written with flush_writes.
+        """
         self.settings = settings
         xroad = settings['xroad']['instance']
         self.logger_m = LoggerManager(settings['logger'], xroad, __version__)
-        connect_args = {
+        self.connect_args = {
             'tls': bool(settings['mongodb'].get('tls')),
             'tlsCAFile': settings['mongodb'].get('tls-ca-file'),
         }
-        self.client: pymongo.MongoClient = pymongo.MongoClient(
-            self.get_mongo_uri(settings),
-            **connect_args
-        )
+        self._client: Optional[pymongo.MongoClient] = None
+        self._client_pid = None
         self.mdb_database = f'query_db_{xroad}'
+        self.write_buffer_size = write_buffer_size
+        self._current_group = ([], [])
+        self._pending_groups = []
+        self._pending_count = 0
+
+    def close(self) -> None:
+        """
+        Closes the MongoDB client.
+        :return: None
+        """
+        if self._client is not None and self._client_pid == os.getpid():
+            self._client.close()
+        self._client = None
+        self._client_pid = None
+
+    def get_client(self) -> pymongo.MongoClient:
+        """
+        Gets the MongoClient of the current process. Client is created on first use.
+        A new client is created if the manager is used in a forked child process, the client of the parent is not used.
+        :return: Returns the MongoClient.
+        """
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            self._client = pymongo.MongoClient(self.get_mongo_uri(self.settings), **self.connect_args)
+            self._client_pid = pid
+        return self._client
 
     @staticmethod
     def get_mongo_uri(settings: dict) -> str:
@@ -89,7 +137,7 @@ class DatabaseManager:
         Gets the specific (XRoadInstance) query database .
         :return: Returns the specific query database.
         """
-        db = self.client[self.mdb_database]
+        db = self.get_client()[self.mdb_database]
         return db
 
     def mark_as_corrected(self, document: dict) -> None:
@@ -99,6 +147,9 @@ class DatabaseManager:
         :return: None
         """
         doc_id = document['_id']
+        if self.write_buffer_size:
+            self._buffer_raw_write(UpdateOne({'_id': doc_id}, {'$set': {'corrected': True}}))
+            return
         db = self.get_query_db()
         raw_data = db[RAW_DATA_COLLECTION]
         raw_data.update_one({'_id': doc_id}, {'$set': {'corrected': True}})
@@ -111,15 +162,19 @@ class DatabaseManager:
         :return: None
         """
         doc_id = document['_id']
+        if self.write_buffer_size:
+            self._buffer_raw_write(UpdateOne({'_id': doc_id}, {'$set': {'corrected': True, 'restPath': rest_path}}))
+            return
         db = self.get_query_db()
         raw_data = db[RAW_DATA_COLLECTION]
         raw_data.update_one({'_id': doc_id}, {'$set': {'corrected': True, 'restPath': rest_path}})
 
-    def get_faulty_raw_documents(self, limit: int = 1000) -> List[dict]:
+    def get_faulty_raw_documents(self, limit: int = 1000, projection: Optional[dict] = None) -> List[dict]:
         """
         Gets number of documents specified by the limit that have not been corrected and has no xRequestId
         Sorted by "requestInTs".
         :param limit: Number of documents to return.
+        :param projection: Optional projection of the returned fields.
         :return: Returns documents sorted by "requestInTs". Number is specified by the limit.
         """
         try:
@@ -131,96 +186,142 @@ class DatabaseManager:
                 'requestInTs': {'$ne': None},
                 'securityServerType': {'$ne': None}
             }
-            cursor = raw_data.find(q).sort('requestInTs', 1).limit(limit)
+            cursor = raw_data.find(q, projection).sort('requestInTs', 1).limit(limit)
             return list(cursor)
         except Exception as e:
             self.logger_m.log_exception('DatabaseManager.get_faulty_raw_documents', repr(e))
             raise e
 
-    def get_raw_documents(self, limit: int = 1000) -> List[dict]:
+    def get_raw_documents(self, limit: int = 1000, projection: Optional[dict] = None,
+                          shard_query: Optional[dict] = None) -> List[dict]:
         """
         Gets number of documents specified by the limit that have not been corrected.
         Sorted by "requestInTs".
         :param limit: Number of documents to return.
+        :param projection: Optional projection of the returned fields.
+        :param shard_query: Optional xRequestId range of the corrector shard.
         :return: Returns documents sorted by "requestInTs". Number is specified by the limit.
         """
         try:
             db = self.get_query_db()
             raw_data = db[RAW_DATA_COLLECTION]
-            q = {'corrected': None}
-            cursor = raw_data.find(q).sort('requestInTs', 1).limit(limit)
+            q = {'corrected': None, **(shard_query or {})}
+            cursor = raw_data.find(q, projection).sort('requestInTs', 1).limit(limit)
             return list(cursor)
         except Exception as e:
             self.logger_m.log_exception('DatabaseManager.get_raw_documents', repr(e))
             raise e
 
-    def get_clean_document(self, current_doc: dict) -> Optional[dict]:
+    def iter_raw_documents(self, limit: int = 1000, batch_size: int = 1000, projection: Optional[dict] = None,
+                           shard_query: Optional[dict] = None) -> Iterator[dict]:
         """
-        Gets single clean document.
-        :param current_doc: The input document.
-        :return: Returns document".
+        Iterates over documents that have not been corrected, at most limit documents.
+        Documents are read with a cursor in batches of batch_size documents sorted by "requestInTs",
+        so that only one cursor batch is held in memory at a time.
+        :param limit: Maximum number of documents to iterate.
+        :param batch_size: Number of documents fetched from MongoDB in one cursor batch.
+        :param projection: Optional projection of the returned fields.
+        :param shard_query: Optional xRequestId range of the corrector shard.
+        :return: Returns generator of documents sorted by "requestInTs".
         """
-        q = {
-            'xRequestId': current_doc['xRequestId'],
-        }
         try:
             db = self.get_query_db()
-            clean_data = db[CLEAN_DATA_COLLECTION]
-            document = clean_data.find_one(q)
-            return document
+            raw_data = db[RAW_DATA_COLLECTION]
+            q = {'corrected': None, **(shard_query or {})}
+            cursor = raw_data.find(q, projection).sort('requestInTs', 1).limit(limit).batch_size(batch_size)
+            yield from cursor
         except Exception as e:
-            self.logger_m.log_exception('DatabaseManager.get_clean_document', repr(e))
+            self.logger_m.log_exception('DatabaseManager.iter_raw_documents', repr(e))
             raise e
 
-    def get_timeout_document_ids_client(self, timeout_days: int, limit: int = 1000) -> List[dict]:
+    def get_raw_documents_by_ids(self, document_ids: List) -> List[dict]:
         """
-        Gets the document ids (without other fields) from Client that have been processing more
-        than timeout_days.
-        :param timeout_days: The timeout days.
-        :param limit: Number of document ids to return.
-        :return: Returns the document ids that have been processing more than timeout_days.
+        Gets raw documents that have not been corrected by "_id" with one query.
+        :param document_ids: The document IDs. NB: This is not "messageId"!
+        :return: Returns documents in the order of document_ids. Documents that do not exist or have already been
+                 corrected are omitted.
+        """
+        if not document_ids:
+            return []
+        try:
+            db = self.get_query_db()
+            raw_data = db[RAW_DATA_COLLECTION]
+            cursor = raw_data.find({'_id': {'$in': document_ids}, 'corrected': None})
+            documents = {document['_id']: document for document in cursor}
+            return [documents[doc_id] for doc_id in document_ids if doc_id in documents]
+        except Exception as e:
+            self.logger_m.log_exception('DatabaseManager.get_raw_documents_by_ids', repr(e))
+            raise e
+
+    def get_clean_documents(self, x_request_ids: Iterable[str]) -> Dict[str, List[dict]]:
         """
+        Gets clean documents of many xRequestIds with one query.
+        Only fields in CLEAN_DOCUMENT_PROJECTION are returned.
+        :param x_request_ids: The xRequestIds to look up.
+        :return: Returns dict of clean document lists by xRequestId. xRequestIds without clean documents are omitted.
+        """
+        q = {
+            'xRequestId': {'$in': list(x_request_ids)},
+        }
         try:
             db = self.get_query_db()
             clean_data = db[CLEAN_DATA_COLLECTION]
-            ref_time = 1000 * (get_timestamp() - (timeout_days * 24 * 60 * 60))
-            q = {
-                'correctorStatus': 'processing',
-                'client.requestInTs': {'$lt': ref_time},
-                'client.xRequestId': {'$ne': None}
-            }
-            cursor = clean_data.find(q, {'_id': True}).limit(limit)
-            return list(cursor)
+            documents = {}
+            for document in clean_data.find(q, CLEAN_DOCUMENT_PROJECTION):
+                documents.setdefault(document['xRequestId'], []).append(document)
+            return documents
         except Exception as e:
-            self.logger_m.log_exception(
-                'DatabaseManager.get_timeout_document_ids_client', repr(e))
+            self.logger_m.log_exception('DatabaseManager.get_clean_documents', repr(e))
             raise e
 
-    def get_timeout_document_ids_producer(self, timeout_days: int, limit: int = 1000) -> List[dict]:
+    def update_timeout_documents_to_done(self, party: str, timeout_days: int, limit: int = 1000,
+                                         chunk_size: int = 10000, shard_query: Optional[dict] = None) -> int:
         """
-        Gets the document ids (without other fields) from Producer that have been processing more
-        than timeout_days.
+        Updates correctorStatus to "done" for documents of the given party that have been processing more than
+        timeout_days. Also updates the correctorTime.
+        Documents are updated on the server with update_many, one {party}.requestInTs range of about chunk_size documents
+        at a time. Ranges follow the (correctorStatus, {party}.requestInTs) index, so that no sort is done in memory.
+        A range includes all documents with its last requestInTs, so a chunk may be larger than chunk_size.
+        :param party: Party of the orphan documents, "client" or "producer".
         :param timeout_days: The timeout days.
-        :param limit: Number of document ids to return.
-        :return: Returns the document ids that have been processing more than timeout_days.
+        :param limit: Maximum number of documents to update.
+        :param chunk_size: Number of documents updated with one update_many.
+        :param shard_query: Optional xRequestId range of the corrector shard.
+        :return: Returns number of updated documents.
         """
         try:
             db = self.get_query_db()
             clean_data = db[CLEAN_DATA_COLLECTION]
             ref_time = 1000 * (get_timestamp() - (timeout_days * 24 * 60 * 60))
+            request_in_ts = f'{party}.requestInTs'
             q = {
                 'correctorStatus': 'processing',
-                # This check does not seem to be necessary.
-                # Documents with both client and producer should never be in "processing" state.
-                # 'client.requestInTs': {'$exists': False},
-                'producer.requestInTs': {'$lt': ref_time},
-                'producer.xRequestId': {'$ne': None}
+                # Documents with both client and producer should never be in "processing" state,
+                # so the producer query does not check that client is missing.
+                request_in_ts: {'$lt': ref_time},
+                f'{party}.xRequestId': {'$ne': None},
+                **(shard_query or {})
             }
-            cursor = clean_data.find(q, {'_id': True}).limit(limit)
-            return list(cursor)
+            updated = 0
+            while updated < limit:
+                size = min(chunk_size, limit - updated)
+                # Find the last requestInTs of the chunk in index order, updated documents leave the query
+                end = list(
+                    clean_data.find(q, {request_in_ts: True, '_id': False}).sort(request_in_ts, 1).skip(size - 1).limit(1)
+                )
+                chunk_query = dict(q)
+                if end:
+                    chunk_query[request_in_ts] = {'$lte': end[0][party]['requestInTs']}
+                result = clean_data.update_many(
+                    chunk_query,
+                    {'$set': {'correctorStatus': 'done', 'correctorTime': get_timestamp()}}
+                )
+                updated += result.modified_count
+                if not end or not result.modified_count:
+                    break
+            return updated
         except Exception as e:
-            self.logger_m.log_exception(
-                'DatabaseManager.get_timeout_document_ids_producer', repr(e))
+            self.logger_m.log_exception('DatabaseManager.update_timeout_documents_to_done', repr(e))
             raise e
 
     def add_to_clean_data(self, document: dict) -> None:
@@ -229,6 +330,9 @@ class DatabaseManager:
         :param document: The input document.
         :return: None
         """
+        if self.write_buffer_size:
+            self._buffer_clean_write(InsertOne(document))
+            return
         try:
             db = self.get_query_db()
             clean_data = db[CLEAN_DATA_COLLECTION]
@@ -244,6 +348,9 @@ class DatabaseManager:
         :param document: The input document.
         :return: None.
         """
+        if self.write_buffer_size:
+            self._buffer_clean_write(UpdateOne({'_id': document['_id']}, {"$set": document}))
+            return
         try:
             db = self.get_query_db()
             clean_data = db[CLEAN_DATA_COLLECTION]
@@ -252,53 +359,139 @@ class DatabaseManager:
             self.logger_m.log_exception('DatabaseManager.update_form_clean_data', repr(e))
             raise e
 
-    def update_old_doc_to_done(self, doc_id: str) -> None:
+    def remove_duplicate_from_raw(self, message_id: str) -> None:
         """
-        Updates correctorStatus to "done" for the given document. Also updates the correctorTime.
-        :param doc_id: Document "_id" to be updated.
-        :return: None.
+        Removes the duplicated document from "raw_messages".
+        :param message_id: The document ID. NB: This is not "messageId"!
+        :return: None
         """
+        if self.write_buffer_size:
+            self._buffer_raw_write(DeleteOne({'_id': message_id}))
+            return
         try:
             db = self.get_query_db()
-            clean_data = db[CLEAN_DATA_COLLECTION]
-            clean_data.update_one(
-                {'_id': doc_id},
-                {'$set': {'correctorStatus': 'done', 'correctorTime': get_timestamp()}})
+            raw_messages = db[RAW_DATA_COLLECTION]
+            raw_messages.delete_one({'_id': message_id})
         except Exception as e:
-            self.logger_m.log_exception('DatabaseManager.update_old_to_done', repr(e))
+            self.logger_m.log_exception('DatabaseManager.remove_duplicate_from_raw', repr(e))
             raise e
 
-    def check_clean_document_exists(self, x_request_id: str, document: dict) -> bool:
+    def claim_shard_lease(self, lease_id: str, owner: str, lease_time: float) -> bool:
         """
-        Checks if given document exists in clean_data or not
-        :param x_request_id: The input document xRequestId
-        :param document: The input document
-        :return: Returns true if document exists and false if not.
+        Claims or renews a corrector shard lease.
+        The lease is granted if it does not exist, has expired or is already held by the owner.
+        :param lease_id: The lease document "_id".
+        :param owner: Unique id of the corrector instance.
+        :param lease_time: Lease time in seconds.
+        :return: Returns True if the owner holds the lease.
         """
-        db = self.get_query_db()
-        clean_data = db[CLEAN_DATA_COLLECTION]
-        # client or producer
-        party = document['securityServerType'].lower()
-        result = clean_data.find(
-            {
-                f'{party}.securityServerType': document['securityServerType'],
-                'xRequestId': x_request_id,
-            }
-        )
-        if len(list(result)) > 0:
+        now = get_timestamp()
+        try:
+            db = self.get_query_db()
+            leases = db[LEASE_COLLECTION]
+            leases.find_one_and_update(
+                {'_id': lease_id, '$or': [{'owner': owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires': now + lease_time, 'renewed': now}},
+                upsert=True
+            )
             return True
-        return False
+        except DuplicateKeyError:
+            # Lease exists and is held by another owner
+            return False
+        except Exception as e:
+            self.logger_m.log_exception('DatabaseManager.claim_shard_lease', repr(e))
+            raise e
 
-    def remove_duplicate_from_raw(self, message_id: str) -> None:
+    def release_shard_lease(self, lease_id: str, owner: str) -> None:
         """
-        Removes the duplicated document from "raw_messages".
-        :param message_id: The document ID. NB: This is not "messageId"!
+        Releases a corrector shard lease held by the owner.
+        :param lease_id: The lease document "_id".
+        :param owner: Unique id of the corrector instance.
         :return: None
         """
         try:
             db = self.get_query_db()
-            raw_messages = db[RAW_DATA_COLLECTION]
-            raw_messages.delete_one({'_id': message_id})
+            leases = db[LEASE_COLLECTION]
+            leases.update_one({'_id': lease_id, 'owner': owner}, {'$set': {'expires': 0}})
         except Exception as e:
-            self.logger_m.log_exception('DatabaseManager.remove_duplicate_from_raw', repr(e))
+            self.logger_m.log_exception('DatabaseManager.release_shard_lease', repr(e))
             raise e
+
+    def _buffer_clean_write(self, operation) -> None:
+        self._current_group[0].append(operation)
+
+    def _buffer_raw_write(self, operation) -> None:
+        self._current_group[1].append(operation)
+
+    def end_write_group(self) -> None:
+        """
+        Ends the current write group and flushes buffered writes if at least write_buffer_size writes are pending.
+        Raw_messages writes of a group are written only if all clean_data writes of the same group succeeded.
+        :return: None
+        """
+        clean_writes, raw_writes = self._current_group
+        self._current_group = ([], [])
+        if not clean_writes and not raw_writes:
+            return
+        self._pending_groups.append((clean_writes, raw_writes))
+        self._pending_count += len(clean_writes) + len(raw_writes)
+        if self._pending_count >= self.write_buffer_size:
+            self.flush_writes()
+
+    def discard_write_group(self) -> None:
+        """
+        Discards buffered writes of the current, unfinished write group.
+        :return: None
+        """
+        self._current_group = ([], [])
+
+    def flush_writes(self) -> None:
+        """
+        Writes buffered writes of ended write groups with unordered bulk writes.
+        Clean_data writes are written first. Raw_messages writes of groups whose clean_data writes failed are skipped,
+        so those raw documents are not marked as corrected and are processed again by the next batch.
+        :return: None
+        """
+        groups = self._pending_groups
+        self._pending_groups = []
+        self._pending_count = 0
+        if not groups:
+            return
+
+        db = self.get_query_db()
+        clean_writes = []
+        clean_write_groups = []
+        for i, (group_clean_writes, _) in enumerate(groups):
+            clean_writes.extend(group_clean_writes)
+            clean_write_groups.extend([i] * len(group_clean_writes))
+
+        failed_groups = set()
+        errors = []
+        if clean_writes:
+            try:
+                db[CLEAN_DATA_COLLECTION].bulk_write(clean_writes, ordered=False)
+            except BulkWriteError as e:
+                failed_groups = {clean_write_groups[error['index']] for error in e.details.get('writeErrors', [])}
+                errors.append(f'{len(failed_groups)} clean_data write groups failed: {repr(e)}')
+            except Exception as e:
+                self.logger_m.log_exception('DatabaseManager.flush_writes', repr(e))
+                raise e
+
+        raw_writes = [
+            operation for i, (_, group_raw_writes) in enumerate(groups)
+            if i not in failed_groups
+            for operation in group_raw_writes
+        ]
+        if raw_writes:
+            try:
+                db[RAW_DATA_COLLECTION].bulk_write(raw_writes, ordered=False)
+            except BulkWriteError as e:
+                errors.append(f'raw_messages writes failed: {repr(e)}')
+            except Exception as e:
+                self.logger_m.log_exception('DatabaseManager.flush_writes', repr(e))
+                raise e
+
+        if errors:
+            message = ' | '.join(errors)
+            self.logger_m.log_exception('DatabaseManager.flush_writes', message)
+            raise RuntimeError(message)
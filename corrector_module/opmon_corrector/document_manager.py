@@ -28,7 +28,49 @@ Document Manager - Corrector Module
 from opmon_corrector import (SECURITY_SERVER_TYPE_CLIENT,
                              SECURITY_SERVER_TYPE_PRODUCER, __version__)
 from opmon_corrector.logger_manager import LoggerManager
-from typing import Dict, Union
+
+CALCULATION_MIN_VALUE = -2 ** 31 + 1
+CALCULATION_MAX_VALUE = 2 ** 31 - 1
+
+# Calculated fields, limited to CALCULATION_MIN_VALUE...CALCULATION_MAX_VALUE.
+CALCULATED_FIELDS = frozenset([
+    'clientSsResponseDuration',
+    'producerSsResponseDuration',
+    'requestNwDuration',
+    'totalDuration',
+    'producerDurationProducerView',
+    'responseNwDuration',
+    'producerResponseSize',
+    'producerDurationClientView',
+    'clientResponseSize',
+    'producerSsRequestDuration',
+    'clientRequestSize',
+    'clientSsRequestDuration',
+    'producerRequestSize',
+    'producerIsDuration'
+])
+
+# Durations of apply_calculations_batch: (calc setting, field, (party, minuend), (party, subtrahend)).
+DURATION_CALCULATIONS = (
+    ('total-duration', 'totalDuration', ('client', 'responseOutTs'), ('client', 'requestInTs')),
+    ('client-request-duration', 'clientSsRequestDuration', ('client', 'requestOutTs'), ('client', 'requestInTs')),
+    ('client-response-duration', 'clientSsResponseDuration', ('client', 'responseOutTs'), ('client', 'responseInTs')),
+    ('producer-duration-client-view', 'producerDurationClientView', ('client', 'responseInTs'), ('client', 'requestOutTs')),
+    ('producer-duration-producer-view', 'producerDurationProducerView', ('producer', 'responseOutTs'), ('producer', 'requestInTs')),
+    ('producer-request-duration', 'producerSsRequestDuration', ('producer', 'requestOutTs'), ('producer', 'requestInTs')),
+    ('producer-response-duration', 'producerSsResponseDuration', ('producer', 'responseOutTs'), ('producer', 'responseInTs')),
+    ('producer-is-duration', 'producerIsDuration', ('producer', 'responseInTs'), ('producer', 'requestOutTs')),
+    ('request-nw-duration', 'requestNwDuration', ('producer', 'requestInTs'), ('client', 'requestOutTs')),
+    ('response-nw-duration', 'responseNwDuration', ('client', 'responseInTs'), ('producer', 'responseOutTs')),
+)
+
+# Sizes of apply_calculations_batch: (calc setting, field, party, transaction type).
+SIZE_CALCULATIONS = (
+    ('request-size', 'clientRequestSize', 'client', 'request'),
+    ('request-size', 'producerRequestSize', 'producer', 'request'),
+    ('response-size', 'clientResponseSize', 'client', 'response'),
+    ('response-size', 'producerResponseSize', 'producer', 'response'),
+)
 
 
 class DocumentManager:
@@ -77,6 +119,7 @@ class DocumentManager:
             'faultString',
             'serviceType'
         )
+        self.must_field_set = frozenset(self.must_fields)
 
     @staticmethod
     def subtract_or_none(a, b):
@@ -189,10 +232,21 @@ class DocumentManager:
         :param value: The value to be checked.
         :return: Returns either the input value or the min_value or the max_value based on the input value.
         """
-        lo = -2 ** 31 + 1
-        hi = 2 ** 31 - 1
+        return None if value is None else max(min(value, CALCULATION_MAX_VALUE), CALCULATION_MIN_VALUE)
 
-        return None if value is None else max(min(value, hi), lo)
+    @staticmethod
+    def _limit_column(values):
+        """
+        Limits a column of calculated values like get_boundary_value.
+        :param values: The calculated values, None for missing values.
+        :return: Returns list of limited values.
+        """
+        lo = CALCULATION_MIN_VALUE
+        hi = CALCULATION_MAX_VALUE
+        return [
+            None if value is None else (hi if value > hi else (lo if value < lo else value))
+            for value in values
+        ]
 
     def _limit_calculation_values(self, document):
         """
@@ -200,27 +254,9 @@ class DocumentManager:
         :param document: The input document.
         :return: Returns the document with fixed values.
         """
-        keys_to_limit = [
-            'clientSsResponseDuration',
-            'producerSsResponseDuration',
-            'requestNwDuration',
-            'totalDuration',
-            'producerDurationProducerView',
-            'responseNwDuration',
-            'producerResponseSize',
-            'producerDurationClientView',
-            'clientResponseSize',
-            'producerSsRequestDuration',
-            'clientRequestSize',
-            'clientSsRequestDuration',
-            'producerRequestSize',
-            'producerIsDuration'
-        ]
-
-        return {
-            key: (self.get_boundary_value(value) if key in keys_to_limit else value)
-            for (key, value) in document.items()
-        }
+        for key in CALCULATED_FIELDS.intersection(document):
+            document[key] = self.get_boundary_value(document[key])
+        return document
 
     def apply_calculations(self, in_doc):
         """
@@ -234,6 +270,54 @@ class DocumentManager:
         in_doc = self._limit_calculation_values(in_doc)
         return in_doc
 
+    def apply_calculations_batch(self, documents):
+        """
+        Performs the calculations of apply_calculations for a chunk of documents.
+        Each calculated field is computed and limited for the whole chunk at once and then written to the documents.
+        :param documents: List of documents with client and producer.
+        :return: Returns the documents with the applied calculations.
+        """
+        parties = {
+            'client': [doc.get('client') or {} for doc in documents],
+            'producer': [doc.get('producer') or {} for doc in documents]
+        }
+        columns = {}
+
+        def column(party, field):
+            if (party, field) not in columns:
+                columns[(party, field)] = [member.get(field) for member in parties[party]]
+            return columns[(party, field)]
+
+        calculated = set()
+        for setting, field, (party_a, field_a), (party_b, field_b) in DURATION_CALCULATIONS:
+            if not self.calc[setting]:
+                continue
+            values = self._limit_column(
+                None if a is None or b is None else a - b
+                for a, b in zip(column(party_a, field_a), column(party_b, field_b))
+            )
+            for doc, value in zip(documents, values):
+                doc[field] = value
+            calculated.add(field)
+
+        for setting, field, party, transaction_type in SIZE_CALCULATIONS:
+            if not self.calc[setting]:
+                continue
+            values = self._limit_column(
+                self.calculate_transaction_size(member, transaction_type) for member in parties[party]
+            )
+            for doc, value in zip(documents, values):
+                doc[field] = value
+            calculated.add(field)
+
+        # Calculated fields of disabled calculations may already exist in clean documents.
+        for field in CALCULATED_FIELDS.difference(calculated):
+            for doc in documents:
+                if field in doc:
+                    doc[field] = self.get_boundary_value(doc[field])
+
+        return documents
+
     def match_documents(self, document_a, document_b, orphan=False):
         """
         Tries to match 2 regular documents.
@@ -316,8 +400,9 @@ class DocumentManager:
         :param value: The string to be escaped.
         :return: Returns escaped string.
         """
-        translation_table: Dict[str, Union[str, int, None]] = {'<': '&lt;', '>': '&gt;', '&': '&amp;'}
-        return value.translate(str.maketrans(translation_table))
+        if '&' in value or '<' in value or '>' in value:
+            return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        return value
 
     @staticmethod
     def sanitize_document(document: dict) -> dict:
@@ -326,35 +411,75 @@ class DocumentManager:
         :param document: The document to be sanitized.
         :return: Returns the sanitized document.
         """
-        sanitized_document = {
-            key: DocumentManager.escape_html(value) if isinstance(value, str) else value
+        escape_html = DocumentManager.escape_html
+        return {
+            key: escape_html(value) if isinstance(value, str) else value
             for key, value in document.items()
         }
-        return sanitized_document
 
-    def correct_structure(self, doc: dict) -> dict:
+    @staticmethod
+    def _add_heuristic_fields(doc: dict) -> int:
         """
-        Check that documents have all required fields.
-        Try to fill in missing fields by heuristics or set them to None as last resort.
-        :param doc: The input document.
-        :return: Returns the corrected document.
+        Fills in missing size and service type fields by heuristics.
+        :param doc: The input document, modified in place.
+        :return: Returns the number of fields added.
         """
-
+        added = 0
         if 'requestSize' not in doc:
             doc['requestSize'] = doc.get('requestSoapSize') or doc.get('requestRestSize')
+            added += 1
 
         if 'responseSize' not in doc:
             doc['responseSize'] = doc.get('responseSoapSize') or doc.get('responseRestSize')
+            added += 1
+
+        if 'serviceType' not in doc:
+            if doc.get('responseSoapSize') is not None:
+                doc['serviceType'] = 'WSDL'
+                added += 1
+            elif doc.get('responseRestSize') is not None:
+                doc['serviceType'] = 'REST'
+                added += 1
+        return added
 
-        if 'serviceType' not in doc and doc.get('responseSoapSize') is not None:
-            doc['serviceType'] = 'WSDL'
+    def correct_structure(self, doc: dict) -> dict:
+        """
+        Check that documents have all required fields.
+        Try to fill in missing fields by heuristics or set them to None as last resort.
+        :param doc: The input document.
+        :return: Returns the corrected document.
+        """
+        self._add_heuristic_fields(doc)
 
-        if 'serviceType' not in doc and doc.get('responseRestSize') is not None:
-            doc['serviceType'] = 'REST'
+        missing_fields = self.must_field_set.difference(doc)
+        if missing_fields:
+            for f in self.must_fields:
+                if f in missing_fields:
+                    doc[f] = None
+        return doc
 
-        for f in self.must_fields:
-            if f not in doc:
-                doc[f] = None
+    def normalize_document(self, document: dict) -> dict:
+        """
+        Sanitizes the document and corrects its structure, like correct_structure(sanitize_document(document)).
+        Fields are escaped and must_fields present in the document are counted in a single pass over the document,
+        so that missing must_fields are looked up only if the document does not have all of them.
+        :param document: The raw document.
+        :return: Returns the sanitized and corrected document.
+        """
+        escape_html = DocumentManager.escape_html
+        must_field_set = self.must_field_set
+        doc = {}
+        must_count = 0
+        for key, value in document.items():
+            doc[key] = escape_html(value) if isinstance(value, str) else value
+            if key in must_field_set:
+                must_count += 1
+
+        must_count += self._add_heuristic_fields(doc)
+        if must_count < len(self.must_fields):
+            for f in self.must_fields:
+                if f not in doc:
+                    doc[f] = None
         return doc
 
     @staticmethod
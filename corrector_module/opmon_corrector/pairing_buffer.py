@@ -0,0 +1,131 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+"""
+Pairing Buffer - Corrector Module
+"""
+
+from collections import OrderedDict
+from heapq import heapify, heappop, heappush
+from itertools import count
+from typing import List, Optional, Tuple
+
+from opmon_corrector import SECURITY_SERVER_TYPE_CLIENT, SECURITY_SERVER_TYPE_PRODUCER
+
+PAIR = frozenset([SECURITY_SERVER_TYPE_CLIENT, SECURITY_SERVER_TYPE_PRODUCER])
+
+
+class PairingBuffer:
+    """
+    Buffer of raw document ids grouped by xRequestId, that waits for the document of the other security server.
+
+    Groups with both client and producer documents are ready immediately. Groups with documents of one party only are
+    held for hold_time seconds, so that they are not written to clean_data as orphans if the partner arrives soon.
+    If more than size groups are held, the group with the oldest requestInTs is released early.
+    """
+
+    def __init__(self, size: int, hold_time: float):
+        """
+        :param size: Maximum number of held groups.
+        :param hold_time: Time in seconds a group of one party is held.
+        """
+        self.size = size
+        self.hold_time = hold_time
+        self._held = OrderedDict()
+        self._ready = OrderedDict()
+        # (requestInTs, sequence, xRequestId) of held groups, entries of released groups are skipped when popped
+        self._heap = []
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._held) + len(self._ready)
+
+    def add(self, x_request_id: str, doc_id, security_server_type: Optional[str], request_in_ts: Optional[int],
+            now: float) -> None:
+        """
+        Adds a raw document to the group of its xRequestId.
+        :param x_request_id: xRequestId of the raw document.
+        :param doc_id: The raw document "_id".
+        :param security_server_type: securityServerType of the raw document.
+        :param request_in_ts: requestInTs of the raw document.
+        :param now: Current time in seconds, time.monotonic().
+        :return: None
+        """
+        if x_request_id in self._ready:
+            self._ready[x_request_id].append(doc_id)
+            return
+
+        group = self._held.get(x_request_id)
+        if group is None:
+            group = {'held_at': now, 'sequence': next(self._sequence), 'doc_ids': [], 'parties': set()}
+            self._held[x_request_id] = group
+            heappush(self._heap, (request_in_ts or 0, group['sequence'], x_request_id))
+        group['doc_ids'].append(doc_id)
+        group['parties'].add((security_server_type or '').lower())
+
+        if PAIR.issubset(group['parties']):
+            self._release(x_request_id)
+        elif len(self._held) > self.size:
+            self._release_oldest()
+
+    def pop_ready(self, now: float) -> List[Tuple[str, list]]:
+        """
+        Removes and returns the groups that are ready for correcting: pairs, groups held for hold_time and groups
+        released because the buffer was full.
+        :param now: Current time in seconds, time.monotonic().
+        :return: Returns list of (x_request_id, raw document ids) groups.
+        """
+        while self._held:
+            x_request_id, group = next(iter(self._held.items()))
+            if now - group['held_at'] < self.hold_time:
+                break
+            self._release(x_request_id)
+        ready = list(self._ready.items())
+        self._ready = OrderedDict()
+        return ready
+
+    def clear(self) -> None:
+        """
+        Drops all groups.
+        :return: None
+        """
+        self._held = OrderedDict()
+        self._ready = OrderedDict()
+        self._heap = []
+
+    def _release(self, x_request_id: str) -> None:
+        self._ready[x_request_id] = self._held.pop(x_request_id)['doc_ids']
+        if len(self._heap) > 2 * len(self._held) + 100:
+            self._heap = [entry for entry in self._heap if self._is_held(entry)]
+            heapify(self._heap)
+
+    def _release_oldest(self) -> None:
+        while self._heap:
+            entry = heappop(self._heap)
+            if self._is_held(entry):
+                self._release(entry[2])
+                return
+
+    def _is_held(self, entry) -> bool:
+        group = self._held.get(entry[2])
+        return group is not None and group['sequence'] == entry[1]
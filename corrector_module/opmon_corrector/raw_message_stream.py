@@ -0,0 +1,175 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+"""
+Raw Message Stream - Corrector Module
+"""
+
+import time
+from typing import List, Optional, Tuple
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .database_manager import RAW_DATA_COLLECTION, DatabaseManager
+from .pairing_buffer import PairingBuffer
+
+DEFAULT_GRACE_WINDOW = 10
+DEFAULT_BUFFER_SIZE = 10000
+# Longest time in seconds a read from the change stream blocks, and interval of checking groups for the grace window
+POLL_INTERVAL = 1
+# Seconds to wait before opening the change stream again after opening failed, doubled on every further failure
+OPEN_RETRY_INTERVAL = 60
+MAX_OPEN_RETRY_INTERVAL = 3600
+# Error code of MongoDB servers that do not support change streams, for example a standalone mongod
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+
+class RawMessageStream:
+    """
+    Change stream of raw_messages inserts.
+    Ids of inserted raw documents are collected by xRequestId in a PairingBuffer, so that the groups can be corrected
+    without waiting for the next batch. Pairs are corrected immediately, groups of one party after grace-window seconds.
+    Raw documents without xRequestId are left to corrector batches.
+    """
+
+    def __init__(self, settings, logger_m, db_m: Optional[DatabaseManager] = None):
+        self.logger_m = logger_m
+        # DatabaseManager created by the stream is closed by the stream, a given one by its owner
+        self._owns_db_m = db_m is None
+        self.db_m = db_m or DatabaseManager(settings)
+        self.buffer = PairingBuffer(
+            settings['corrector'].get('change-stream-buffer-size') or DEFAULT_BUFFER_SIZE,
+            settings['corrector'].get('change-stream-grace-window') or DEFAULT_GRACE_WINDOW
+        )
+        self.shard_query = None
+        self._stream = None
+        self._checked_at = 0.0
+        self._open_failures = 0
+        self._retry_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self._stream is not None
+
+    def open(self, shard_query: Optional[dict] = None) -> bool:
+        """
+        Opens the change stream, unless it is already open for the same xRequestId range.
+        If opening fails, it is not tried again for OPEN_RETRY_INTERVAL seconds, doubled on every further failure.
+        If the MongoDB server does not support change streams, it is not tried again at all.
+        :param shard_query: Optional xRequestId range of the corrector shard.
+        :return: Returns True if the stream is open, False if change streams are not available.
+        """
+        shard_query = shard_query or {}
+        if self.is_open and shard_query == self.shard_query:
+            return True
+        self.close()
+        if time.monotonic() < self._retry_at:
+            return False
+
+        pipeline = [
+            {'$match': {
+                'operationType': 'insert',
+                'fullDocument.xRequestId': {'$ne': None, **shard_query.get('xRequestId', {})}
+            }},
+            {'$project': {
+                'fullDocument._id': True,
+                'fullDocument.xRequestId': True,
+                'fullDocument.securityServerType': True,
+                'fullDocument.requestInTs': True
+            }}
+        ]
+        try:
+            raw_data = self.db_m.get_query_db()[RAW_DATA_COLLECTION]
+            self._stream = raw_data.watch(pipeline, max_await_time_ms=1000 * POLL_INTERVAL)
+        except PyMongoError as e:
+            if isinstance(e, OperationFailure) and e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                self._retry_at = float('inf')
+                message = f'Change streams are not supported, using polling: {repr(e)}'
+            else:
+                retry_interval = min(OPEN_RETRY_INTERVAL * 2 ** self._open_failures, MAX_OPEN_RETRY_INTERVAL)
+                self._retry_at = time.monotonic() + retry_interval
+                message = f'Change stream is not available, using polling for {retry_interval} seconds: {repr(e)}'
+            # Warn only on the first failure, until the change stream is opened again
+            if not self._open_failures:
+                self.logger_m.log_warning('corrector_change_stream', message)
+            self._open_failures += 1
+            return False
+
+        self._open_failures = 0
+        self.shard_query = shard_query
+        self.logger_m.log_info('corrector_change_stream', 'Change stream of raw messages opened.')
+        return True
+
+    def close(self) -> None:
+        """
+        Closes the change stream and drops the buffered groups. Their raw documents are corrected by the next batch.
+        :return: None
+        """
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except PyMongoError:
+                pass
+        self._stream = None
+        self.shard_query = None
+        self.buffer.clear()
+
+    def shutdown(self) -> None:
+        """
+        Closes the change stream and the MongoDB client of the stream on corrector shutdown.
+        :return: None
+        """
+        try:
+            self.close()
+        finally:
+            if self._owns_db_m:
+                self.db_m.close()
+
+    def wait(self, timeout: float) -> List[Tuple[str, list]]:
+        """
+        Reads inserts from the change stream until groups are ready for correcting or timeout seconds passed.
+        If reading the change stream fails, the stream is closed.
+        :param timeout: Maximum time to wait in seconds.
+        :return: Returns list of (x_request_id, raw document ids) groups, see PairingBuffer.pop_ready.
+        """
+        end_time = time.monotonic() + timeout
+        try:
+            while self.is_open:
+                now = time.monotonic()
+                if now - self._checked_at >= POLL_INTERVAL or now >= end_time:
+                    self._checked_at = now
+                    groups = self.buffer.pop_ready(now)
+                    if groups or now >= end_time:
+                        return groups
+                event = self._stream.try_next()
+                if event is not None:
+                    document = event['fullDocument']
+                    self.buffer.add(
+                        document['xRequestId'], document['_id'], document.get('securityServerType'),
+                        document.get('requestInTs'), time.monotonic()
+                    )
+        except PyMongoError as e:
+            self.logger_m.log_warning(
+                'corrector_change_stream', f'Change stream failed, using polling: {repr(e)}')
+            self.close()
+        return []
@@ -0,0 +1,164 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+"""
+Shard Lease - Corrector Module
+"""
+
+import os
+import socket
+import time
+import uuid
+from typing import Optional, Tuple
+
+from opmon_corrector import database_manager
+from opmon_corrector.logger_manager import LoggerManager
+
+DEFAULT_SHARD_LEASE_TIME = 900
+
+# xRequestId ranges are split by the first PREFIX_LENGTH hex digits
+PREFIX_LENGTH = 4
+
+
+def get_x_request_id_range(shard_index: int, shard_count: int) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Gets the xRequestId range of a shard. xRequestIds are UUIDs, so ranges split the hex prefix space evenly.
+    The first range has no lower bound and the last range has no upper bound, so that every xRequestId,
+    also one that is not a UUID, belongs to exactly one shard.
+    :param shard_index: Index of the shard, 0 <= shard_index < shard_count.
+    :param shard_count: Number of shards.
+    :return: Returns (lower bound, upper bound) tuple. Lower bound is inclusive, upper bound exclusive, None if unbounded.
+    """
+    prefix_space = 16 ** PREFIX_LENGTH
+    lower = None if shard_index == 0 else format(shard_index * prefix_space // shard_count, f'0{PREFIX_LENGTH}x')
+    upper = None if shard_index == shard_count - 1 else format((shard_index + 1) * prefix_space // shard_count, f'0{PREFIX_LENGTH}x')
+    return lower, upper
+
+
+class ShardLease:
+    """
+    Lease of one xRequestId shard for a corrector instance.
+
+    With shard-count greater than 1, several corrector instances can run for the same X-Road instance.
+    Every instance claims a free shard by writing a lease document to MongoDB and corrects only raw documents whose
+    xRequestId belongs to the range of its shard. The lease is renewed before every corrector batch and job.
+    A lease that is not renewed in shard-lease-time seconds expires and can be claimed by another instance.
+    """
+
+    def __init__(self, settings, logger_m: LoggerManager, db_m: database_manager.DatabaseManager = None):
+        self.logger_m = logger_m
+        self.shard_count = settings['corrector'].get('shard-count') or 1
+        self.lease_time = settings['corrector'].get('shard-lease-time') or DEFAULT_SHARD_LEASE_TIME
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.shard_index = None
+        self.renewed_at = None
+        self.db_m = db_m
+        # DatabaseManager created by the lease is closed by the lease, a given one by its owner
+        self._owns_db_m = self.enabled and db_m is None
+        if self._owns_db_m:
+            self.db_m = database_manager.DatabaseManager(settings)
+
+    @property
+    def enabled(self):
+        return self.shard_count > 1
+
+    @property
+    def renewal_due(self):
+        """
+        Lease is renewed when a third of the lease time has passed since the last renewal.
+        """
+        return self.enabled and (self.renewed_at is None or time.monotonic() - self.renewed_at > self.lease_time / 3)
+
+    def acquire(self) -> bool:
+        """
+        Renews the lease of the current shard or claims a free shard.
+        :return: Returns True if the instance holds a shard lease.
+        """
+        if not self.enabled:
+            return True
+
+        if self.shard_index is not None:
+            if self.db_m.claim_shard_lease(self._lease_id(self.shard_index), self.owner, self.lease_time):
+                self.renewed_at = time.monotonic()
+                return True
+            self.logger_m.log_warning('corrector_shard_lease', f'Lease of shard {self._shard_name()} was lost.')
+            self.shard_index = None
+
+        for shard_index in range(self.shard_count):
+            if self.db_m.claim_shard_lease(self._lease_id(shard_index), self.owner, self.lease_time):
+                self.shard_index = shard_index
+                self.renewed_at = time.monotonic()
+                self.logger_m.log_info('corrector_shard_lease', f'Claimed shard {self._shard_name()}.')
+                return True
+        return False
+
+    def release(self) -> None:
+        """
+        Releases the lease of the current shard, so that another instance can claim it immediately.
+        :return: None
+        """
+        if self.enabled and self.shard_index is not None:
+            self.db_m.release_shard_lease(self._lease_id(self.shard_index), self.owner)
+            self.shard_index = None
+            self.renewed_at = None
+
+    def close(self) -> None:
+        """
+        Releases the lease and closes the MongoDB client of the lease.
+        :return: None
+        """
+        try:
+            self.release()
+        finally:
+            if self._owns_db_m:
+                self.db_m.close()
+
+    def x_request_id_query(self) -> dict:
+        """
+        Gets query of the xRequestId range of the current shard.
+        :return: Returns query dict for the xRequestId field, or empty dict if sharding is not enabled.
+        """
+        if not self.enabled:
+            return {}
+        if self.shard_index is None:
+            raise RuntimeError('Shard lease is not held.')
+        lower, upper = get_x_request_id_range(self.shard_index, self.shard_count)
+        condition = {}
+        if lower is not None:
+            condition['$gte'] = lower
+        if upper is not None:
+            condition['$lt'] = upper
+        return {'xRequestId': condition} if condition else {}
+
+    @property
+    def processes_faulty_documents(self) -> bool:
+        """
+        Documents without xRequestId are processed by the instance holding the first shard only.
+        """
+        return not self.enabled or self.shard_index == 0
+
+    def _lease_id(self, shard_index):
+        return f'shard_{shard_index}_of_{self.shard_count}'
+
+    def _shard_name(self):
+        return f'{self.shard_index + 1}/{self.shard_count}'
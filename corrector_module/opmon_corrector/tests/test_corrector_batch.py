@@ -33,18 +33,22 @@ import pymongo
 import pytest
 from freezegun import freeze_time
 
-from opmon_corrector.corrector_batch import CorrectorBatch
+from opmon_corrector.corrector_batch import CorrectorBatch, group_documents_in_window
 from opmon_corrector.corrector_worker import CorrectorWorker
+from opmon_corrector.database_manager import DatabaseManager
+from opmon_corrector.document_manager import DocumentManager
 from opmon_corrector.logger_manager import LoggerManager
 from opmon_corrector.settings_parser import OpmonSettingsManager
+from opmon_corrector.shard_lease import ShardLease
 
 TEST_DIR = os.path.abspath(os.path.dirname(__file__))
 
 
 class SingleProcessedCorrectorBatch(CorrectorBatch):
-    def _process_workers(self, list_to_process, duplicates, job_type='consume'):
+    def _process_workers(self, tasks, job_type='consume'):
         worker = CorrectorWorker(self.settings, 'worker 1')
-        worker.run(list_to_process, duplicates, job_type)
+        worker.start()
+        return sum(worker.process_task(job_type, task) for task in tasks)
 
 
 def read_data_from_json(path):
@@ -140,6 +144,81 @@ def test_corrector_batch_1(mongo, batch):
     assert len(corrected_raw_documents) == len(raw_messages)
 
 
+@freeze_time("2022-12-10")
+def test_corrector_batch_cursor_read_mode(mongo, batch, caplog):
+    caplog.set_level(logging.INFO)
+    batch.settings['corrector']['read-mode'] = 'cursor'
+    batch.settings['corrector']['chunk-size'] = 2
+    raw_messages = insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_1'))
+    batch.run({})
+
+    expected_clean_data = read_fixture('clean_data_batch_1')
+    actual_clean_data = get_documents(mongo, 'clean_data')
+    compare_documents(actual_clean_data, expected_clean_data)
+    corrected_raw_documents = get_documents(mongo, 'raw_messages', {'corrected': True})
+    assert len(corrected_raw_documents) == len(raw_messages)
+    assert '0 documents postponed to next batch' in caplog.text
+
+
+@pytest.mark.parametrize('read_mode', ['list', 'cursor'])
+def test_consume_tasks_contain_document_ids(mongo, batch, read_mode):
+    batch.settings['corrector']['read-mode'] = read_mode
+    batch.settings['corrector']['chunk-size'] = 2
+    raw_messages = insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_1'))
+    counters = {'read': 0, 'queued': 0, 'postponed': 0}
+
+    tasks = list(batch._get_consume_tasks(DatabaseManager(batch.settings), 100, counters))
+
+    ids_by_request = {}
+    for doc in raw_messages:
+        if doc.get('xRequestId'):
+            ids_by_request.setdefault(doc['xRequestId'], set()).add(doc['_id'])
+    assert all(len(task) <= 2 for task in tasks)
+    assert {x_request_id: set(ids) for task in tasks for x_request_id, ids in task} == ids_by_request
+    assert counters['queued'] == sum(len(ids) for ids in ids_by_request.values())
+
+
+@freeze_time("2022-12-10")
+def test_sharded_corrector_batches(mongo, batch):
+    batch.settings['corrector']['shard-count'] = 2
+    raw_messages = insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_1'))
+    leases = [ShardLease(batch.settings, batch.logger_m) for _ in range(2)]
+    assert all(lease.acquire() for lease in leases)
+
+    first_shard = SingleProcessedCorrectorBatch(batch.settings, batch.logger_m, lease=leases[0])
+    first_shard.run({})
+    corrected = get_documents(mongo, 'raw_messages', {'corrected': True})
+    assert 0 < len(corrected) < len(raw_messages)
+    assert all(not doc.get('xRequestId') or doc['xRequestId'] < '8000' for doc in corrected)
+
+    second_shard = SingleProcessedCorrectorBatch(batch.settings, batch.logger_m, lease=leases[1])
+    second_shard.run({})
+    assert len(get_documents(mongo, 'raw_messages', {'corrected': True})) == len(raw_messages)
+    compare_documents(get_documents(mongo, 'clean_data'), read_fixture('clean_data_batch_1'))
+
+
+def test_group_documents_in_window():
+    documents = [
+        {'_id': 1, 'xRequestId': 'a', 'requestInTs': 1000},
+        {'_id': 2, 'xRequestId': 'b', 'requestInTs': 1500},
+        {'_id': 3, 'xRequestId': None, 'requestInTs': 1600},
+        {'_id': 4, 'xRequestId': 'a', 'requestInTs': 2000},
+        {'_id': 5, 'xRequestId': 'c', 'requestInTs': 3000},
+        {'_id': 6, 'xRequestId': 'a', 'requestInTs': 3100},
+        {'_id': 7, 'xRequestId': 'b', 'requestInTs': 3200},
+    ]
+    postponed = []
+    groups = group_documents_in_window(iter(documents), 1000, postponed)
+
+    # group "a" is complete as soon as a document more than 1000 ms newer is read
+    assert next(groups) == ('a', [documents[0], documents[3]])
+    assert [(x_request_id, [d['_id'] for d in group]) for x_request_id, group in groups] == [
+        ('b', [2]), ('c', [5])
+    ]
+    # late documents of completed groups are left for the next batch
+    assert postponed == [6, 7]
+
+
 @freeze_time('2022-12-10')
 def test_correct_case_insensitive(mongo, batch):
     raw_messages = insert_fixture(
@@ -174,6 +253,69 @@ def test_corrector_batch_2(mongo, batch):
     actual_clean_data = get_documents(mongo, 'clean_data')
     compare_documents(actual_clean_data, expected_clean_data)
 
+
+@freeze_time("2022-12-10")
+def test_corrector_batch_looks_up_clean_data_once_per_chunk(mongo, batch, mocker):
+    batch.settings['corrector']['chunk-size'] = 100
+    insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_1'))
+    batch.run({})
+    insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_2'))
+
+    get_clean_documents = mocker.spy(DatabaseManager, 'get_clean_documents')
+    batch.run({})
+
+    assert get_clean_documents.call_count == 1
+    assert len(get_documents(mongo, 'clean_data', {"correctorStatus": "processing"})) == 3
+    compare_documents(get_documents(mongo, 'clean_data'), read_fixture('clean_data_after_batch_2'))
+
+
+@freeze_time("2022-12-10")
+def test_corrector_batch_applies_calculations_once_per_chunk(mongo, batch, mocker):
+    batch.settings['corrector']['chunk-size'] = 100
+    insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_1'))
+    apply_calculations = mocker.spy(DocumentManager, 'apply_calculations')
+    apply_calculations_batch = mocker.spy(DocumentManager, 'apply_calculations_batch')
+    batch.run({})
+
+    # Only faulty documents without xRequestId are calculated one by one
+    assert all(not call.args[1].get('xRequestId') for call in apply_calculations.call_args_list)
+    assert apply_calculations_batch.call_count == 1
+    compare_documents(get_documents(mongo, 'clean_data'), read_fixture('clean_data_batch_1'))
+
+
+@freeze_time("2022-12-10")
+def test_corrector_batch_skips_failing_group(mongo, batch, mocker):
+    batch.settings['corrector']['chunk-size'] = 100
+    raw_documents = insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_1'))
+    failing_id = next(doc['xRequestId'] for doc in raw_documents if doc.get('xRequestId'))
+    match_group = CorrectorWorker._match_group
+
+    def fail_one_group(worker, data):
+        if data['x_request_id'] == failing_id:
+            raise ValueError('broken group')
+        return match_group(worker, data)
+
+    mocker.patch.object(CorrectorWorker, '_match_group', fail_one_group)
+    batch.run({})
+
+    # other groups of the chunk are corrected, documents of the failing group are left for the next batch
+    expected_clean_data = [doc for doc in read_fixture('clean_data_batch_1') if doc['xRequestId'] != failing_id]
+    compare_documents(get_documents(mongo, 'clean_data'), expected_clean_data)
+    assert not get_documents(mongo, 'raw_messages', {'xRequestId': failing_id, 'corrected': True})
+
+
+@freeze_time("2022-12-10")
+def test_corrector_batch_calculates_documents_one_by_one_after_chunk_failure(mongo, batch, mocker):
+    batch.settings['corrector']['chunk-size'] = 100
+    insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_1'))
+    mocker.patch.object(DocumentManager, 'apply_calculations_batch', side_effect=ValueError('broken chunk'))
+    apply_calculations = mocker.spy(DocumentManager, 'apply_calculations')
+    batch.run({})
+
+    assert any(call.args[1].get('xRequestId') for call in apply_calculations.call_args_list)
+    compare_documents(get_documents(mongo, 'clean_data'), read_fixture('clean_data_batch_1'))
+
+
 @freeze_time("2022-12-10")
 def test_corrector_rest_path(mongo, batch):
     insert_fixture(mongo, 'raw_messages', read_fixture('raw_messages_batch_3_before_run'))
@@ -269,3 +411,17 @@ def test_corrector_batch_update_after_timeout(mongo):
     # comparing updated document with expected clean_data
     expected_clean_data = read_fixture('clean_data_after_batch_2_timeout')
     compare_documents(updated_sample_document, expected_clean_data)
+
+
+@freeze_time("2022-12-10")
+def test_corrector_batch_closes_only_own_database_manager(mongo, batch, mocker):
+    close = mocker.spy(DatabaseManager, 'close')
+    db_m = DatabaseManager(batch.settings)
+    owned = SingleProcessedCorrectorBatch(batch.settings, batch.logger_m, db_m=db_m)
+    owned.run({})
+    owned.run({})
+    assert close.call_count == 0
+
+    # Batch without DatabaseManager of the owner closes the one it created
+    batch.run({})
+    assert close.call_count == 1
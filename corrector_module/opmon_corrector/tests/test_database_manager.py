@@ -0,0 +1,151 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+import os
+import pathlib
+from logging import StreamHandler
+
+import mongomock  # type: ignore
+import pymongo
+import pytest
+from pymongo.errors import BulkWriteError
+
+from opmon_corrector.database_manager import DatabaseManager
+from opmon_corrector.settings_parser import OpmonSettingsManager
+
+
+@pytest.fixture(autouse=True)
+def mock_logger_manager(mocker):
+    mocker.patch('opmon_corrector.logger_manager.LoggerManager._create_file_handler', return_value=StreamHandler())
+
+
+@pytest.fixture
+def settings():
+    os.chdir(pathlib.Path(__file__).parent.absolute())
+    return OpmonSettingsManager('UNITTEST').settings
+
+
+@pytest.fixture
+def mongo():
+    with mongomock.patch(servers=(('mongodb', 27017),)):
+        yield pymongo.MongoClient('mongodb').query_db_UNITTEST
+
+
+def _write_group(db_m, x_request_id):
+    db_m.add_to_clean_data({'xRequestId': x_request_id})
+    db_m.mark_as_corrected({'_id': f'{x_request_id}_client'})
+    db_m.remove_duplicate_from_raw(f'{x_request_id}_duplicate')
+    db_m.end_write_group()
+
+
+def test_buffered_writes_are_flushed_in_bulk(mongo, settings):
+    mongo.raw_messages.insert_many([
+        {'_id': 'a_client'}, {'_id': 'a_duplicate'}, {'_id': 'b_client'}, {'_id': 'b_duplicate'}
+    ])
+    db_m = DatabaseManager(settings, write_buffer_size=100)
+
+    _write_group(db_m, 'a')
+    _write_group(db_m, 'b')
+    assert mongo.clean_data.count_documents({}) == 0
+
+    db_m.flush_writes()
+    assert mongo.clean_data.count_documents({}) == 2
+    assert sorted(doc['_id'] for doc in mongo.raw_messages.find({'corrected': True})) == ['a_client', 'b_client']
+    assert mongo.raw_messages.count_documents({}) == 2
+
+
+def test_buffered_writes_are_flushed_when_buffer_is_full(mongo, settings):
+    db_m = DatabaseManager(settings, write_buffer_size=3)
+
+    db_m.add_to_clean_data({'xRequestId': 'a'})
+    db_m.add_to_clean_data({'xRequestId': 'b'})
+    db_m.add_to_clean_data({'xRequestId': 'c'})
+    # writes of an unfinished group are not flushed
+    assert mongo.clean_data.count_documents({}) == 0
+    db_m.end_write_group()
+    assert mongo.clean_data.count_documents({}) == 3
+
+
+def test_failed_clean_write_does_not_mark_raw_documents_corrected(mongo, settings, mocker):
+    mongo.raw_messages.insert_many([
+        {'_id': 'a_client'}, {'_id': 'a_duplicate'}, {'_id': 'b_client'}, {'_id': 'b_duplicate'}
+    ])
+    db_m = DatabaseManager(settings, write_buffer_size=100)
+    _write_group(db_m, 'a')
+    _write_group(db_m, 'b')
+
+    bulk_write = mocker.patch.object(
+        mongomock.collection.Collection, 'bulk_write', autospec=True,
+        side_effect=[BulkWriteError({'writeErrors': [{'index': 1, 'code': 1, 'errmsg': 'failed'}]}), None]
+    )
+    with pytest.raises(RuntimeError, match='1 clean_data write groups failed'):
+        db_m.flush_writes()
+
+    raw_writes = bulk_write.call_args_list[1].args[1]
+    assert [operation._filter['_id'] for operation in raw_writes] == ['a_client', 'a_duplicate']
+
+
+def test_get_raw_documents_by_ids_keeps_order(mongo, settings):
+    mongo.raw_messages.insert_many([{'_id': i, 'requestInTs': i} for i in range(5)])
+    db_m = DatabaseManager(settings)
+
+    documents = db_m.get_raw_documents_by_ids([3, 1, 7, 4])
+    assert [doc['_id'] for doc in documents] == [3, 1, 4]
+
+
+def test_get_raw_documents_by_ids_skips_corrected_documents(mongo, settings):
+    mongo.raw_messages.insert_many([{'_id': 1}, {'_id': 2, 'corrected': True}, {'_id': 3, 'corrected': None}])
+    db_m = DatabaseManager(settings)
+
+    assert [doc['_id'] for doc in db_m.get_raw_documents_by_ids([1, 2, 3])] == [1, 3]
+    assert db_m.get_raw_documents_by_ids([]) == []
+
+
+def test_update_timeout_documents_to_done(mongo, settings, mocker):
+    old_ts = 1000 * (1700000000 - 10 * 24 * 60 * 60)
+    mongo.clean_data.insert_many(
+        [
+            {'_id': i, 'correctorStatus': 'processing', 'xRequestId': f'{i % 2}',
+             'client': {'requestInTs': old_ts - i, 'xRequestId': f'{i % 2}'}}
+            for i in range(10)
+        ] + [
+            {'_id': 10, 'correctorStatus': 'processing', 'xRequestId': '0',
+             'client': {'requestInTs': 1000 * 1700000000, 'xRequestId': '0'}},
+            {'_id': 11, 'correctorStatus': 'processing', 'xRequestId': '0',
+             'producer': {'requestInTs': old_ts, 'xRequestId': '0'}},
+        ]
+    )
+    mocker.patch('opmon_corrector.database_manager.get_timestamp', return_value=1700000000)
+    db_m = DatabaseManager(settings)
+    update_many = mocker.spy(mongo.clean_data.__class__, 'update_many')
+
+    assert db_m.update_timeout_documents_to_done('client', 3, limit=3, chunk_size=2, shard_query={'xRequestId': '0'}) == 3
+    # the oldest documents are updated first
+    assert sorted(doc['_id'] for doc in mongo.clean_data.find({'correctorStatus': 'done'})) == [4, 6, 8]
+    assert update_many.call_count == 2
+
+    assert db_m.update_timeout_documents_to_done('client', 3, limit=100, chunk_size=2) == 7
+    assert db_m.update_timeout_documents_to_done('producer', 3, limit=100, chunk_size=2) == 1
+    processing = [doc['_id'] for doc in mongo.clean_data.find({'correctorStatus': 'processing'})]
+    assert processing == [10]
+    assert mongo.clean_data.find_one({'_id': 11})['correctorTime'] == 1700000000
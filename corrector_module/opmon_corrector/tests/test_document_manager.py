@@ -404,6 +404,48 @@ def test_limit_calculation_values(mock_logger_manager, basic_settings, mocker):
         DocumentManager.get_boundary_value.assert_any_call(value)
 
 
+def test_apply_calculations_batch(mock_logger_manager, basic_settings):
+    dm = DocumentManager(basic_settings)
+    documents = [
+        deepcopy(test_doc),
+        {'client': deepcopy(test_doc['client']), 'producer': None},
+        {'client': None, 'producer': deepcopy(test_doc['producer'])},
+        {
+            'client': {'requestInTs': 0, 'requestOutTs': 2 ** 40, 'responseOutTs': 2 ** 40, 'requestSize': 10,
+                       'requestAttachmentCount': 1, 'requestMimeSize': 2 ** 33},
+            'producer': {'requestInTs': 0, 'responseOutTs': 0, 'responseSize': None}
+        },
+    ]
+
+    expected = [dm.apply_calculations(deepcopy(doc)) for doc in documents]
+    result = dm.apply_calculations_batch(documents)
+
+    assert result is documents
+    assert documents == expected
+    assert documents[0]['totalDuration'] == 21
+    assert documents[0]['requestNwDuration'] == 7
+    assert documents[3]['totalDuration'] == 2 ** 31 - 1
+    assert documents[3]['requestNwDuration'] == -2 ** 31 + 1
+    assert documents[3]['clientRequestSize'] == 2 ** 31 - 1
+
+
+def test_apply_calculations_batch_disabled_calculations(mock_logger_manager, basic_settings):
+    for setting in ['total-duration', 'request-nw-duration', 'response-size']:
+        basic_settings['corrector']['calc'][setting] = False
+    dm = DocumentManager(basic_settings)
+    doc = deepcopy(test_doc)
+    doc['requestNwDuration'] = 2 ** 40
+
+    dm.apply_calculations_batch([doc])
+
+    assert 'totalDuration' not in doc
+    assert 'clientResponseSize' not in doc
+    assert 'producerResponseSize' not in doc
+    assert doc['requestNwDuration'] == 2 ** 31 - 1
+    assert doc['clientSsRequestDuration'] == 2
+    assert doc['clientRequestSize'] == 1234
+
+
 def test_match_documents(mock_logger_manager, basic_settings, matching_docs):
     doc1, doc2 = matching_docs
     dm = DocumentManager(basic_settings)
@@ -550,3 +592,30 @@ def test_sanitize_document(mock_logger_manager, basic_settings):
         'field5': None,
         'field6': {'sub': 'test'}
     }
+
+
+def test_normalize_document(mock_logger_manager, basic_settings):
+    dm = DocumentManager(basic_settings)
+    raw_document = {
+        'serviceCode': '<script>',
+        'responseSoapSize': 100,
+        'requestSoapSize': 50,
+        'requestAttachmentCount': 0
+    }
+
+    doc = dm.normalize_document(raw_document)
+
+    assert doc == dm.correct_structure(dm.sanitize_document(raw_document))
+    assert doc['serviceCode'] == '&lt;script&gt;'
+    assert doc['serviceType'] == 'WSDL'
+    assert doc['requestSize'] == 50
+    assert doc['responseSize'] == 100
+    assert doc['faultCode'] is None
+    assert list(doc)[7:] == [f for f in dm.must_fields if f not in list(doc)[:7]]
+    assert raw_document['serviceCode'] == '<script>'
+
+
+def test_escape_html():
+    assert DocumentManager.escape_html('foo') == 'foo'
+    assert DocumentManager.escape_html('&lt;') == '&amp;lt;'
+    assert DocumentManager.escape_html('a<b>&c') == 'a&lt;b&gt;&amp;c'
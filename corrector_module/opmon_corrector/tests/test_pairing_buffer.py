@@ -0,0 +1,85 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+from opmon_corrector.pairing_buffer import PairingBuffer
+
+
+def test_pairs_are_ready_immediately():
+    buffer = PairingBuffer(10, 10)
+    buffer.add('a', 1, 'Client', 100, 0)
+    buffer.add('b', 2, 'Client', 100, 0)
+    buffer.add('a', 3, 'Producer', 105, 1)
+
+    assert buffer.pop_ready(1) == [('a', [1, 3])]
+    assert len(buffer) == 1
+
+
+def test_documents_of_one_party_are_held_for_hold_time():
+    buffer = PairingBuffer(10, 10)
+    buffer.add('a', 1, 'Client', 100, 0)
+    buffer.add('a', 2, 'Client', 100, 2)
+    buffer.add('b', 3, 'Producer', 100, 5)
+
+    assert buffer.pop_ready(9) == []
+    assert buffer.pop_ready(10) == [('a', [1, 2])]
+    assert buffer.pop_ready(15) == [('b', [3])]
+    assert len(buffer) == 0
+
+
+def test_full_buffer_releases_oldest_request_in_ts():
+    buffer = PairingBuffer(2, 10)
+    buffer.add('a', 1, 'Client', 300, 0)
+    buffer.add('b', 2, 'Producer', 100, 0)
+    buffer.add('c', 3, 'Client', 200, 0)
+
+    assert buffer.pop_ready(0) == [('b', [2])]
+
+    buffer.add('c', 4, 'Producer', 200, 1)
+    buffer.add('d', 5, 'Client', 400, 1)
+    buffer.add('e', 6, 'Client', 50, 1)
+    assert buffer.pop_ready(1) == [('c', [3, 4]), ('e', [6])]
+
+
+def test_documents_of_ready_group_are_added_to_group():
+    buffer = PairingBuffer(10, 10)
+    buffer.add('a', 1, 'Client', 100, 0)
+    buffer.add('a', 2, 'producer', 100, 0)
+    buffer.add('a', 3, 'Producer', 100, 0)
+
+    assert buffer.pop_ready(0) == [('a', [1, 2, 3])]
+
+    buffer.add('a', 4, 'Producer', 100, 1)
+    assert buffer.pop_ready(1) == []
+    assert buffer.pop_ready(11) == [('a', [4])]
+
+
+def test_clear_drops_groups():
+    buffer = PairingBuffer(10, 10)
+    buffer.add('a', 1, 'Client', 100, 0)
+    buffer.add('b', 2, 'Client', 100, 0)
+    buffer.add('b', 3, 'Producer', 100, 0)
+    buffer.clear()
+
+    assert len(buffer) == 0
+    assert buffer.pop_ready(100) == []
@@ -0,0 +1,201 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+
+import os
+import pathlib
+import time
+from logging import StreamHandler
+
+import mongomock  # type: ignore
+import pymongo
+import pytest
+from freezegun import freeze_time
+from pymongo.errors import OperationFailure
+
+from opmon_corrector.logger_manager import LoggerManager
+from opmon_corrector.raw_message_stream import RawMessageStream
+from opmon_corrector.settings_parser import OpmonSettingsManager
+
+
+class FakeChangeStream:
+    def __init__(self, events, frozen_time=None):
+        self.events = list(events)
+        self.frozen_time = frozen_time
+        self.closed = False
+
+    def try_next(self):
+        if not self.events:
+            # Change stream waits for max_await_time_ms when there are no changes
+            self.frozen_time.tick(1)
+            return None
+        event = self.events.pop(0)
+        if isinstance(event, Exception):
+            raise event
+        return event
+
+    def close(self):
+        self.closed = True
+
+
+def insert_event(doc_id, x_request_id, security_server_type='Client'):
+    return {
+        'operationType': 'insert',
+        'fullDocument': {
+            '_id': doc_id, 'xRequestId': x_request_id, 'securityServerType': security_server_type, 'requestInTs': doc_id
+        }
+    }
+
+
+@pytest.fixture(autouse=True)
+def mock_logger_manager(mocker):
+    mocker.patch('opmon_corrector.logger_manager.LoggerManager._create_file_handler', return_value=StreamHandler())
+
+
+@pytest.fixture
+def settings():
+    os.chdir(pathlib.Path(__file__).parent.absolute())
+    settings = OpmonSettingsManager('UNITTEST').settings
+    settings['corrector']['change-stream-grace-window'] = 10
+    return settings
+
+
+@pytest.fixture
+def mongo():
+    with mongomock.patch(servers=(('mongodb', 27017),)):
+        yield pymongo.MongoClient('mongodb').query_db_UNITTEST
+
+
+@pytest.fixture
+def watch(mocker, mongo):
+    return mocker.patch.object(mongomock.collection.Collection, 'watch', create=True)
+
+
+def make_stream(settings):
+    return RawMessageStream(settings, LoggerManager(settings['logger'], settings['xroad']['instance'], ''))
+
+
+def test_stream_groups_inserts_by_x_request_id(settings, watch):
+    stream = make_stream(settings)
+
+    with freeze_time('2026-01-01 12:00:00') as frozen_time:
+        watch.return_value = FakeChangeStream([
+            insert_event(1, 'a'), insert_event(2, 'b'), insert_event(3, 'a', 'Producer')
+        ], frozen_time)
+        assert stream.open({'xRequestId': {'$lt': '8'}})
+
+        assert stream.wait(5) == [('a', [1, 3])]
+        assert len(stream.buffer) == 1
+
+        assert stream.wait(60) == [('b', [2])]
+        assert len(stream.buffer) == 0
+        assert stream.wait(1) == []
+
+    pipeline = watch.call_args.args[0]
+    assert pipeline[0]['$match']['fullDocument.xRequestId'] == {'$ne': None, '$lt': '8'}
+
+
+def test_stream_returns_groups_after_grace_window(settings, watch):
+    stream = make_stream(settings)
+
+    with freeze_time('2026-01-01 12:00:00') as frozen_time:
+        watch.return_value = FakeChangeStream([insert_event(1, 'a')], frozen_time)
+        stream.open()
+        start_time = time.monotonic()
+
+        assert stream.wait(60) == [('a', [1])]
+        assert time.monotonic() - start_time == 10
+
+
+def test_stream_is_reopened_for_other_shard(settings, watch):
+    watch.side_effect = lambda *args, **kwargs: FakeChangeStream([])
+    stream = make_stream(settings)
+
+    assert stream.open()
+    assert stream.open()
+    assert watch.call_count == 1
+
+    first_stream = stream._stream
+    assert stream.open({'xRequestId': {'$gte': '8'}})
+    assert watch.call_count == 2
+    assert first_stream.closed
+
+
+def test_stream_falls_back_to_polling_without_replica_set(settings, watch):
+    watch.side_effect = OperationFailure('The $changeStream stage is only supported on replica sets', code=40573)
+    stream = make_stream(settings)
+
+    assert not stream.open()
+    assert not stream.is_open
+    assert stream.wait(0) == []
+
+    # Server without change streams is not asked again
+    assert not stream.open()
+    assert watch.call_count == 1
+
+
+def test_stream_open_backs_off_after_failure(settings, watch, mocker):
+    watch.side_effect = [OperationFailure('not primary'), OperationFailure('not primary'), FakeChangeStream([])]
+    stream = make_stream(settings)
+    log_warning = mocker.spy(stream.logger_m, 'log_warning')
+
+    with freeze_time('2026-01-01 12:00:00') as frozen_time:
+        assert not stream.open()
+        assert not stream.open()
+        assert watch.call_count == 1
+
+        frozen_time.tick(60)
+        assert not stream.open()
+        assert watch.call_count == 2
+
+        # Retry interval is doubled after the second failure
+        frozen_time.tick(60)
+        assert not stream.open()
+        assert watch.call_count == 2
+        frozen_time.tick(60)
+        assert stream.open()
+        assert watch.call_count == 3
+
+    # Only the first failure is logged
+    assert log_warning.call_count == 1
+
+
+def test_stream_is_closed_on_error(settings, watch):
+    watch.return_value = FakeChangeStream([insert_event(1, 'a'), OperationFailure('stream lost')])
+    stream = make_stream(settings)
+    stream.open()
+
+    assert stream.wait(5) == []
+    assert not stream.is_open
+    assert len(stream.buffer) == 0
+
+
+def test_stream_shutdown_closes_client(settings, watch, mocker):
+    watch.return_value = FakeChangeStream([])
+    stream = make_stream(settings)
+    stream.open()
+    close = mocker.spy(stream.db_m, 'close')
+
+    stream.shutdown()
+    assert not stream.is_open
+    close.assert_called_once()
@@ -0,0 +1,135 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+import os
+import pathlib
+import string
+from logging import StreamHandler
+
+import mongomock  # type: ignore
+import pymongo
+import pytest
+
+from opmon_corrector.logger_manager import LoggerManager
+from opmon_corrector.settings_parser import OpmonSettingsManager
+from opmon_corrector.shard_lease import ShardLease, get_x_request_id_range
+
+
+@pytest.fixture(autouse=True)
+def mock_logger_manager(mocker):
+    mocker.patch('opmon_corrector.logger_manager.LoggerManager._create_file_handler', return_value=StreamHandler())
+
+
+@pytest.fixture
+def settings():
+    os.chdir(pathlib.Path(__file__).parent.absolute())
+    settings = OpmonSettingsManager('UNITTEST').settings
+    settings['corrector']['shard-count'] = 2
+    settings['corrector']['shard-lease-time'] = 60
+    return settings
+
+
+@pytest.fixture
+def mongo():
+    with mongomock.patch(servers=(('mongodb', 27017),)):
+        yield pymongo.MongoClient('mongodb').query_db_UNITTEST
+
+
+def make_lease(settings):
+    return ShardLease(settings, LoggerManager(settings['logger'], settings['xroad']['instance'], ''))
+
+
+def in_range(x_request_id, lower, upper):
+    return (lower is None or x_request_id >= lower) and (upper is None or x_request_id < upper)
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 3, 7])
+def test_x_request_id_ranges_cover_every_id_once(shard_count):
+    ranges = [get_x_request_id_range(i, shard_count) for i in range(shard_count)]
+    x_request_ids = [c * 8 for c in string.hexdigits + 'xyzXYZ-'] + ['', '7fff-', '8000-', 'ffffffff']
+    for x_request_id in x_request_ids:
+        assert sum(in_range(x_request_id, lower, upper) for lower, upper in ranges) == 1
+
+
+def test_x_request_id_range_splits_prefixes_evenly():
+    assert get_x_request_id_range(0, 4) == (None, '4000')
+    assert get_x_request_id_range(1, 4) == ('4000', '8000')
+    assert get_x_request_id_range(3, 4) == ('c000', None)
+
+
+def test_instances_claim_different_shards(mongo, settings):
+    first, second, third = make_lease(settings), make_lease(settings), make_lease(settings)
+
+    assert first.acquire()
+    assert second.acquire()
+    assert not third.acquire()
+    assert {first.shard_index, second.shard_index} == {0, 1}
+    assert first.x_request_id_query() == {'xRequestId': {'$lt': '8000'}}
+    assert second.x_request_id_query() == {'xRequestId': {'$gte': '8000'}}
+    assert first.processes_faulty_documents
+    assert not second.processes_faulty_documents
+
+    # renewing keeps the same shard
+    assert first.acquire()
+    assert first.shard_index == 0
+
+    second.release()
+    assert third.acquire()
+    assert third.shard_index == 1
+
+
+def test_expired_lease_can_be_claimed(mongo, settings):
+    settings['corrector']['shard-count'] = 3
+    first, second = make_lease(settings), make_lease(settings)
+    assert first.acquire() and second.acquire()
+
+    mongo.corrector_leases.update_one({'owner': first.owner}, {'$set': {'expires': 0}})
+    third = make_lease(settings)
+    assert third.acquire()
+    assert third.shard_index == 0
+
+    # the previous owner notices that the lease was lost and claims a free shard
+    assert first.acquire()
+    assert first.shard_index == 2
+
+
+def test_close_releases_lease_and_client(mongo, settings, mocker):
+    first, second = make_lease(settings), make_lease(settings)
+    assert first.acquire()
+    close = mocker.spy(first.db_m, 'close')
+
+    first.close()
+    close.assert_called_once()
+    assert first.shard_index is None
+    assert second.acquire()
+    assert second.shard_index == 0
+
+
+def test_sharding_disabled(settings):
+    settings['corrector']['shard-count'] = 1
+    lease = make_lease(settings)
+    assert lease.db_m is None
+    assert lease.acquire()
+    assert lease.x_request_id_query() == {}
+    assert lease.processes_faulty_documents
+    lease.close()
@@ -0,0 +1,106 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+import os
+import pathlib
+from logging import StreamHandler
+
+import pytest
+
+from opmon_corrector.corrector_worker import CorrectorWorker
+from opmon_corrector.logger_manager import LoggerManager
+from opmon_corrector.settings_parser import OpmonSettingsManager
+from opmon_corrector.worker_pool import CorrectorWorkerPool
+
+
+def process_task(worker, job_type, task):
+    if 'fail' in task:
+        raise ValueError('failed task')
+    if 'exit' in task:
+        os._exit(1)
+    return len(task)
+
+
+@pytest.fixture
+def pool(mocker):
+    os.chdir(pathlib.Path(__file__).parent.absolute())
+    mocker.patch('opmon_corrector.logger_manager.LoggerManager._create_file_handler', return_value=StreamHandler())
+    mocker.patch.object(CorrectorWorker, 'start')
+    mocker.patch.object(CorrectorWorker, 'process_task', process_task)
+    # Patched worker methods are inherited only by forked worker processes
+    mocker.patch('opmon_corrector.worker_pool.START_METHOD', 'fork')
+    settings = OpmonSettingsManager('UNITTEST').settings
+    settings['corrector']['thread-count'] = 2
+    logger_m = LoggerManager(settings['logger'], settings['xroad']['instance'], '')
+    pool = CorrectorWorkerPool(settings, logger_m)
+    yield pool
+    pool.terminate()
+
+
+def test_worker_pool_is_reused_between_jobs(pool):
+    pool.start()
+    pids = [p.pid for p in pool._processes]
+
+    assert pool.process(([i] * i for i in range(10)), 'consume') == sum(range(10))
+    assert pool.process([['a'], ['b']], 'faulty') == 2
+    assert [p.pid for p in pool._processes] == pids
+
+    pool.stop()
+    assert pool._processes == []
+
+
+def test_worker_pool_logs_failed_tasks(pool, mocker):
+    log_error = mocker.patch.object(pool.logger_m, 'log_error')
+    assert pool.process([['a'], ['fail'], ['b', 'c']], 'consume') == 3
+    log_error.assert_called_once()
+    assert 'failed task' in log_error.call_args.args[1]
+
+
+def test_worker_pool_restarts_after_worker_exit(pool):
+    with pytest.raises(RuntimeError, match='exited with code 1'):
+        pool.process([['exit']], 'consume')
+    assert pool._processes == []
+
+    assert pool.process([['a']], 'consume') == 1
+    assert len(pool._processes) == 2
+
+
+def test_worker_pool_stop_stops_all_workers(pool):
+    for _ in range(5):
+        pool.process([['a']], 'consume')
+        processes = pool._processes
+        pool.stop()
+        assert [p.exitcode for p in processes] == [0, 0]
+
+
+
+def test_worker_pool_spawns_workers(mocker):
+    os.chdir(pathlib.Path(__file__).parent.absolute())
+    get_context = mocker.patch('opmon_corrector.worker_pool.multiprocessing.get_context')
+    settings = OpmonSettingsManager('UNITTEST').settings
+    settings['corrector']['thread-count'] = 2
+    pool = CorrectorWorkerPool(settings, mocker.Mock())
+    pool.start()
+
+    get_context.assert_called_once_with('spawn')
+    assert get_context.return_value.Process.call_count == 2
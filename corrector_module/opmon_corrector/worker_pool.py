@@ -0,0 +1,170 @@
+#
+# The MIT License 
+# Copyright (c) 2021- Nordic Institute for Interoperability Solutions (NIIS)
+# Copyright (c) 2017-2020 Estonian Information System Authority (RIA)
+#  
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the "Software"), to deal 
+# in the Software without restriction, including without limitation the rights 
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell 
+# copies of the Software, and to permit persons to whom the Software is 
+# furnished to do so, subject to the following conditions: 
+#  
+# The above copyright notice and this permission notice shall be included in 
+# all copies or substantial portions of the Software. 
+#  
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, 
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN 
+# THE SOFTWARE.
+#
+"""
+Worker Pool - Corrector Module
+"""
+
+import multiprocessing
+import queue
+import time
+
+from opmon_corrector.corrector_worker import CorrectorWorker
+from opmon_corrector.logger_manager import LoggerManager
+
+# Seconds to wait for a queue before checking that all worker processes are alive
+POLL_INTERVAL = 1
+# Worker processes are spawned, not forked: when workers are restarted the corrector process already has MongoDB
+# clients with monitor threads, which must not be inherited by a forked child.
+START_METHOD = 'spawn'
+
+
+class CorrectorWorkerPool:
+    """
+    Long-lived pool of corrector worker processes.
+
+    Worker processes are started once and keep their settings and MongoDB connection across corrector batches.
+    Work is passed to them as task messages through a bounded queue and every task is acknowledged through a result
+    queue, so process() returns when all tasks of the job are done.
+    If a worker process dies, the job fails and the pool is restarted for the next job.
+    """
+
+    def __init__(self, settings, logger_m: LoggerManager):
+        self.settings = settings
+        self.logger_m = logger_m
+        self.thread_count = settings['corrector']['thread-count']
+        self._task_queue = None
+        self._result_queue = None
+        self._processes = []
+        self._job_id = 0
+
+    def start(self):
+        """
+        Starts the worker processes.
+        :return: Returns the time in seconds spent starting the workers.
+        """
+        start_time = time.time()
+        context = multiprocessing.get_context(START_METHOD)
+        self._task_queue = context.Queue(maxsize=2 * self.thread_count)
+        self._result_queue = context.Queue()
+        self._processes = []
+        for i in range(self.thread_count):
+            worker = CorrectorWorker(self.settings, f'worker_{i}')
+            p = context.Process(target=worker.serve, args=(self._task_queue, self._result_queue), daemon=True)
+            p.start()
+            self._processes.append(p)
+        startup_time = time.time() - start_time
+        self.logger_m.log_info(
+            'corrector_worker_pool_start', f'Started {self.thread_count} corrector workers in {startup_time:.3f} seconds.'
+        )
+        return startup_time
+
+    def stop(self):
+        """
+        Stops the worker processes after they have finished their current tasks.
+        :return: None
+        """
+        alive = sum(1 for p in self._processes if p.is_alive())
+        for _ in range(alive):
+            self._put(None)
+        for p in self._processes:
+            p.join()
+        self._processes = []
+
+    def terminate(self):
+        """
+        Kills the worker processes without waiting for their tasks.
+        :return: None
+        """
+        for p in self._processes:
+            p.terminate()
+        for p in self._processes:
+            p.join()
+        self._processes = []
+
+    def process(self, tasks, job_type='consume'):
+        """
+        Processes tasks in the worker processes and waits until all of them are done.
+        Tasks are read lazily while workers are running.
+        :param tasks: Iterable of tasks.
+        :param job_type: Job type (consume / faulty)
+        :return: Returns the total of task results, i.e. the number of duplicates for the consume job.
+        """
+        if not self._processes:
+            self.start()
+
+        self._job_id += 1
+        sent = 0
+        received = 0
+        total = 0
+        errors = []
+        try:
+            for task in tasks:
+                self._put((self._job_id, job_type, task))
+                sent += 1
+                # Collect results already available to keep the result queue short
+                while True:
+                    result = self._get_result(block=False)
+                    if result is None:
+                        break
+                    received, total = self._add_result(result, received, total, errors)
+
+            while received < sent:
+                received, total = self._add_result(self._get_result(), received, total, errors)
+        except Exception:
+            self.terminate()
+            raise
+
+        for error in errors:
+            self.logger_m.log_error('corrector_worker', error)
+        return total
+
+    def _add_result(self, result, received, total, errors):
+        job_id, value, error = result
+        if job_id != self._job_id:
+            return received, total
+        if error:
+            errors.append(error)
+        return received + 1, total + value
+
+    def _put(self, item):
+        while True:
+            try:
+                self._task_queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                self._check_workers()
+
+    def _get_result(self, block=True):
+        while True:
+            try:
+                return self._result_queue.get(block, POLL_INTERVAL)
+            except queue.Empty:
+                if not block:
+                    return None
+                self._check_workers()
+
+    def _check_workers(self):
+        for p in self._processes:
+            if not p.is_alive():
+                raise RuntimeError(f'Corrector worker process {p.pid} exited with code {p.exitcode}.')